@@ -0,0 +1,125 @@
+import config
+import random
+
+# AI controllers. They expose the same interface as input.InputController (an `action` among
+# 'up', 'down' and 'stop') plus an update() called once per tick before the paddles move.
+#
+# The side tells the controller which paddle of the game it drives: 'right' is the enemy
+# and 'left' is the player (used when two AIs play against each other, e.g. headless matches)
+
+class AIController():
+    def __init__(self, game, side='right'):
+        self.action = 'stop'
+        self.game = game
+        self.side = side
+
+    def _get_paddle(self):
+        if self.side == 'right':
+            return self.game.enemy
+        return self.game.player
+
+    # The ball the controller plays, games with several balls pick one (see arena.py)
+    def _get_ball(self):
+        return self.game.ball
+
+    def _is_ball_incoming(self, ball):
+        if self.side == 'right':
+            return ball.rect.centerx >= self.game.screen_rect.centerx
+        return ball.rect.centerx <= self.game.screen_rect.centerx
+
+    def update(self):
+        paddle = self._get_paddle()
+        ball = self._get_ball()
+        if self._is_ball_incoming(ball):
+            if paddle.rect.centery > ball.rect.centery:
+                self.action = 'up'
+            elif paddle.rect.centery < ball.rect.centery:
+                self.action = 'down'
+            else:
+                self.action = 'stop'
+        else:
+            if paddle.rect.centery > self.game.screen_rect.centery + paddle.speed:
+                self.action = 'up'
+            elif paddle.rect.centery < self.game.screen_rect.centery - paddle.speed:
+                self.action = 'down'
+            else:
+                self.action = 'stop'
+
+# Solves where the ball will meet the paddle instead of chasing it. The intercept is computed
+# analytically (the top/bottom wall reflections are unfolded) only when the ball velocity
+# changes, i.e. after a wall bounce, a paddle hit or a serve; every other tick is a comparison
+# against the cached target.
+#   reaction_delay: ticks before a new solution is followed (the old target is kept meanwhile)
+#   error: standard deviation, in pixels, of the noise added to every solution
+class PredictiveAIController(AIController):
+    def __init__(self, game, side='right', reaction_delay=config.AI_REACTION_DELAY,
+                 error=config.AI_ERROR, rng=None):
+        super().__init__(game, side)
+        self.reaction_delay = reaction_delay
+        self.error = error
+        self.rng = rng if rng is not None else random
+        self._velocity = None
+        self._target = None
+        self._pending_target = None
+        self._delay = 0
+
+    def _is_ball_approaching(self, ball):
+        if self.side == 'right':
+            return ball.xspeed > 0
+        return ball.xspeed < 0
+
+    def predict_intercept(self):
+        ball = self._get_ball()
+        paddle = self._get_paddle()
+        if not self._is_ball_approaching(ball):
+            return float(self.game.screen_rect.centery)
+
+        # Ball top-left x when it touches the paddle face
+        if self.side == 'right':
+            contact_x = paddle.rect.left - ball.size
+        else:
+            contact_x = paddle.rect.right
+        ticks = (contact_x - ball.fx) / ball.xspeed
+        y = ball.fy + ball.yspeed * max(ticks, 0.0)
+
+        # Fold the unbounded trajectory into the board: reflections at 0 and span
+        span = ball.board_rect.height - ball.size
+        if span > 0:
+            y = y % (2 * span)
+            if y > span:
+                y = 2 * span - y
+        target = y + ball.size / 2
+
+        if self.error:
+            target += self.rng.gauss(0.0, self.error)
+        return target
+
+    def update(self):
+        ball = self._get_ball()
+        velocity = (ball.xspeed, ball.yspeed)
+        if velocity != self._velocity:
+            self._velocity = velocity
+            self._pending_target = self.predict_intercept()
+            if self._target is None:
+                self._target = self._pending_target
+                self._delay = 0
+            else:
+                self._delay = self.reaction_delay
+
+        if self._delay > 0:
+            self._delay -= 1
+        else:
+            self._target = self._pending_target
+
+        paddle = self._get_paddle()
+        if paddle.rect.centery > self._target + paddle.speed:
+            self.action = 'up'
+        elif paddle.rect.centery < self._target - paddle.speed:
+            self.action = 'down'
+        else:
+            self.action = 'stop'
+
+CONTROLLERS = {'simple': AIController, 'predictive': PredictiveAIController}
+
+def create_controller(game, name=None, side='right', **kwargs):
+    return CONTROLLERS[name or config.ENEMY_AI](game, side=side, **kwargs)
@@ -0,0 +1,274 @@
+import sys
+import time
+import random
+import config
+import pygame
+from entities import Ball, Paddle, Obstacle
+from ai import AIController
+from broadphase import UniformGrid
+from input import InputController
+from loader import EmptySound
+from simulation import check_point
+from widgets import SimpleTextBox
+
+# Multi-ball arena: the usual two paddles against dozens to hundreds of balls, with static
+# obstacles in the middle of the board. Balls don't collide with each other, every ball
+# bounces off the walls, the paddles and the obstacles (swept collisions) and scores on its
+# own. The paddles and obstacles are registered in a broadphase.UniformGrid, each ball only
+# checks the colliders of the cells around it.
+#
+# python arena.py play [BALLS] [OBSTACLES]: left paddle on the keyboard, right one AI
+# python arena.py stress [--obstacles M] [--frames N] [--only grid|naive]
+#   raises the number of balls until a frame (the physics steps of one frame at config.FPS plus
+#   drawing everything) no longer fits in the frame budget at p95, and reports that ceiling
+#   with the grid and with every ball checking every collider (naive)
+
+STRESS_START = 8
+STRESS_FRAMES = 120
+STRESS_WARMUP = 20
+STRESS_LIMIT = 100000
+
+# Follows the ball that will reach its side first, the closest one when none is coming
+class ArenaAIController(AIController):
+
+    def _get_ball(self):
+        paddle = self._get_paddle()
+        if self.side == 'right':
+            face, direction = paddle.rect.left, 1
+        else:
+            face, direction = paddle.rect.right, -1
+        best, best_time = None, None
+        for ball in self.game.balls:
+            velocity = ball.xspeed * ball.speed_coeff * direction
+            if velocity <= 0:
+                continue
+            ticks = (face - ball.rect.centerx) * direction / velocity
+            if ticks >= 0 and (best_time is None or ticks < best_time):
+                best, best_time = ball, ticks
+        if best is None:
+            best = min(self.game.balls, key=lambda ball: abs(face - ball.rect.centerx))
+        return best
+
+def arena_left_ai(game):
+    return ArenaAIController(game, side='left')
+
+def arena_right_ai(game):
+    return ArenaAIController(game, side='right')
+
+# count obstacle rects on a lattice between the paddles, with a free band in the middle of the
+# board where the balls are served. The lattice cells are picked by a seeded RNG
+def obstacle_lattice(count, board_rect, size=config.BRICK_SIZE // 2, spacing=2 * config.BRICK_SIZE, seed=0):
+    candidates = []
+    left, right = board_rect.left + 4 * config.BRICK_SIZE, board_rect.right - 4 * config.BRICK_SIZE
+    band = pygame.Rect(0, 0, 3 * config.BRICK_SIZE, board_rect.height)
+    band.centerx = board_rect.centerx
+    for y in range(board_rect.top + spacing // 2, board_rect.bottom - size, spacing):
+        for x in range(left, right - size, spacing):
+            rect = pygame.Rect(x, y, size, size)
+            if not rect.colliderect(band):
+                candidates.append(rect)
+    if count > len(candidates):
+        raise ValueError("At most {} obstacles fit on the board".format(len(candidates)))
+    return sorted(random.Random(seed).sample(candidates, count), key=lambda rect: (rect.y, rect.x))
+
+class MultiBallMatch():
+
+    # obstacles: rects of the obstacles. broadphase: look the colliders up in a UniformGrid,
+    # every ball checks all of them otherwise. Scores never end the match
+    def __init__(self, ball_count, obstacles=(), player_controller=arena_left_ai,
+                 enemy_controller=arena_right_ai, ball_speed=config.BALL_SPEED, timestep=None,
+                 seed=None, broadphase=True, board=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.timestep = timestep if timestep is not None else config.TIMESTEP
+        self.board = board if board is not None else pygame.Surface((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+        self.screen_rect = self.board.get_rect()
+
+        self.balls = []
+        for _ in range(ball_count):
+            ball = Ball(config.BRICK_SIZE, self.screen_rect.centerx, self.screen_rect.centery,
+                        ball_speed, self.board, bounce_sound=EmptySound(), hit_sound=EmptySound(),
+                        rng=self.rng)
+            # Served along the middle band, not all from the center
+            ball.y = self.rng.randrange(0, self.screen_rect.height - ball.size)
+            ball.fy = ball.prev_fy = float(ball.y)
+            self.balls.append(ball)
+        self.player = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
+                             2*config.BRICK_SIZE, self.screen_rect.centery,
+                             config.PLAYER_SPEED, self.board, player_controller(self))
+        self.enemy = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
+                            config.SCREEN_WIDTH - 2*config.BRICK_SIZE,
+                            self.screen_rect.centery, config.ENEMY_SPEED,
+                            self.board, enemy_controller(self))
+        self.paddles = [self.player, self.enemy]
+        self.obstacles = [Obstacle(rect.width, rect.height, rect.centerx, rect.centery, self.board)
+                          for rect in obstacles]
+        self.colliders = self.paddles + self.obstacles
+
+        self.grid = None
+        if broadphase:
+            self.grid = UniformGrid(self.screen_rect)
+            for entity in self.colliders:
+                self.grid.insert(entity)
+        for ball in self.balls:
+            if self.grid is not None:
+                ball.broadphase = self.grid
+            else:
+                ball.colliders = self.colliders
+
+        self.background = pygame.Surface(self.screen_rect.size)
+        self.background.fill(pygame.Color('black'))
+        for obstacle in self.obstacles:
+            self.background.blit(obstacle.image, obstacle.rect)
+
+        self.player_score = 0
+        self.enemy_score = 0
+        self.ticks = 0
+
+    @property
+    def entities(self):
+        return self.balls + self.colliders
+
+    # Same order as HeadlessMatch.step(): points, controllers, balls then paddles. The grid
+    # is updated once the paddles have moved
+    def step(self):
+        for ball in self.balls:
+            scorer = check_point(ball, self.player, self.enemy)
+            if scorer is not None:
+                if scorer == 'enemy':
+                    self.enemy_score += 1
+                else:
+                    self.player_score += 1
+                ball.reset()
+
+        for paddle in self.paddles:
+            paddle.controller.update()
+        for ball in self.balls:
+            ball.update(self.timestep)
+        for paddle in self.paddles:
+            paddle.update(self.timestep)
+            if self.grid is not None:
+                self.grid.update(paddle)
+
+        self.ticks += 1
+
+    # Full redraw, the obstacles are part of the background
+    def draw(self, surface):
+        surface.blit(self.background, (0, 0))
+        surface.blits([(ball.image, ball.rect) for ball in self.balls], doreturn=False)
+        for paddle in self.paddles:
+            surface.blit(paddle.image, paddle.rect)
+
+    def state(self):
+        return (self.ticks, self.player_score, self.enemy_score,
+                tuple((ball.fx, ball.fy, ball.xspeed, ball.yspeed, ball.speed_coeff) for ball in self.balls),
+                tuple(paddle.fy for paddle in self.paddles))
+
+def play(ball_count, obstacle_count):
+    screen = pygame.display.set_mode((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+    pygame.display.set_caption("PyPong! arena")
+    controller = InputController()
+    match = MultiBallMatch(ball_count, obstacle_lattice(obstacle_count, screen.get_rect()),
+                           player_controller=lambda game: controller, board=screen)
+    player_score_textbox = SimpleTextBox(screen.get_rect().centerx - 40, 36, screen, text='0', glyphs=True)
+    enemy_score_textbox = SimpleTextBox(screen.get_rect().centerx + 40, 36, screen, text='0', glyphs=True)
+    clock = pygame.time.Clock()
+    accumulator = 0.0
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                return match
+            controller.handle_event(event)
+        accumulator += min(clock.tick(config.FPS) / 1000.0, config.MAX_FRAME_TIME)
+        while accumulator >= match.timestep:
+            match.step()
+            accumulator -= match.timestep
+        match.draw(screen)
+        player_score_textbox.modify(newtext=str(match.player_score))
+        enemy_score_textbox.modify(newtext=str(match.enemy_score))
+        for textbox in (player_score_textbox, enemy_score_textbox):
+            textbox.update()
+            textbox.draw()
+        pygame.display.update()
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(percent / 100 * len(sorted_values)))]
+
+# p95 frame time (seconds) with ball_count balls and the colliders checked per ball query
+def measure_frame(ball_count, obstacles, broadphase, surface, frames=STRESS_FRAMES):
+    match = MultiBallMatch(ball_count, obstacles, seed=0, broadphase=broadphase, board=surface)
+    steps = max(1, round(1 / (config.FPS * match.timestep)))
+    def frame():
+        for _ in range(steps):
+            match.step()
+        match.draw(surface)
+    for _ in range(STRESS_WARMUP):
+        frame()
+    if match.grid is not None:
+        match.grid.reset_stats()
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        frame()
+        times.append(time.perf_counter() - start)
+    if match.grid is not None:
+        candidates = match.grid.candidates / match.grid.queries if match.grid.queries else 0.0
+    else:
+        candidates = float(len(match.colliders))
+    return _percentile(sorted(times), 95), candidates
+
+# Doubles the number of balls until the frame budget is exceeded, then bisects down to the
+# largest count that fits (within 1/16)
+def find_ceiling(obstacles, broadphase, surface, budget, frames=STRESS_FRAMES):
+    name = 'grid' if broadphase else 'naive'
+    def fits(ball_count):
+        p95, candidates = measure_frame(ball_count, obstacles, broadphase, surface, frames)
+        print("{:<6} {:>6} balls  p95 {:>7.2f} ms  {:>5.1f} colliders/query  {}".format(
+            name, ball_count, 1000 * p95, candidates, 'ok' if p95 <= budget else 'over budget'))
+        return p95 <= budget
+
+    low, high = 0, STRESS_START
+    while high <= STRESS_LIMIT and fits(high):
+        low, high = high, 2 * high
+    if high > STRESS_LIMIT:
+        return low
+    while high - low > max(1, low // 16):
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+def _argument(name, default, cast=str):
+    if name in sys.argv:
+        return cast(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+def stress():
+    surface = pygame.Surface((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+    obstacle_count = _argument('--obstacles', config.ARENA_OBSTACLES, int)
+    obstacles = obstacle_lattice(obstacle_count, surface.get_rect())
+    frames = _argument('--frames', STRESS_FRAMES, int)
+    only = _argument('--only', None)
+    budget = 1 / config.FPS
+    ceilings = {}
+    for broadphase in (True, False):
+        name = 'grid' if broadphase else 'naive'
+        if only is None or only == name:
+            ceilings[name] = find_ceiling(obstacles, broadphase, surface, budget, frames)
+    print("Frame budget {:.2f} ms ({} FPS), 2 paddles + {} obstacles, {} physics steps per frame".format(
+        1000 * budget, config.FPS, obstacle_count, max(1, round(1 / (config.FPS * config.TIMESTEP)))))
+    for name, ceiling in ceilings.items():
+        print("{:<6} ceiling: {} balls".format(name, ceiling))
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stress'
+    if command == 'play':
+        pygame.init()
+        ball_count = int(sys.argv[2]) if len(sys.argv) > 2 else config.ARENA_BALLS
+        obstacle_count = int(sys.argv[3]) if len(sys.argv) > 3 else config.ARENA_OBSTACLES
+        match = play(ball_count, obstacle_count)
+        print("score {}-{} after {} ticks".format(match.player_score, match.enemy_score, match.ticks))
+    elif command == 'stress':
+        stress()
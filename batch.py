@@ -0,0 +1,251 @@
+import config
+import numpy as np
+from simulation import MAXIMUM_SCORE
+
+# Vectorized version of simulation.HeadlessMatch: N AI vs AI matches kept as
+# structure-of-arrays buffers and advanced together, one numpy pass per tick.
+#
+# Every step mirrors the scalar order of operations (scoring, collisions, AI, ball and paddle
+# movement) with the same float64 arithmetic, so a lane fed the same serve directions as a
+# scalar match with discrete collisions (HeadlessMatch(swept=False)) follows the same trajectory. The only expected difference is np.sin vs math.sin
+# (last ulp), hence POSITION_TOLERANCE. Serves are random in both engines, so unsynchronized
+# runs only agree statistically (see compare_with_scalar()).
+
+POSITION_TOLERANCE = 1e-6
+
+def random_serve(rng, count):
+    return rng.choice((-1.0, 1.0), size=count), rng.choice((-1.0, 1.0), size=count)
+
+class BatchSimulation():
+
+    def __init__(self, count, ball_speed=config.BALL_SPEED, maximum_score=MAXIMUM_SCORE,
+                 seed=None, serve=random_serve):
+        self.count = count
+        self.maximum_score = maximum_score
+        self.rng = np.random.default_rng(seed)
+        self._serve = serve
+
+        self.ball_size = config.BRICK_SIZE
+        self.paddle_width = config.BRICK_SIZE
+        self.paddle_height = 3 * config.BRICK_SIZE
+        self.board_width = config.SCREEN_WIDTH
+        self.board_height = config.SCREEN_HEIGHT
+        self.initial_speed = float(ball_speed)
+
+        # Same rect arithmetic as pygame's get_rect(center=...)
+        self.ball_start_x = self.board_width // 2 - self.ball_size // 2
+        self.ball_start_y = self.board_height // 2 - self.ball_size // 2
+        self.player_x = 2 * config.BRICK_SIZE - self.paddle_width // 2
+        self.enemy_x = self.board_width - 2 * config.BRICK_SIZE - self.paddle_width // 2
+        self.paddle_start_y = self.board_height // 2 - self.paddle_height // 2
+        self.player_speed = config.PLAYER_SPEED
+        self.enemy_speed = config.ENEMY_SPEED
+
+        self.ball_x = np.full(count, self.ball_start_x, dtype=np.int64)
+        self.ball_y = np.full(count, self.ball_start_y, dtype=np.int64)
+        self.ball_fx = self.ball_x.astype(np.float64)
+        self.ball_fy = self.ball_y.astype(np.float64)
+        xdir, ydir = self._serve(self.rng, count)
+        self.xspeed = self.initial_speed * xdir
+        self.yspeed = self.initial_speed * ydir
+        self.speed_coeff = np.ones(count, dtype=np.float64)
+
+        self.player_y = np.full(count, self.paddle_start_y, dtype=np.int64)
+        self.enemy_y = np.full(count, self.paddle_start_y, dtype=np.int64)
+
+        self.player_score = np.zeros(count, dtype=np.int64)
+        self.enemy_score = np.zeros(count, dtype=np.int64)
+        self.ticks = np.zeros(count, dtype=np.int64)
+        self.current_rally = np.zeros(count, dtype=np.int64)
+        self.total_hits = np.zeros(count, dtype=np.int64)
+        self.longest_rally = np.zeros(count, dtype=np.int64)
+        self.finished = np.zeros(count, dtype=bool)
+
+    @property
+    def active(self):
+        return ~self.finished
+
+    def load_match(self, index, match):
+        # Copies the state of a simulation.HeadlessMatch into one lane
+        self.ball_x[index] = match.ball.rect.x
+        self.ball_y[index] = match.ball.rect.y
+        self.ball_fx[index] = match.ball.fx
+        self.ball_fy[index] = match.ball.fy
+        self.xspeed[index] = match.ball.xspeed
+        self.yspeed[index] = match.ball.yspeed
+        self.speed_coeff[index] = match.ball.speed_coeff
+        self.player_y[index] = match.player.rect.y
+        self.enemy_y[index] = match.enemy.rect.y
+        self.player_score[index] = match.player_score
+        self.enemy_score[index] = match.enemy_score
+        self.ticks[index] = match.ticks
+
+    def _reset_balls(self, mask):
+        indices = np.flatnonzero(mask)
+        if indices.size == 0:
+            return
+        xdir, ydir = self._serve(self.rng, indices.size)
+        self.ball_x[indices] = self.ball_start_x
+        self.ball_y[indices] = self.ball_start_y
+        self.ball_fx[indices] = self.ball_start_x
+        self.ball_fy[indices] = self.ball_start_y
+        self.xspeed[indices] = self.initial_speed * xdir
+        self.yspeed[indices] = self.initial_speed * ydir
+        self.speed_coeff[indices] = 1.0
+
+    def _score(self, active):
+        enemy_point = active & (self.ball_x < self.player_x)
+        player_point = active & ~enemy_point & (self.ball_x > self.enemy_x)
+        point = enemy_point | player_point
+
+        self.enemy_score += enemy_point
+        self.player_score += player_point
+        np.maximum(self.longest_rally, np.where(point, self.current_rally, 0), out=self.longest_rally)
+        self.current_rally[point] = 0
+        self._reset_balls(point)
+
+        self.finished |= ((self.enemy_score >= self.maximum_score) |
+                          (self.player_score >= self.maximum_score))
+
+    def _collide(self, active, paddle_x, paddle_y):
+        # pygame.Rect.colliderect: strict overlap on both axes
+        size = self.ball_size
+        hit = (active &
+               (self.ball_x < paddle_x + self.paddle_width) & (paddle_x < self.ball_x + size) &
+               (self.ball_y < paddle_y + self.paddle_height) & (paddle_y < self.ball_y + size))
+        if not hit.any():
+            return
+
+        # Ball.process_collision, applied to the hit lanes only
+        self.ball_fx[hit] = np.where(self.xspeed[hit] < 0,
+                                     float(paddle_x + self.paddle_width),
+                                     float(paddle_x - size))
+        offset = (paddle_y[hit] + self.paddle_height // 2) - (self.ball_y[hit] + size // 2)
+        normalized_offset = offset / (0.5 * (self.paddle_height + size))
+        bounce_angle = config.MAX_BOUNCING_ANGLE * normalized_offset
+        self.xspeed[hit] = -self.xspeed[hit]
+        self.yspeed[hit] = self.initial_speed * -np.sin(bounce_angle)
+        self.speed_coeff[hit] += np.where(np.abs(bounce_angle) <= (config.MAX_BOUNCING_ANGLE / 6),
+                                          0.10, 0.05)
+        self.current_rally[hit] += 1
+        self.total_hits[hit] += 1
+
+    def _ai_actions(self, paddle_y, speed, incoming):
+        # ai.AIController policy; -1 = 'up', +1 = 'down', 0 = 'stop'
+        paddle_centery = paddle_y + self.paddle_height // 2
+        ball_centery = self.ball_y + self.ball_size // 2
+        board_centery = self.board_height // 2
+        chase = np.sign(ball_centery - paddle_centery)
+        home = np.where(paddle_centery > board_centery + speed, -1,
+                        np.where(paddle_centery < board_centery - speed, 1, 0))
+        return np.where(incoming, chase, home)
+
+    def _move_ball(self, active):
+        bounce = active & ((self.ball_fy >= (self.board_height - self.ball_size)) | (self.ball_fy <= 0))
+        self.yspeed[bounce] = -self.yspeed[bounce]
+        self.ball_fx[active] += self.speed_coeff[active] * self.xspeed[active]
+        self.ball_fy[active] += self.speed_coeff[active] * self.yspeed[active]
+        # np.rint rounds half to even, like the builtin round() used by Ball.update
+        self.ball_x[active] = np.rint(self.ball_fx[active]).astype(np.int64)
+        self.ball_y[active] = np.rint(self.ball_fy[active]).astype(np.int64)
+
+    def _move_paddle(self, active, paddle_y, actions, speed):
+        moved = np.clip(paddle_y + actions * speed, 0, self.board_height - self.paddle_height)
+        paddle_y[active] = moved[active]
+
+    def step(self):
+        active = self.active
+        self._score(active)
+        active = self.active
+        if not active.any():
+            return False
+
+        self._collide(active, self.player_x, self.player_y)
+        self._collide(active, self.enemy_x, self.enemy_y)
+
+        ball_centerx = self.ball_x + self.ball_size // 2
+        board_centerx = self.board_width // 2
+        player_actions = self._ai_actions(self.player_y, self.player_speed, ball_centerx <= board_centerx)
+        enemy_actions = self._ai_actions(self.enemy_y, self.enemy_speed, ball_centerx >= board_centerx)
+
+        self._move_ball(active)
+        self._move_paddle(active, self.player_y, player_actions, self.player_speed)
+        self._move_paddle(active, self.enemy_y, enemy_actions, self.enemy_speed)
+
+        self.ticks[active] += 1
+        return True
+
+    def run(self, max_ticks=None):
+        steps = 0
+        while self.step():
+            steps += 1
+            if max_ticks is not None and steps >= max_ticks:
+                break
+        return self.results()
+
+    def results(self):
+        return {'player_score': self.player_score.copy(),
+                'enemy_score': self.enemy_score.copy(),
+                'ticks': self.ticks.copy(),
+                'total_hits': self.total_hits.copy(),
+                'longest_rally': self.longest_rally.copy(),
+                'finished': self.finished.copy()}
+
+def compare_with_scalar(count=8, ticks=20000, tolerance=POSITION_TOLERANCE):
+    # Runs `count` scalar matches and the same number of batch lanes in lockstep. Whenever the
+    # scalar ball is served again its direction is copied into the lane, so both engines see the
+    # same randomness. Returns the worst position error found.
+    from simulation import HeadlessMatch
+
+    matches = [HeadlessMatch(swept=False) for _ in range(count)]
+    batch = BatchSimulation(count)
+    for index, match in enumerate(matches):
+        batch.load_match(index, match)
+
+    worst_error = 0.0
+    for _ in range(ticks):
+        points_before = [match.player_score + match.enemy_score for match in matches]
+        for match in matches:
+            match.step()
+        served = np.array([match.player_score + match.enemy_score != before
+                           for match, before in zip(matches, points_before)])
+
+        directions = {index: (np.sign(matches[index].ball.xspeed), np.sign(matches[index].ball.yspeed))
+                      for index in np.flatnonzero(served)}
+        def serve(rng, size, _directions=directions):
+            xdir = np.array([d[0] for d in _directions.values()], dtype=np.float64)
+            ydir = np.array([d[1] for d in _directions.values()], dtype=np.float64)
+            return xdir, ydir
+        batch._serve = serve
+        if not batch.step():
+            break
+
+        for index, match in enumerate(matches):
+            if match.is_finished:
+                continue
+            error = max(abs(batch.ball_fx[index] - match.ball.fx),
+                        abs(batch.ball_fy[index] - match.ball.fy),
+                        abs(batch.player_y[index] - match.player.rect.y),
+                        abs(batch.enemy_y[index] - match.enemy.rect.y))
+            worst_error = max(worst_error, error)
+
+    if worst_error > tolerance:
+        raise AssertionError("batch and scalar engines diverged: {} > {}".format(worst_error, tolerance))
+    return worst_error
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    simulation = BatchSimulation(count)
+    start = time.perf_counter()
+    steps = 0
+    while simulation.step():
+        steps += 1
+    elapsed = time.perf_counter() - start
+    results = simulation.results()
+    print("{} matches in {:.2f} s ({:.1f} matches/s, {:.0f} steps, {:.2f} ms/step)".format(
+          count, elapsed, count / elapsed, steps, 1000 * elapsed / max(steps, 1)))
+    print("player wins: {} - enemy wins: {}".format(int((results['player_score'] > results['enemy_score']).sum()),
+                                                    int((results['enemy_score'] > results['player_score']).sum())))
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+
+# Frame time benchmarks, run without a window or a sound card:
+#   - every state of states.py on its own: get_event(), update() and draw() timed separately
+#   - the whole GameStateManager frame (events, update, draw, display update) driven by a
+#     scripted player going through the menus, the countdown, a match and the pause menu
+# Times are reported as p50/p95/p99 in ms, allocations as bytes allocated per frame (measured
+# in a second pass, tracemalloc slows everything down).
+#
+# python benchmark.py [--frames N] [--baseline PATH] [--save-baseline] [--threshold 0.2]
+# Compared against the baseline (same machine!), a benchmark whose p95 frame time grew more
+# than the threshold (and MIN_REGRESSION_MS) is a regression and the script exits with status 1.
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import config
+
+# Nothing from the benchmark lands in the real storage/replays folders, and matches are the same.
+# The folder is removed when the script exits
+STORAGE_DIRECTORY = tempfile.TemporaryDirectory(prefix='pypong_benchmark_')
+config.STORAGE_BASE_PATH = STORAGE_DIRECTORY.name
+config.REPLAYS_PATH = config.STORAGE_BASE_PATH
+config.RECORD_REPLAYS = False
+config.MATCH_SEED = 0
+config.BACKGROUND_LOADING = False
+
+import pygame
+from loader import ResourceLoader, MuteableSound
+from states import (GameStateManager, StateRegistry, GameMainMenuState, GameOptionsMenuState,
+                    GamePauseMenuState, GameRunningState, GameLoseScreenState,
+                    GameWinScreenState, GameCountdownState, GameSaveMenuState,
+                    GameLoadMenuState)
+
+DEFAULT_BASELINE_PATH = os.path.join(config.BASE_PATH, 'benchmark_baseline.json')
+DEFAULT_THRESHOLD = 0.2
+# Smaller p95 changes are measurement noise (menus take a few microseconds per frame)
+MIN_REGRESSION_MS = 0.05
+DEFAULT_FRAMES = 600
+WARMUP_FRAMES = 30
+# Timing passes per benchmark, the one with the best p95 frame time is kept (less noise)
+REPEATS = 3
+PERCENTILES = (50, 95, 99)
+
+STATES = {'MAIN_MENU_STATE': GameMainMenuState,
+          'OPTIONS_MENU_STATE': GameOptionsMenuState,
+          'PAUSE_MENU_STATE': GamePauseMenuState,
+          'GAME_COUNTDOWN_STATE': GameCountdownState,
+          'GAME_RUNNING_STATE': GameRunningState,
+          'GAME_LOSE_SCREEN_STATE': GameLoseScreenState,
+          'GAME_WIN_SCREEN_STATE': GameWinScreenState,
+          'SAVE_MENU_STATE': GameSaveMenuState,
+          'LOAD_MENU_STATE': GameLoadMenuState}
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+# samples: seconds
+def summarize(samples):
+    values = sorted(1000 * sample for sample in samples)
+    summary = {'p{}'.format(percent): percentile(values, percent) for percent in PERCENTILES}
+    summary['mean'] = sum(values) / len(values) if values else 0.0
+    summary['max'] = values[-1] if values else 0.0
+    return summary
+
+def key_event(event_type, key):
+    return pygame.event.Event(event_type, key=key, mod=0, unicode='', scancode=0)
+
+def motion_event(pos):
+    return pygame.event.Event(pygame.MOUSEMOTION, pos=pos, rel=(0, 0), buttons=(0, 0, 0))
+
+# The button must be seen pressed by an update(), so the release comes a frame later
+def button_event(event_type, pos):
+    return pygame.event.Event(event_type, pos=pos, button=1)
+
+# Input of a single state benchmark: menus get the mouse swept over them (hover changes, no
+# clicks, they would leave the state), the match gets the paddle keys pressed and released
+def state_events(state, frame):
+    if isinstance(state, GameRunningState):
+        if frame % 40 == 0:
+            return [key_event(pygame.KEYDOWN, pygame.K_UP if frame % 80 else pygame.K_DOWN)]
+        if frame % 40 == 20:
+            return [key_event(pygame.KEYUP, pygame.K_UP if frame % 80 > 40 else pygame.K_DOWN)]
+        return []
+    if state.IS_STATIC:
+        width, height = state.screen.get_size()
+        x = (frame * 7) % width
+        return [motion_event((x, (frame * 3) % height))]
+    return []
+
+def time_state(name, factory, screen, resource_loader, frames, with_allocations=False):
+    state = factory(screen, resource_loader)
+    state.startup()
+    state.invalidate()
+    phases = {'get_event': [], 'update': [], 'draw': [], 'frame': []}
+    allocations = []
+    clock = time.perf_counter
+    for frame in range(WARMUP_FRAMES + frames):
+        events = state_events(state, frame)
+        if with_allocations:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        start = clock()
+        for event in events:
+            state.get_event(event)
+        event_end = clock()
+        state.update(config.TIMESTEP)
+        update_end = clock()
+        state.draw(1.0)
+        draw_end = clock()
+
+        # Leaving the state is not part of the benchmark
+        state.clean()
+        if frame < WARMUP_FRAMES:
+            continue
+        if with_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            phases['get_event'].append(event_end - start)
+            phases['update'].append(update_end - event_end)
+            phases['draw'].append(draw_end - update_end)
+            phases['frame'].append(draw_end - start)
+    return phases, allocations
+
+# Scripted session for the manager benchmark, decided from the state on screen: click PLAY,
+# wait for the countdown, play for a while, pause, hover the pause menu and resume
+class ScriptedPlayer():
+
+    PLAY_FRAMES = 600
+    MENU_FRAMES = 60
+    # Main menu, countdown, match, pause menu and countdown again
+    SESSION_FRAMES = 2 * MENU_FRAMES + 2 * GameCountdownState.TIME_IN_SECONDS * config.PHYSICS_FPS + PLAY_FRAMES
+
+    def __init__(self):
+        self._state_name = None
+        self._frames_in_state = 0
+
+    def _click(self, button, frame, click_frame):
+        if frame == click_frame:
+            return [button_event(pygame.MOUSEBUTTONDOWN, button.rect.center)]
+        if frame == click_frame + 1:
+            return [button_event(pygame.MOUSEBUTTONUP, button.rect.center)]
+        return None
+
+    def events(self, manager):
+        if manager.current_state_name != self._state_name:
+            self._state_name = manager.current_state_name
+            self._frames_in_state = 0
+        frame = self._frames_in_state
+        self._frames_in_state += 1
+        state = manager.current_state
+
+        if self._state_name in ('MAIN_MENU_STATE', 'PAUSE_MENU_STATE'):
+            button = state.buttons[0] # PLAY / RESUME
+            click = self._click(button, frame, self.MENU_FRAMES)
+            if click is not None:
+                return click
+            x, y = button.rect.center
+            return [motion_event((x + (frame % 20) * 10 - 100, y))]
+        if self._state_name == 'GAME_RUNNING_STATE':
+            if frame == self.PLAY_FRAMES:
+                return [key_event(pygame.KEYDOWN, pygame.K_p)]
+            return state_events(state, frame)
+        if self._state_name in ('GAME_LOSE_SCREEN_STATE', 'GAME_WIN_SCREEN_STATE'):
+            return self._click(state.buttons[0], frame, 0) or []
+        return []
+
+def time_manager(screen, resource_loader, frames, with_allocations=False):
+    manager = GameStateManager(StateRegistry(screen, resource_loader, STATES), 'MAIN_MENU_STATE', screen)
+    player = ScriptedPlayer()
+    samples = []
+    allocations = []
+    clock = time.perf_counter
+    for frame in range(WARMUP_FRAMES + frames):
+        for event in player.events(manager):
+            pygame.event.post(event)
+        if with_allocations:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        start = clock()
+        manager.process_events()
+        manager.update(config.TIMESTEP)
+        manager._update_overlay()
+        manager._display_update(manager.draw(1.0))
+        end = clock()
+
+        if frame < WARMUP_FRAMES:
+            continue
+        if with_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            samples.append(end - start)
+    return {'frame': samples}, allocations
+
+def run(frames=DEFAULT_FRAMES):
+    pygame.mixer.pre_init(config.MIXER_FREQUENCY, config.MIXER_SIZE, config.MIXER_CHANNELS, config.MIXER_BUFFER)
+    pygame.init()
+    screen = pygame.display.set_mode((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+    resource_loader = ResourceLoader(config.RESOURCES_BASE_PATH)
+    # Thousands of hover sounds per second can crash the SDL dummy audio thread. The sounds are
+    # still looked up, only the mixer is left out (it mixes on its own thread anyway)
+    MuteableSound.mute_all()
+
+    benchmarks = [(name, lambda with_allocations, name=name: time_state(name, STATES[name], screen, resource_loader,
+                                                                        frames, with_allocations))
+                  for name in STATES]
+    manager_frames = max(frames, ScriptedPlayer.SESSION_FRAMES)
+    benchmarks.append(('MANAGER_LOOP', lambda with_allocations: time_manager(screen, resource_loader,
+                                                                             manager_frames, with_allocations)))
+
+    results = {}
+    for name, benchmark in benchmarks:
+        passes = []
+        for _ in range(REPEATS):
+            phases = benchmark(False)[0]
+            passes.append({phase: summarize(samples) for phase, samples in phases.items()})
+        tracemalloc.start()
+        allocations = benchmark(True)[1]
+        tracemalloc.stop()
+        results[name] = min(passes, key=lambda summaries: summaries['frame']['p95'])
+        results[name]['alloc_bytes'] = {'mean': sum(allocations) / len(allocations) if allocations else 0.0,
+                                        'max': max(allocations) if allocations else 0}
+
+    resource_loader.shutdown()
+    pygame.quit()
+    return results
+
+def print_results(results):
+    print("{:<24} {:<10} {:>8} {:>8} {:>8} {:>8}  {:>12}".format('benchmark', 'phase', 'p50 ms', 'p95 ms',
+                                                                  'p99 ms', 'max ms', 'alloc B/frame'))
+    for name, result in results.items():
+        alloc = "{:.0f}".format(result['alloc_bytes']['mean'])
+        for phase, summary in result.items():
+            if phase == 'alloc_bytes':
+                continue
+            print("{:<24} {:<10} {:8.3f} {:8.3f} {:8.3f} {:8.3f}  {:>12}".format(
+                name, phase, summary['p50'], summary['p95'], summary['p99'], summary['max'],
+                alloc if phase == 'frame' else ''))
+
+# Returns the list of (benchmark, baseline p95, current p95) that got slower than the threshold
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old_p95 = baseline[name]['frame']['p95']
+        new_p95 = result['frame']['p95']
+        if new_p95 > old_p95 * (1 + threshold) and new_p95 - old_p95 > MIN_REGRESSION_MS:
+            regressions.append((name, old_p95, new_p95))
+    return regressions
+
+def _argument(name, default):
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+if __name__ == '__main__':
+    frames = int(_argument('--frames', DEFAULT_FRAMES))
+    baseline_path = _argument('--baseline', DEFAULT_BASELINE_PATH)
+    threshold = float(_argument('--threshold', DEFAULT_THRESHOLD))
+
+    results = run(frames)
+    print_results(results)
+
+    if '--save-baseline' in sys.argv:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print("Baseline saved to {}".format(baseline_path))
+    elif os.path.isfile(baseline_path):
+        with open(baseline_path, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, threshold)
+        for name, old_p95, new_p95 in regressions:
+            print("REGRESSION {}: p95 {:.3f} ms -> {:.3f} ms (+{:.0%})".format(name, old_p95, new_p95,
+                                                                              new_p95 / old_p95 - 1))
+        if regressions:
+            sys.exit(1)
+        print("No regression over {:.0%} against {}".format(threshold, baseline_path))
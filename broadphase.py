@@ -0,0 +1,98 @@
+import config
+import pygame
+
+# Uniform grid broadphase: the board is cut in square cells of config.BROADPHASE_CELL_SIZE
+# pixels and every registered entity is listed in the cells its rect overlaps. A query only
+# looks at the cells under the queried rect, so a ball checks the few colliders around it
+# instead of all of them: collision checks cost O(balls + colliders) per tick instead of
+# O(balls * colliders). Rects outside the board are clamped to the border cells.
+#
+# Query results come in registration order, the order a plain list of colliders would be
+# checked in, so swept collisions give exactly the same results with or without the grid.
+
+class UniformGrid():
+
+    def __init__(self, bounds, cell_size=config.BROADPHASE_CELL_SIZE):
+        self.bounds = pygame.Rect(bounds)
+        self.cell_size = cell_size
+        self.columns = max(1, -(-self.bounds.width // cell_size))
+        self.rows = max(1, -(-self.bounds.height // cell_size))
+        self.cells = [[] for _ in range(self.columns * self.rows)]
+        # entity -> (registration order, cell range it is listed in)
+        self._entries = {}
+        self._next_order = 0
+        # Totals since the last reset_stats(), see stress mode in arena.py
+        self.queries = 0
+        self.candidates = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entity):
+        return entity in self._entries
+
+    # (first column, first row, last column, last row) of the cells under rect
+    def _cell_range(self, rect):
+        size = self.cell_size
+        first_column = min(max((rect.left - self.bounds.left) // size, 0), self.columns - 1)
+        last_column = min(max((rect.right - 1 - self.bounds.left) // size, 0), self.columns - 1)
+        first_row = min(max((rect.top - self.bounds.top) // size, 0), self.rows - 1)
+        last_row = min(max((rect.bottom - 1 - self.bounds.top) // size, 0), self.rows - 1)
+        return first_column, first_row, last_column, last_row
+
+    def _cells(self, cell_range):
+        first_column, first_row, last_column, last_row = cell_range
+        for row in range(first_row, last_row + 1):
+            start = row * self.columns
+            for column in range(first_column, last_column + 1):
+                yield self.cells[start + column]
+
+    def insert(self, entity):
+        if entity in self._entries:
+            raise ValueError("{!r} is already in the grid".format(entity))
+        cell_range = self._cell_range(entity.rect)
+        self._entries[entity] = (self._next_order, cell_range)
+        self._next_order += 1
+        for cell in self._cells(cell_range):
+            cell.append(entity)
+
+    def remove(self, entity):
+        _, cell_range = self._entries.pop(entity)
+        for cell in self._cells(cell_range):
+            cell.remove(entity)
+
+    # To be called after a registered entity moved. Only touches the cells when the entity
+    # moved to other ones (a paddle crosses a cell border every few ticks)
+    def update(self, entity):
+        order, cell_range = self._entries[entity]
+        new_range = self._cell_range(entity.rect)
+        if new_range == cell_range:
+            return
+        for cell in self._cells(cell_range):
+            cell.remove(entity)
+        for cell in self._cells(new_range):
+            cell.append(entity)
+        self._entries[entity] = (order, new_range)
+
+    # Registered entities listed in the cells under rect (they may not overlap rect itself,
+    # the narrow phase decides), each once and in registration order
+    def query(self, rect):
+        cell_range = self._cell_range(rect)
+        if cell_range[0] == cell_range[2] and cell_range[1] == cell_range[3]:
+            found = list(self.cells[cell_range[1] * self.columns + cell_range[0]])
+        else:
+            found = []
+            for cell in self._cells(cell_range):
+                for entity in cell:
+                    if entity not in found:
+                        found.append(entity)
+        if len(found) > 1:
+            entries = self._entries
+            found.sort(key=lambda entity: entries[entity][0])
+        self.queries += 1
+        self.candidates += len(found)
+        return found
+
+    def reset_stats(self):
+        self.queries = 0
+        self.candidates = 0
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import config
+import pygame
+
+# Packed asset bundle: every asset of resources/ in a single file, already decoded.
+#   - sounds: raw PCM in the mixer format (config.MIXER_*), as returned by Sound.get_raw()
+#   - images: raw pixels (RGB, or RGBA when the image has transparency)
+#
+# Layout: HEADER | blobs (16-byte aligned) | JSON index
+# The index maps every resource type and name to the offset/length of its blob plus what is
+# needed to rebuild it (image size and pixel format, sound mixer format). It also lists the
+# source files (size and modification time) the bundle was built from: a bundle that doesn't
+# match resources/ any more is stale and ResourceLoader ignores it (see Bundle.is_current()).
+#
+# Build it with `python bundle.py [output_path]` and ResourceLoader will map it instead of
+# decoding the loose files (see ResourceLoader(bundle_path=...)).
+
+MAGIC = b'PPBN'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ') # magic, version, reserved, index offset, index length
+ALIGNMENT = 16
+
+class BundleError(Exception):
+    pass
+
+def _mixer_format():
+    return [config.MIXER_FREQUENCY, config.MIXER_SIZE, config.MIXER_CHANNELS]
+
+def _pad(bundle_file):
+    padding = (-bundle_file.tell()) % ALIGNMENT
+    bundle_file.write(b'\0' * padding)
+
+# {resource type: {file name: [size, modification time in ns]}} of the asset files
+def source_manifest(resource_root_path):
+    from loader import ResourceLoader
+
+    manifest = {}
+    for resource_type in ResourceLoader.RESOURCES:
+        resource_path = os.path.join(resource_root_path, resource_type)
+        manifest[resource_type] = {}
+        for file in sorted(os.listdir(resource_path)):
+            if file.endswith(ResourceLoader.ACCEPTED_IMAGE_EXTENSIONS + ResourceLoader.ACCEPTED_SOUND_EXTENSIONS):
+                stat = os.stat(os.path.join(resource_path, file))
+                manifest[resource_type][file] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+def build_bundle(resource_root_path, output_path):
+    from loader import ResourceLoader
+
+    if pygame.mixer.get_init() is None:
+        pygame.mixer.init(config.MIXER_FREQUENCY, config.MIXER_SIZE, config.MIXER_CHANNELS, config.MIXER_BUFFER)
+    if list(pygame.mixer.get_init()) != _mixer_format():
+        raise BundleError("The mixer is not using the configured format: {}".format(pygame.mixer.get_init()))
+
+    index = {'images': {}, 'sounds': {}, 'sources': source_manifest(resource_root_path)}
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as bundle_file:
+        bundle_file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+        for resource_type in ResourceLoader.RESOURCES:
+            resource_path = os.path.join(resource_root_path, resource_type)
+            for file in sorted(os.listdir(resource_path)):
+                filepath = os.path.join(resource_path, file)
+                resource_name = file.split('.')[0]
+                if resource_type == 'images' and file.endswith(ResourceLoader.ACCEPTED_IMAGE_EXTENSIONS):
+                    image = pygame.image.load(filepath)
+                    pixel_format = 'RGBA' if image.get_flags() & pygame.SRCALPHA else 'RGB'
+                    data = pygame.image.tostring(image, pixel_format)
+                    entry = {'size': list(image.get_size()), 'format': pixel_format}
+                elif resource_type == 'sounds' and file.endswith(ResourceLoader.ACCEPTED_SOUND_EXTENSIONS):
+                    data = pygame.mixer.Sound(filepath).get_raw()
+                    entry = {'mixer': _mixer_format()}
+                else:
+                    continue
+
+                _pad(bundle_file)
+                entry['offset'] = bundle_file.tell()
+                entry['length'] = len(data)
+                bundle_file.write(data)
+                index[resource_type][resource_name] = entry
+
+        _pad(bundle_file)
+        index_offset = bundle_file.tell()
+        index_data = json.dumps(index).encode('utf-8')
+        bundle_file.write(index_data)
+        bundle_file.seek(0)
+        bundle_file.write(HEADER.pack(MAGIC, VERSION, 0, index_offset, len(index_data)))
+
+    os.replace(tmp_path, output_path)
+    return index
+
+class Bundle():
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise BundleError("Empty bundle: {}".format(path))
+        self._view = memoryview(self._map)
+
+        magic, version, _, index_offset, index_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise BundleError("Not a version {} bundle: {}".format(VERSION, path))
+        self.index = json.loads(bytes(self._view[index_offset:index_offset + index_length]).decode('utf-8'))
+
+    def __contains__(self, key):
+        resource_type, resource_name = key
+        return resource_name in self.index.get(resource_type, {})
+
+    # Whether the bundle was built from the asset files currently in resource_root_path
+    # (bundles built before the sources were recorded are never current)
+    def is_current(self, resource_root_path):
+        return self.index.get('sources') == source_manifest(resource_root_path)
+
+    def names(self, resource_type):
+        return list(self.index.get(resource_type, {}))
+
+    def _blob(self, entry):
+        return self._view[entry['offset']:entry['offset'] + entry['length']]
+
+    # The surface reads the mapped pixels directly, no copy (until it is converted)
+    def load_image(self, image_name):
+        entry = self.index['images'][image_name]
+        return pygame.image.frombuffer(self._blob(entry), tuple(entry['size']), entry['format'])
+
+    def load_sound(self, sound_name):
+        entry = self.index['sounds'][sound_name]
+        if list(pygame.mixer.get_init() or ()) != entry['mixer']:
+            raise BundleError("Sound '{}' was bundled for a different mixer format".format(sound_name))
+        return pygame.mixer.Sound(buffer=self._blob(entry))
+
+    def load(self, resource_type, resource_name):
+        if resource_type == 'images':
+            return self.load_image(resource_name)
+        return self.load_sound(resource_name)
+
+    # Surfaces still built on top of the mapping keep it alive, it is then closed when collected
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+if __name__ == '__main__':
+    output_path = sys.argv[1] if len(sys.argv) > 1 else config.BUNDLE_PATH
+    index = build_bundle(config.RESOURCES_BASE_PATH, output_path)
+    print("{}: {} images, {} sounds, {} bytes".format(output_path, len(index['images']),
+                                                      len(index['sounds']), os.path.getsize(output_path)))
@@ -8,17 +8,99 @@ RESOURCES_BASE_PATH = os.path.join(BASE_PATH, 'resources')
 SOUNDS_PATH = os.path.join(RESOURCES_BASE_PATH, 'sounds')
 IMAGES_PATH = os.path.join(RESOURCES_BASE_PATH, 'images')
 STORAGE_BASE_PATH = os.path.join(BASE_PATH, 'storage')
-
-# Global variable to keep a paused game image as a string in RAM.
-# Could this be done in a cleaner way? Creating/deleting the image in the fs every
-# time is not the way to go as it is costly. The string buffer is a nice alternative.
-PAUSED_GAME_IMG_STRING = None
+REPLAYS_PATH = os.path.join(BASE_PATH, 'replays')
+PROFILES_PATH = os.path.join(BASE_PATH, 'profiles')
+TRACES_PATH = os.path.join(BASE_PATH, 'traces')
+BUNDLE_PATH = os.path.join(BASE_PATH, 'resources.bundle') # Built by bundle.py
 
 # Game configuration variables
 SCREEN_WIDTH = 700
 SCREEN_HEIGHT = 450
-FPS = 60
+FPS = 60 # Render rate cap
+PHYSICS_FPS = 120 # Fixed simulation rate, independent from the render rate
+TIMESTEP = 1 / PHYSICS_FPS # seconds
+MAX_FRAME_TIME = 0.25 # seconds, avoids the spiral of death after a long stall
+# Entity speeds are expressed in pixels per frame at this rate, whatever the physics rate is
+SPEED_REFERENCE_FPS = 60
+# Idle mode (static states): max time to wait for an event before waking up, in ms
+IDLE_TIMEOUT = 500
+IDLE_UNFOCUSED_TIMEOUT = 2000
+IDLE_HIDDEN_TIMEOUT = 5000
+PROFILER_HISTORY = 240 # Frames kept by the profiling overlay (F key), dumped to PROFILES_PATH with D
+# Instrumentation (see instrument.py): record from the start, T key toggles the recording and
+# exports it to TRACES_PATH. Events past TRACE_MAX_EVENTS drop the oldest ones
+TRACE_ENABLED = False
+TRACE_MAX_EVENTS = 200000
+# Build the likely next states while idling on a menu (see states.StateRegistry)
+PREWARM_STATES = True
+# Print the time to first frame and the state construction times at startup
+STARTUP_REPORT = False
+# Mixer settings, the asset bundle stores the sounds already in this format
+MIXER_FREQUENCY = 44100
+MIXER_SIZE = -16
+MIXER_CHANNELS = 1
+MIXER_BUFFER = 512 # samples, output latency = MIXER_BUFFER / MIXER_FREQUENCY
+# Voice manager (see voices.py): mixer channels, priority class of the sounds ('game' if not
+# listed), channels reserved to a class and minimum time between two plays of a sound (s)
+MIXER_VOICES = 8
+SOUND_CLASSES = {'btn_hover': 'ui', 'btn_click': 'ui', 'score_point': 'score',
+                 'countdown_beep': 'score', 'match_beep': 'score'}
+RESERVED_CHANNELS = {'ui': 1, 'score': 1}
+SOUND_COOLDOWNS = {'ball_bounce': 0.05, 'ball_bounce_2': 0.05, 'ball_hit': 0.03, 'btn_hover': 0.03}
+# Asset loading: decode on LOADER_WORKERS threads and keep at most RESOURCE_BUDGETS bytes
+# of decoded assets per type (None = no limit), see loader.ResourceLoader
+BACKGROUND_LOADING = True
+LOADER_WORKERS = 2
+RESOURCE_BUDGETS = {'images': None, 'sounds': None}
+TEXT_CACHE_SIZE = 256 # Rendered text surfaces kept by fonts.TEXT_CACHE
+SAVE_QUEUE_SIZE = 4 # Saves waiting for the background writer, see storage.SaveWriter
+# Seed of every match (None = a new random seed per match) and whether the matches played are
+# recorded to REPLAYS_PATH, see replay.py
+MATCH_SEED = None
+RECORD_REPLAYS = False
+# Network play (see netplay.py): local inputs are applied NETPLAY_INPUT_DELAY ticks later, at
+# most NETPLAY_MAX_ROLLBACK ticks are predicted ahead of the remote inputs
+NETPLAY_PORT = 7777
+NETPLAY_INPUT_DELAY = 2 # ticks, one frame at 60 FPS
+NETPLAY_MAX_ROLLBACK = 16 # ticks
+NETPLAY_TIMEOUT = 5 # seconds without packets before the peer is considered gone
+# Match server (see server.py): tick rate of every hosted match, bytes waiting in a client
+# socket past which its state deltas are merged (high water) or it is disconnected (max)
+SERVER_PORT = 7878
+SERVER_TICK_RATE = 60
+SERVER_HIGH_WATER = 16 * 1024
+SERVER_MAX_BUFFER = 256 * 1024
+SERVER_COALESCE_TICKS = 6 # A client over SERVER_HIGH_WATER gets one merged delta every that many ticks
+SERVER_METRICS_TICKS = 600 # Ticks the scheduling metrics are computed over
+# AI tournaments (see tournament.py): matches per work unit sent to a worker process, and
+# seconds between two checkpoint writes
+TOURNAMENT_CHUNK = 50
+TOURNAMENT_CHECKPOINT_INTERVAL = 10
 BRICK_SIZE = 25
 PLAYER_SPEED = 3
 ENEMY_SPEED = 3
+BALL_SPEED = 2
+ENEMY_AI = 'simple' # 'simple' or 'predictive', see ai.CONTROLLERS
+AI_REACTION_DELAY = 0 # ticks, predictive AI only
+AI_ERROR = 0.0 # pixels (std dev), predictive AI only
+# Swept (continuous) ball collisions, see Ball._sweep(): the supported mode, the ball can't
+# tunnel through the paddles. Disabled = the old per-tick overlap checks (what batch.py mirrors).
+# python simulation.py check compares both (mirrored matches, AI vs AI win rates)
+SWEPT_COLLISIONS = True
 MAX_BOUNCING_ANGLE = (5 * pi / 12) # = 75 degrees
+# Cell size (pixels) of the broadphase grid balls find their colliders in (multi-ball arena,
+# see broadphase.py and arena.py): about twice the ball size, colliders span a few cells at most
+BROADPHASE_CELL_SIZE = 50
+# Multi-ball arena defaults (see arena.py)
+ARENA_BALLS = 50
+ARENA_OBSTACLES = 40
+# Particle effects of the paddle hits, wall bounces and goals (see particles.py, needs numpy).
+# At most PARTICLE_CAP particles are alive at once, the ones emitted beyond are dropped
+PARTICLES = True
+PARTICLE_CAP = 1024
+PARTICLE_SIZE = 2 # pixels
+PARTICLE_GRAVITY = 250 # pixels/s^2
+# name: (particles per emission, max speed in pixels/s, lifetime in seconds, color)
+PARTICLE_EFFECTS = {'hit': (24, 180, 0.45, (255, 255, 255)),
+                    'bounce': (10, 120, 0.3, (160, 160, 160)),
+                    'goal': (120, 320, 0.9, (255, 200, 80))}
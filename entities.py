@@ -3,28 +3,51 @@ import random
 import pygame
 from math import sin
 from pygame.locals import *
+from instrument import TRACER
 
 # TODO:
 # - redesign the controller interface..., add a function to get the action: MB the class has to implement Controllable abstract class
 
 class Ball(pygame.sprite.Sprite):
 
-    def __init__(self, size, x, y, speed, board, bounce_sound=None, hit_sound=None):
+    # Upper bound of wall/paddle bounces resolved within a single swept update
+    MAX_SWEEP_BOUNCES = 8
+
+    # colliders: when given, update() moves the ball with swept collision detection against
+    # them and the board walls instead of relying on the discrete process_collision() checks
+    # rng: random.Random the serve directions are drawn from (seeded per match for replays),
+    # the random module itself by default
+    # broadphase: broadphase.UniformGrid the colliders are looked up in (swept collisions too),
+    # instead of checking every collider of a long colliders list
+    # effects: particles.ParticleSystem the hits and bounces emit particles into, if any
+    def __init__(self, size, x, y, speed, board, bounce_sound=None, hit_sound=None, colliders=None, rng=None,
+                 broadphase=None, effects=None):
         super().__init__()
         self.size = size
         self.image = pygame.Surface([size, size])
         self.image.fill(pygame.Color('white'))
         self.rect = self.image.get_rect(center=(x, y))
         self.initial_speed = speed
-        self.xspeed = random.choice([speed, -speed])
-        self.yspeed = random.choice([speed, -speed])
+        self.rng = rng if rng is not None else random
+        self.xspeed = self.rng.choice([speed, -speed])
+        self.yspeed = self.rng.choice([speed, -speed])
         self.speed_coeff = 1.0
         self.board = board
         self.board_rect = self.board.get_rect()
         self.fx = float(self.rect.x)
         self.fy = float(self.rect.y)
+        self.prev_fx = self.fx
+        self.prev_fy = self.fy
+        # Horizontal run of the sweep: (x it started from, direction, distance covered, fx it
+        # gives), see _sweep()
+        self.run = None
+        self.drawn_rect = None
         self.bounce_sound = bounce_sound
         self.hit_sound = hit_sound
+        self.colliders = colliders
+        self.broadphase = broadphase
+        self.effects = effects
+        self.hit_count = 0
 
     @property
     def x(self):
@@ -42,17 +65,25 @@ class Ball(pygame.sprite.Sprite):
     def y(self, y):
         self.rect.y = y
 
+    def _emit(self, effect, x, y):
+        if self.effects is not None:
+            self.effects.emit(effect, x, y)
+
     def _check_board_boundaries(self):
         if self.fy >= (self.board_rect.height - self.size) or self.fy <= 0:
             self.yspeed = -self.yspeed
+            TRACER.count('wall_bounces')
             self.bounce_sound.play()
+            self._emit('bounce', self.fx + self.size / 2, self.fy if self.fy <= 0 else self.fy + self.size)
 
     def reset(self):
         self.rect.center = self.board_rect.center
         self.fx = self.rect.x
         self.fy = self.rect.y
-        self.xspeed = random.choice([self.initial_speed, -self.initial_speed])
-        self.yspeed = random.choice([self.initial_speed, -self.initial_speed])
+        self.prev_fx = self.fx
+        self.prev_fy = self.fy
+        self.xspeed = self.rng.choice([self.initial_speed, -self.initial_speed])
+        self.yspeed = self.rng.choice([self.initial_speed, -self.initial_speed])
         self.speed_coeff = 1.0
 
     def process_collision(self, entity):
@@ -63,34 +94,200 @@ class Ball(pygame.sprite.Sprite):
             else:
                 self.fx = entity.rect.left - self.size
 
-            offset = (entity.rect.centery - self.rect.centery)
-            normalized_offset = offset / (0.5 * (entity.height + self.size))
-            bounce_angle = config.MAX_BOUNCING_ANGLE * normalized_offset
+            self._bounce_off(entity, self.rect.centery)
+
+    def _bounce_off(self, entity, centery):
+        self._emit('hit', entity.rect.right if self.xspeed < 0 else entity.rect.left, centery)
+        offset = (entity.rect.centery - centery)
+        normalized_offset = offset / (0.5 * (entity.height + self.size))
+        bounce_angle = config.MAX_BOUNCING_ANGLE * normalized_offset
+
+        self.xspeed = -self.xspeed
+        self.yspeed = self.initial_speed * -sin(bounce_angle)
+
+        if abs(bounce_angle) <= (config.MAX_BOUNCING_ANGLE / 6):
+            self.speed_coeff += 0.10
+        else:
+            self.speed_coeff += 0.05
+
+        self.hit_count += 1
+        TRACER.count('paddle_hits')
+        self.hit_sound.play()
+
+    # Time of impact (as a fraction of the displacement: distance along the run, dy) against
+    # the board walls and the faces of the colliders that look towards the ball. Returns (toi,
+    # hit, axis) where hit is 'top', 'bottom' or the collider and axis the one of the face hit
+    # ('x': a vertical face), or (None, None, None) when nothing is reached within this step.
+    # Paddles are only hit on their vertical faces, obstacles on all four.
+    def _time_of_impact(self, distance, dy, colliders):
+        origin, direction, covered, _ = self.run
+        toi, hit, axis = None, None, None
+
+        if dy < 0:
+            toi, hit = max(-self.fy / dy, 0.0), 'top'
+        elif dy > 0:
+            toi, hit = max((self.board_rect.height - self.size - self.fy) / dy, 0.0), 'bottom'
+        if toi is not None and toi > 1:
+            toi, hit = None, None
+        if hit is not None:
+            axis = 'y'
 
-            self.xspeed = -self.xspeed
-            self.yspeed = self.initial_speed * -sin(bounce_angle)
+        for entity in colliders:
+            if entity.IS_OBSTACLE and dy != 0:
+                # Same as below on the horizontal faces
+                if dy > 0:
+                    face = entity.rect.top - self.size
+                    inside = self.fy > face
+                else:
+                    face = entity.rect.bottom
+                    inside = self.fy < face
+                if not inside:
+                    t = (face - self.fy) / dy
+                    if t <= 1 and (toi is None or t < toi):
+                        # Run distances where the ball spans the face
+                        start = direction * (entity.rect.left - self.size - origin)
+                        end = direction * (entity.rect.right - origin)
+                        if min(start, end) < covered + distance * t < max(start, end):
+                            toi, hit, axis = t, entity, 'y'
 
-            if abs(bounce_angle) <= (config.MAX_BOUNCING_ANGLE / 6):
-                self.speed_coeff += 0.10
+            # Minkowski sum: the collider grown by the ball size, against the ball's top-left corner
+            if distance == 0:
+                continue
+            face = entity.rect.left - self.size if direction > 0 else entity.rect.right
+            gap = direction * (face - origin) - covered
+            if gap < 0:
+                continue
+
+            t = gap / distance
+            if t > 1 or (toi is not None and t >= toi):
+                continue
+            y = self.fy + dy * t
+            top, bottom = entity.rect.top - self.size, entity.rect.bottom
+            # A ball meeting an obstacle exactly on a corner, diagonally, would go through it
+            if top < y < bottom or (entity.IS_OBSTACLE and ((y == top and dy > 0) or (y == bottom and dy < 0))):
+                toi, hit, axis = t, entity, 'x'
+
+        return toi, hit, axis
+
+    # A collider can move onto the ball (e.g. a paddle moving vertically), which the sweep
+    # cannot see coming. Resolved like process_collision() when the ball still travels towards it.
+    # Obstacles don't move, the sweep never lets the ball into them
+    def _resolve_overlaps(self, colliders):
+        ball_rect = pygame.Rect(round(self.fx), round(self.fy), self.size, self.size)
+        for entity in colliders:
+            if not entity.IS_OBSTACLE and ball_rect.colliderect(entity.rect):
+                if self.xspeed > 0 and ball_rect.centerx < entity.rect.centerx:
+                    self.fx = entity.rect.left - self.size
+                    self._bounce_off(entity, self.fy + self.size / 2)
+                elif self.xspeed < 0 and ball_rect.centerx > entity.rect.centerx:
+                    self.fx = entity.rect.right
+                    self._bounce_off(entity, self.fy + self.size / 2)
+
+    # Continuous movement: advances to the earliest impact, bounces and keeps going with the
+    # remaining time, so fast balls or big timesteps can't tunnel through paddles or walls.
+    # Horizontally the ball moves along a run: the distance covered since the x it last started
+    # from (a face it bounced off, the serve). Accumulated into fx, the steps would carry a
+    # rounding error that depends on the magnitude of fx (8 times bigger near the right paddle
+    # than near the left one), and the impacts, hence the bounce angles, would differ between
+    # the two sides of the board. A run covers the same distances in both directions, and the
+    # gaps to the faces (integers) are exact
+    def _sweep(self, step):
+        colliders = self.colliders if self.broadphase is None else self._query_colliders(step)
+        self._resolve_overlaps(colliders)
+        direction = 1 if self.xspeed > 0 else -1
+        # fx was set from outside (serve, loaded game, overlap resolved...): a new run starts there
+        if self.run is None or self.run[3] != self.fx or self.run[1] != direction:
+            self.run = (self.fx, direction, 0.0, self.fx)
+
+        remaining = 1.0
+        for _ in range(self.MAX_SWEEP_BOUNCES):
+            distance = abs(self.speed_coeff * self.xspeed * step * remaining)
+            dy = self.speed_coeff * self.yspeed * step * remaining
+            toi, hit, axis = self._time_of_impact(distance, dy, colliders)
+            origin, direction, covered, _ = self.run
+            if hit is None:
+                covered += distance
+                self.run = (origin, direction, covered, origin + direction * covered)
+                self.fy += dy
+                break
+
+            covered += distance * toi
+            self.run = (origin, direction, covered, origin + direction * covered)
+            remaining *= (1 - toi)
+            if hit == 'top':
+                self.fy = 0.0
+                self.yspeed = -self.yspeed
+                TRACER.count('wall_bounces')
+                self.bounce_sound.play()
+                self._emit('bounce', self.run[3] + self.size / 2, self.fy)
+            elif hit == 'bottom':
+                self.fy = float(self.board_rect.height - self.size)
+                self.yspeed = -self.yspeed
+                TRACER.count('wall_bounces')
+                self.bounce_sound.play()
+                self._emit('bounce', self.run[3] + self.size / 2, self.fy + self.size)
+            elif hit.IS_OBSTACLE:
+                self.fy += dy * toi
+                if axis == 'x':
+                    self._snap_to_face(hit)
+                    self.xspeed = -self.xspeed
+                else:
+                    self.fy = float(hit.rect.top - self.size if self.yspeed > 0 else hit.rect.bottom)
+                    self.yspeed = -self.yspeed
+                TRACER.count('obstacle_bounces')
+                self.bounce_sound.play()
             else:
-                self.speed_coeff += 0.05
+                self.fy += dy * toi
+                self._snap_to_face(hit)
+                self._bounce_off(hit, self.fy + self.size / 2)
+        self.fx = self.run[3]
 
-            print("angle: {} - speed_coeff: {} - limit: {}".format(abs(bounce_angle), self.speed_coeff, (config.MAX_BOUNCING_ANGLE / 6)))
+    # Starts a new run exactly against the vertical face of entity the ball reached (like
+    # process_collision()), going back the other way
+    def _snap_to_face(self, entity):
+        if self.xspeed < 0:
+            face = float(entity.rect.right)
+        else:
+            face = float(entity.rect.left - self.size)
+        self.run = (face, -self.run[1], 0.0, face)
 
-            self.hit_sound.play()
+    # Colliders within reach of this step: the ball area grown by the longest distance the ball
+    # can travel along an axis, counting the speed-ups of the paddle hits it may make meanwhile
+    def _query_colliders(self, step):
+        coeff = self.speed_coeff + 0.10 * self.MAX_SWEEP_BOUNCES
+        reach = int(coeff * max(abs(self.xspeed), abs(self.yspeed), self.initial_speed) * step) + 2
+        area = pygame.Rect(int(self.fx) - reach, int(self.fy) - reach,
+                           self.size + 2 * reach, self.size + 2 * reach)
+        return self.broadphase.query(area)
 
-    def update(self):
-        self._check_board_boundaries()
-        self.fx += (self.speed_coeff * self.xspeed)
-        self.fy += (self.speed_coeff * self.yspeed)
+    # dt in seconds; speeds are scaled so that a dt of 1/SPEED_REFERENCE_FPS moves the ball
+    # exactly speed_coeff * speed pixels
+    def update(self, dt):
+        self.prev_fx = self.fx
+        self.prev_fy = self.fy
+        step = dt * config.SPEED_REFERENCE_FPS
+        if self.colliders is None and self.broadphase is None:
+            self._check_board_boundaries()
+            self.fx += (self.speed_coeff * self.xspeed * step)
+            self.fy += (self.speed_coeff * self.yspeed * step)
+        else:
+            self._sweep(step)
         self.x = round(self.fx)
         self.y = round(self.fy)
 
-    def draw(self):
-        self.board.blit(self.image, self.rect)
+    # alpha interpolates between the last two physics states (0 = previous, 1 = current).
+    # Returns the area drawn, the previous one is kept in drawn_rect until the next draw
+    def draw(self, alpha=1.0):
+        x = self.prev_fx + (self.fx - self.prev_fx) * alpha
+        y = self.prev_fy + (self.fy - self.prev_fy) * alpha
+        self.drawn_rect = self.board.blit(self.image, (round(x), round(y)))
+        return self.drawn_rect
 
 class Paddle(pygame.sprite.Sprite):
 
+    # Balls bounce off paddles with an angle depending on where they hit (see Ball._bounce_off)
+    IS_OBSTACLE = False
+
     def __init__(self, width, height, x, y, speed, board, controller):
         super().__init__()
         self.width = width
@@ -98,6 +295,9 @@ class Paddle(pygame.sprite.Sprite):
         self.image = pygame.Surface([width, height])
         self.image.fill(pygame.Color('white'))
         self.rect = self.image.get_rect(center=(x, y))
+        self.fy = float(self.rect.y)
+        self.prev_fy = self.fy
+        self.drawn_rect = None
         self.speed = speed
         self.board = board
         self.board_rect = board.get_rect()
@@ -119,21 +319,56 @@ class Paddle(pygame.sprite.Sprite):
     @y.setter
     def y(self, y):
         self.rect.y = y
+        self.fy = float(y)
+        self.prev_fy = self.fy
 
     def reset(self):
         self.rect.centery = self.board_rect.centery
+        self.fy = float(self.rect.y)
+        self.prev_fy = self.fy
 
-    def update(self):
+    def update(self, dt):
+        self.prev_fy = self.fy
         self.action = self.controller.action
+        step = dt * config.SPEED_REFERENCE_FPS
 
         if self.action == 'stop':
             pass
         elif self.action == 'up':
-            self.y -= self.speed
+            self.fy -= self.speed * step
         elif self.action == 'down':
-            self.y += self.speed
+            self.fy += self.speed * step
+
+        self.fy = min(max(self.fy, self.board_rect.top), self.board_rect.bottom - self.height)
+        self.rect.y = round(self.fy)
+
+    def draw(self, alpha=1.0):
+        y = self.prev_fy + (self.fy - self.prev_fy) * alpha
+        self.drawn_rect = self.board.blit(self.image, (self.rect.x, round(y)))
+        return self.drawn_rect
+
+# Static block the balls simply bounce off, on any of its faces (swept collisions only, see
+# Ball._time_of_impact). Used by the multi-ball arena, see arena.py
+class Obstacle(pygame.sprite.Sprite):
+
+    IS_OBSTACLE = True
+
+    def __init__(self, width, height, x, y, board):
+        super().__init__()
+        self.width = width
+        self.height = height
+        self.image = pygame.Surface([width, height])
+        self.image.fill(pygame.Color('gray50'))
+        self.rect = self.image.get_rect(center=(x, y))
+        self.board = board
+        self.drawn_rect = None
+
+    def reset(self):
+        pass
 
-        self.rect.clamp_ip(self.board_rect)
+    def update(self, dt):
+        pass
 
-    def draw(self):
-        self.board.blit(self.image, self.rect)
+    def draw(self, alpha=1.0):
+        self.drawn_rect = self.board.blit(self.image, self.rect)
+        return self.drawn_rect
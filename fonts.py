@@ -0,0 +1,84 @@
+import config
+import pygame
+from collections import OrderedDict
+
+# Process-wide font and rendered text caches shared by every SimpleTextBox:
+#   - fonts are created once per (face, size, bold)
+#   - rendered strings are kept in a bounded LRU cache keyed by (text, color, font)
+#   - frequently changing numeric strings (scores, fps...) can be composed from cached glyphs,
+#     which are blitted one by one instead of rasterizing the whole string again
+
+DEFAULT_FACE = 'consolas'
+
+_FONTS = {}
+_ATLASES = {}
+
+def get_font(size, face=DEFAULT_FACE, bold=True):
+    key = (face, size, bold)
+    font = _FONTS.get(key)
+    if font is None:
+        font = pygame.font.SysFont(face, size, bold=bold)
+        _FONTS[key] = font
+    return font
+
+class TextCache():
+
+    def __init__(self, max_size=config.TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self._surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    # The returned surface is shared, callers must not draw on it
+    def render(self, text, color, size, face=DEFAULT_FACE, bold=True):
+        key = (text, tuple(color), face, size, bold)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = get_font(size, face, bold).render(text, True, color)
+        self._surfaces[key] = surface
+        if len(self._surfaces) > self.max_size:
+            self._surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self._surfaces.clear()
+
+TEXT_CACHE = TextCache()
+
+class GlyphAtlas():
+
+    CHARSET = '0123456789.,:-+% fpsmax'
+
+    def __init__(self, size, color, face=DEFAULT_FACE, bold=True):
+        font = get_font(size, face, bold)
+        self._glyphs = {char: font.render(char, True, color) for char in self.CHARSET}
+        self._widths = {char: glyph.get_width() for char, glyph in self._glyphs.items()}
+        self.height = max(glyph.get_height() for glyph in self._glyphs.values())
+
+    def can_render(self, text):
+        return all(char in self._glyphs for char in text)
+
+    # Returns [(glyph, x_offset), ...] and the total width of the text
+    def layout(self, text):
+        glyphs = []
+        width = 0
+        for char in text:
+            glyphs.append((self._glyphs[char], width))
+            width += self._widths[char]
+        return glyphs, width
+
+def get_glyph_atlas(size, color, face=DEFAULT_FACE, bold=True):
+    key = (face, size, bold, tuple(color))
+    atlas = _ATLASES.get(key)
+    if atlas is None:
+        atlas = GlyphAtlas(size, color, face, bold)
+        _ATLASES[key] = atlas
+    return atlas
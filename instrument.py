@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+import config
+
+# Instrumentation: scoped timers, counters and instant events kept in memory and exported as
+# Chrome trace events (JSON, opens in chrome://tracing or https://ui.perfetto.dev).
+#
+#   with TRACER.scope('game_logic'):   # timed span
+#       ...
+#   TRACER.count('paddle_hits')        # counter, the running total is traced
+#   TRACER.instant('save_submitted')   # point in time
+#
+# Disabled (the default, config.TRACE_ENABLED), every call is an attribute check: scope()
+# returns a shared no-op context manager and nothing is allocated. Callers that build an
+# args dict should check TRACER.enabled first so the dict isn't built for nothing.
+# Events are recorded from any thread (the trace has a row per thread); counters should be
+# updated from the main thread only.
+
+class _NullScope():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SCOPE = _NullScope()
+
+class _Scope():
+
+    __slots__ = ('_tracer', '_name', '_category', '_args', '_start')
+
+    def __init__(self, tracer, name, category, args):
+        self._tracer = tracer
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._tracer.complete(self._name, self._start, time.perf_counter(), self._category, self._args)
+        return False
+
+class Tracer():
+
+    def __init__(self, enabled=False, max_events=config.TRACE_MAX_EVENTS):
+        # Oldest events are dropped past max_events
+        self._events = deque(maxlen=max_events)
+        self._thread_names = {}
+        self.counters = {}
+        self.enabled = False
+        self._origin = time.perf_counter()
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self._events.clear()
+        self.counters = {}
+        self._origin = time.perf_counter()
+
+    def __len__(self):
+        return len(self._events)
+
+    def _thread_id(self):
+        thread_id = threading.get_ident()
+        if thread_id not in self._thread_names:
+            self._thread_names[thread_id] = threading.current_thread().name
+        return thread_id
+
+    def scope(self, name, category='game', args=None):
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _Scope(self, name, category, args)
+
+    # Span from timestamps already taken with time.perf_counter() (e.g. by the FrameProfiler)
+    def complete(self, name, start, end, category='game', args=None):
+        if self.enabled:
+            self._events.append(('X', name, category, start, end - start, self._thread_id(), args))
+
+    def instant(self, name, category='game', args=None):
+        if self.enabled:
+            self._events.append(('i', name, category, time.perf_counter(), 0.0, self._thread_id(), args))
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            value = self.counters.get(name, 0) + amount
+            self.counters[name] = value
+            self._events.append(('C', name, 'counters', time.perf_counter(), 0.0, self._thread_id(), value))
+
+    # Chrome trace event format (JSON object format), timestamps in microseconds
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        origin = self._origin
+        trace_events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': name}}
+                        for thread_id, name in list(self._thread_names.items())]
+        for phase, name, category, start, duration, thread_id, args in list(self._events):
+            event = {'name': name, 'cat': category, 'ph': phase, 'pid': pid, 'tid': thread_id,
+                     'ts': round(1e6 * (start - origin), 3)}
+            if phase == 'X':
+                event['dur'] = round(1e6 * duration, 3)
+                if args:
+                    event['args'] = args
+            elif phase == 'C':
+                event['args'] = {name: args}
+            else:
+                event['s'] = 't'
+                if args:
+                    event['args'] = args
+            trace_events.append(event)
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms',
+                'otherData': {'counters': dict(self.counters)}}
+
+    def export(self, path):
+        trace = self.to_chrome_trace()
+        with open(path, 'w') as trace_file:
+            json.dump(trace, trace_file)
+        return path
+
+TRACER = Tracer(enabled=config.TRACE_ENABLED)
+
+# python instrument.py TRACE_FILE: span totals and counters of an exported trace
+if __name__ == '__main__':
+    with open(sys.argv[1], 'r') as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    totals = {}
+    for event in events:
+        if event['ph'] == 'X':
+            count, duration = totals.get(event['name'], (0, 0.0))
+            totals[event['name']] = (count + 1, duration + event['dur'])
+    print("{:<28} {:>8} {:>12} {:>10}".format('span', 'count', 'total ms', 'mean us'))
+    for name, (count, duration) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print("{:<28} {:>8} {:12.2f} {:10.1f}".format(name, count, duration / 1000, duration / count))
+    counters = {}
+    for event in events:
+        if event['ph'] == 'C':
+            counters.update(event['args'])
+    for name, value in sorted(counters.items()):
+        print("{:<28} {:>8}".format(name, value))
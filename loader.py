@@ -1,10 +1,19 @@
 import os
+import config
 import pygame
+from bundle import Bundle, BundleError
+from instrument import TRACER
+from voices import VOICES
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
-# 1) Abstract the loading from the resource type, can hold a dict with the supported type, 
-# its accepted_extensions and the loading function (lambda) 
+# 1) Abstract the loading from the resource type, can hold a dict with the supported type,
+# its accepted_extensions and the loading function (lambda)
 # 2) Add try/catch when needed, define new type of exceptions (?)
 
+# What a corrupt or unreadable asset file raises when decoded
+DECODE_ERRORS = (pygame.error, OSError, ValueError, BundleError)
+
 class EmptySound():
     def play(self):
         pass
@@ -13,14 +22,21 @@ class MuteableSound():
 
     SOUNDS_MUTED = False
 
-    def __init__(self, filepath):
-        self.sound = pygame.mixer.Sound(filepath)
+    # source: a file path or an already built pygame.mixer.Sound
+    # name: the resource name, the voice manager applies the cooldown and priority class of
+    # that name (see voices.py)
+    def __init__(self, source, name=None):
+        if isinstance(source, pygame.mixer.Sound):
+            self.sound = source
+        else:
+            self.sound = pygame.mixer.Sound(source)
+        self.name = name
 
     def play(self):
         if self.SOUNDS_MUTED:
             pass
         else:
-            self.sound.play()
+            VOICES.play(self.sound, self.name)
 
     @classmethod
     def mute_all(cls):
@@ -30,43 +46,217 @@ class MuteableSound():
     def unmute_all(cls):
         cls.SOUNDS_MUTED = False
 
+# What get_sound() hands out: the sound is looked up in the loader on every play, so it can be
+# returned before the sound is decoded and keeps working after the sound is evicted (it is
+# just not heard until it is loaded again)
+class SoundHandle():
+
+    def __init__(self, loader, sound_name):
+        self._loader = loader
+        self.name = sound_name
+
+    def play(self):
+        sound = self._loader.lookup('sounds', self.name)
+        if sound is not None:
+            sound.play()
+
 class ResourceLoader():
 
     RESOURCES = ('images', 'sounds')
     ACCEPTED_SOUND_EXTENSIONS = ('.ogg', '.mp3', '.wav')
     ACCEPTED_IMAGE_EXTENSIONS = ('.png', '.jpeg')
+    # Source of the assets read from the bundle instead of a file
+    BUNDLED = object()
 
-    def __init__(self, resource_root_path):
+    # background: decode the assets on a thread pool, lookups return None (get_image() returns a
+    # placeholder) until they are ready. Converting surfaces and the cache bookkeeping always
+    # happen on the calling (main) thread.
+    # budgets: {resource_type: bytes or None}, the least recently used assets are evicted when a
+    # type goes over its budget and are loaded again the next time they are needed
+    # bundle_path: packed asset bundle (see bundle.py) used instead of the loose files when it
+    # exists and matches the mixer format. Assets are then built from the mapped file, no decoding
+    def __init__(self, resource_root_path, background=False, budgets=None, bundle_path=None):
         self._cache = {}
+        self._paths = {}
+        self._bundle = self._open_bundle(bundle_path, resource_root_path)
+        self._sizes = {}
         self._resource_root_path = resource_root_path
+        self._budgets = budgets if budgets is not None else config.RESOURCE_BUDGETS
+        self._executor = ThreadPoolExecutor(max_workers=config.LOADER_WORKERS) if background else None
+        self._placeholder_image = pygame.Surface((1, 1))
         self._load()
 
+    # The bundle, or None when there is none or it can't be used: the loose files are loaded
+    @staticmethod
+    def _open_bundle(bundle_path, resource_root_path):
+        if not bundle_path or not os.path.isfile(bundle_path):
+            return None
+        try:
+            bundle = Bundle(bundle_path)
+        except (BundleError, OSError):
+            return None
+        if not bundle.is_current(resource_root_path):
+            print("Warning: {} is out of date with {}, loading the asset files instead "
+                  "(run bundle.py to rebuild it)".format(bundle_path, resource_root_path))
+            bundle.close()
+            return None
+        mixer_settings = list(pygame.mixer.get_init() or ())
+        if any(entry['mixer'] != mixer_settings for entry in bundle.index.get('sounds', {}).values()):
+            bundle.close()
+            return None
+        return bundle
+
     def _load(self):
         if not self._cache:
             for resource_type in self.RESOURCES:
+                self._cache[resource_type] = OrderedDict()
+                self._paths[resource_type] = {}
+                self._sizes[resource_type] = {}
+                if self._bundle is not None:
+                    for resource_name in self._bundle.names(resource_type):
+                        self._paths[resource_type][resource_name] = self.BUNDLED
+                        self._request(resource_type, resource_name)
+                    continue
+
                 resource_path = os.path.join(self._resource_root_path, resource_type)
-                self._cache[resource_type] = {}
                 for file in os.listdir(resource_path):
                     filepath = os.path.join(resource_path, file)
                     resource_name = file.split('.')[0]
-                    if resource_type == 'images' and file.endswith(self.ACCEPTED_IMAGE_EXTENSIONS):
-                        self._cache[resource_type][resource_name] = pygame.image.load(filepath).convert()
-                    elif resource_type == 'sounds' and file.endswith(self.ACCEPTED_SOUND_EXTENSIONS):
-                        self._cache[resource_type][resource_name] = MuteableSound(filepath)
+                    if ((resource_type == 'images' and file.endswith(self.ACCEPTED_IMAGE_EXTENSIONS)) or
+                        (resource_type == 'sounds' and file.endswith(self.ACCEPTED_SOUND_EXTENSIONS))):
+                        self._paths[resource_type][resource_name] = filepath
+                        self._request(resource_type, resource_name)
 
             self.add_sound(None, EmptySound())
 
+    def _decode(self, resource_type, resource_name):
+        filepath = self._paths[resource_type][resource_name]
+        with TRACER.scope('decode', 'loader', {'resource': resource_name}):
+            if filepath is self.BUNDLED:
+                resource_obj = self._bundle.load(resource_type, resource_name)
+            elif resource_type == 'images':
+                resource_obj = pygame.image.load(filepath)
+            else:
+                resource_obj = pygame.mixer.Sound(filepath)
+
+        if resource_type == 'sounds':
+            return MuteableSound(resource_obj, name=resource_name)
+        return resource_obj
+
+    def _request(self, resource_type, resource_name):
+        if self._executor is not None:
+            entry = self._executor.submit(self._decode, resource_type, resource_name)
+            self._cache[resource_type][resource_name] = entry
+            return entry
+        try:
+            resource_obj = self._decode(resource_type, resource_name)
+        except DECODE_ERRORS as error:
+            return self._store_failed(resource_type, resource_name, error)
+        return self._store(resource_type, resource_name, resource_obj)
+
+    # Stores the result of a finished background decode
+    def _resolve(self, resource_type, resource_name, entry):
+        error = entry.exception()
+        if error is not None and isinstance(error, DECODE_ERRORS):
+            return self._store_failed(resource_type, resource_name, error)
+        return self._store(resource_type, resource_name, entry.result())
+
+    # An asset that can't be decoded is replaced by a placeholder (blank image, silent sound)
+    # instead of stopping the game
+    def _store_failed(self, resource_type, resource_name, error):
+        print("Error: can't load {} '{}': {}".format(resource_type[:-1], resource_name, error))
+        TRACER.count('decode_errors')
+        placeholder = self._placeholder_image if resource_type == 'images' else EmptySound()
+        return self._store(resource_type, resource_name, placeholder)
+
+    @staticmethod
+    def _get_size(resource_obj):
+        if isinstance(resource_obj, pygame.Surface):
+            return resource_obj.get_pitch() * resource_obj.get_height()
+        if isinstance(resource_obj, MuteableSound):
+            mixer_settings = pygame.mixer.get_init()
+            if mixer_settings:
+                frequency, size, channels = mixer_settings
+                return int(resource_obj.sound.get_length() * frequency * channels * abs(size) // 8)
+        return 0
+
+    def _store(self, resource_type, resource_name, resource_obj):
+        if resource_type == 'images' and isinstance(resource_obj, pygame.Surface) and pygame.display.get_surface():
+            resource_obj = resource_obj.convert()
+        self._cache[resource_type][resource_name] = resource_obj
+        self._cache[resource_type].move_to_end(resource_name)
+        self._sizes[resource_type][resource_name] = self._get_size(resource_obj)
+        self._evict(resource_type, keep=resource_name)
+        return resource_obj
+
+    # Drops least recently used assets that can be loaded again until the type is in budget
+    def _evict(self, resource_type, keep=None):
+        budget = self._budgets.get(resource_type)
+        if budget is None:
+            return
+        sizes = self._sizes[resource_type]
+        cache = self._cache[resource_type]
+        total = sum(sizes.values())
+        for resource_name in list(cache):
+            if total <= budget:
+                break
+            if resource_name == keep or resource_name not in self._paths[resource_type]:
+                continue
+            if isinstance(cache[resource_name], Future):
+                continue
+            del cache[resource_name]
+            total -= sizes.pop(resource_name, 0)
+
+    def memory_usage(self, resource_type):
+        return sum(self._sizes[resource_type].values())
+
+    def is_ready(self, resource_type, resource_name):
+        entry = self._cache[resource_type].get(resource_name)
+        return entry is not None and not (isinstance(entry, Future) and not entry.done())
+
+    # Blocks until every pending asset is decoded
+    def wait(self):
+        for resource_type in self.RESOURCES:
+            for resource_name, entry in list(self._cache[resource_type].items()):
+                if isinstance(entry, Future):
+                    self._resolve(resource_type, resource_name, entry)
+
+    # Returns the asset, or None while it is being decoded in the background
     def lookup(self, resource_type, resource_name):
-        return self._cache[resource_type][resource_name]
+        cache = self._cache[resource_type]
+        entry = cache.get(resource_name)
+        if entry is None:
+            if resource_name not in self._paths[resource_type]:
+                raise KeyError(resource_name)
+            entry = self._request(resource_type, resource_name)
+
+        if isinstance(entry, Future):
+            if not entry.done():
+                return None
+            return self._resolve(resource_type, resource_name, entry)
+
+        cache.move_to_end(resource_name)
+        return entry
 
     def get_image(self, image_name):
-        return self.lookup('images', image_name)
+        image = self.lookup('images', image_name)
+        if image is None:
+            return self._placeholder_image
+        return image
 
     def get_sound(self, sound_name):
-        return self.lookup('sounds', sound_name)
+        if sound_name not in self._cache['sounds'] and sound_name not in self._paths['sounds']:
+            raise KeyError(sound_name)
+        return SoundHandle(self, sound_name)
 
     def add_image(self, image_name, image_obj):
-        self._cache['images'][image_name] = image_obj
+        self._store('images', image_name, image_obj)
 
     def add_sound(self, sound_name, sound_obj):
-        self._cache['sounds'][sound_name] = sound_obj
+        self._store('sounds', sound_name, sound_obj)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._bundle is not None:
+            self._bundle.close()
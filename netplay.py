@@ -0,0 +1,411 @@
+import sys
+import time
+import zlib
+import random
+import socket
+import struct
+import subprocess
+import config
+import pygame
+from input import InputController
+from ai import AIController
+from widgets import SimpleTextBox
+from simulation import HeadlessMatch, MAXIMUM_SCORE
+from replay import ACTIONS, ACTION_CODES, FINAL, new_seed, match_state
+from instrument import TRACER
+
+# Two-player network play over UDP. The host drives the left paddle and the guest the right
+# one; both peers run the same deterministic match (HeadlessMatch, seed sent by the host) and
+# only exchange paddle actions.
+#
+# Input delay + rollback:
+#   - the local action sampled on tick t is applied on tick t + input_delay, and sent at once
+#   - a remote action not received yet is predicted (the last one received is repeated) and
+#     the match keeps going. The state before every predicted tick is kept; when the real
+#     action arrives and differs from the prediction, the match is rewound to that tick and
+#     simulated again up to the current tick (within the same frame, nothing is seen)
+#   - a peer more than max_rollback ticks ahead of the inputs it has, or more than
+#     MAX_AHEAD ticks ahead of the other peer, waits (stalls) instead
+# With an input delay of 2 ticks (one frame at 60 FPS) and LAN round trips well below that,
+# the remote inputs usually arrive before they are needed and rollbacks are short.
+#
+# Packets (one per tick): PACKET header, then for INPUT
+#   INPUT_BODY: inputs received from the peer (ack), first tick, count + count action codes
+# Every packet carries all the local inputs the peer has not acknowledged yet, so a lost
+# packet is covered by the next one.
+#
+# python netplay.py host [PORT] | join HOST [PORT]   (+ --ai --headless --fast --ticks N --loss P)
+# python netplay.py test [TICKS] [LOSS]: host and guest in two processes over loopback
+
+MAGIC = b'PN'
+VERSION = 1
+HELLO, START, INPUT, BYE = range(4)
+PACKET = struct.Struct('<2sBB') # magic, version, type
+START_BODY = struct.Struct('<QddHBB') # seed, timestep, ball speed, maximum score, swept, input delay
+INPUT_BODY = struct.Struct('<IIB') # ack, first tick, count
+MAX_PACKET_INPUTS = 255
+MAX_PACKET_SIZE = 1024
+MAX_AHEAD = 2 # ticks
+HELLO_INTERVAL = 0.1 # seconds
+BYE_PACKETS = 3
+
+class NetplayError(Exception):
+    pass
+
+def _packet(packet_type, body=b''):
+    return PACKET.pack(MAGIC, VERSION, packet_type) + body
+
+def _parse(data):
+    if len(data) < PACKET.size:
+        return None, None
+    magic, version, packet_type = PACKET.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        return None, None
+    return packet_type, data[PACKET.size:]
+
+# Drives a paddle with the session inputs (confirmed or predicted) of the tick being simulated
+class NetController():
+    def __init__(self, session, side):
+        self.action = 'stop'
+        self.session = session
+        self.side = side
+
+    def update(self):
+        self.action = self.session.action(self.session.match.ticks, self.side)
+
+class NetSession():
+
+    # sock: non-blocking UDP socket, peer: its address. side: 'left' (host) or 'right' (guest)
+    # loss: ratio of outgoing packets dropped on purpose, to test the redundancy
+    def __init__(self, sock, peer, side, seed, timestep, ball_speed, maximum_score, swept,
+                 input_delay=config.NETPLAY_INPUT_DELAY, max_rollback=config.NETPLAY_MAX_ROLLBACK,
+                 start_packet=None, loss=0.0):
+        self.sock = sock
+        self.peer = peer
+        self.side = side
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+        self.loss = loss
+        # The host answers a repeated HELLO (its START was lost) with the same START
+        self._start_packet = start_packet
+        self.match = HeadlessMatch(lambda game: NetController(self, 'left'),
+                                   lambda game: NetController(self, 'right'),
+                                   ball_speed=ball_speed, maximum_score=maximum_score,
+                                   timestep=timestep, swept=swept, seed=seed)
+        # Action codes per tick, the first input_delay ticks are 'stop' on both sides
+        self.local_inputs = bytearray(input_delay)
+        self.remote_inputs = bytearray(input_delay)
+        self.peer_ack = 0 # local inputs the peer has
+        self.remote_tick = 0 # last tick the peer is known to have reached
+        self._states = {} # tick -> match state before the tick, for the predicted ticks
+        self.last_received = time.perf_counter()
+        self.is_peer_gone = False
+        self.stats = {'sent': 0, 'received': 0, 'stalls': 0, 'rollbacks': 0, 'resimulated': 0}
+
+    @property
+    def confirmed_ticks(self):
+        return len(self.remote_inputs)
+
+    # Every tick simulated so far used confirmed inputs only, the match state is final
+    @property
+    def is_confirmed(self):
+        return self.confirmed_ticks >= self.match.ticks
+
+    # Both peers have every input up to `ticks` and have simulated that far, the states are final
+    def is_settled(self, ticks):
+        return (self.match.ticks >= ticks and self.is_confirmed and self.remote_tick >= ticks and
+                self.peer_ack >= len(self.local_inputs))
+
+    @property
+    def is_over(self):
+        return self.is_peer_gone or (self.match.is_finished and self.is_settled(self.match.ticks))
+
+    def action(self, tick, side):
+        if side == self.side:
+            return ACTIONS[self.local_inputs[tick]]
+        if tick < len(self.remote_inputs):
+            return ACTIONS[self.remote_inputs[tick]]
+        # Prediction: the peer keeps doing what it did last
+        return ACTIONS[self.remote_inputs[-1]] if self.remote_inputs else 'stop'
+
+    def _simulate(self):
+        tick = self.match.ticks
+        if tick >= len(self.remote_inputs):
+            self._states[tick] = self.match.save_state()
+        return self.match.step()
+
+    def _rollback(self, tick):
+        current = self.match.ticks
+        with TRACER.scope('rollback', 'netplay'):
+            self.match.load_state(self._states[tick])
+            while self.match.ticks < current and self._simulate():
+                pass
+        TRACER.count('rollbacks')
+        self.stats['rollbacks'] += 1
+        self.stats['resimulated'] += current - tick
+
+    # New remote inputs from tick `first_new` on: rewinds to the first one that was mispredicted
+    def _check_predictions(self, first_new):
+        predicted = self.remote_inputs[first_new - 1] if first_new else ACTION_CODES['stop']
+        for tick in range(first_new, min(len(self.remote_inputs), self.match.ticks)):
+            if self.remote_inputs[tick] != predicted:
+                self._rollback(tick)
+                break
+        # States of confirmed ticks can't be needed anymore
+        for tick in [tick for tick in self._states if tick < len(self.remote_inputs)]:
+            del self._states[tick]
+
+    def _handle_input(self, body):
+        if len(body) < INPUT_BODY.size:
+            return
+        ack, first, count = INPUT_BODY.unpack_from(body, 0)
+        codes = body[INPUT_BODY.size:INPUT_BODY.size + count]
+        if len(codes) != count or any(code >= len(ACTIONS) for code in codes):
+            return
+        self.peer_ack = max(self.peer_ack, min(ack, len(self.local_inputs)))
+        self.remote_tick = max(self.remote_tick, first + count - self.input_delay)
+        known = len(self.remote_inputs)
+        if first <= known < first + count:
+            self.remote_inputs.extend(codes[known - first:])
+
+    def receive(self):
+        first_new = len(self.remote_inputs)
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError:
+                # ICMP port unreachable from a previous send (Windows), the peer may come back
+                continue
+            if address != self.peer:
+                continue
+            packet_type, body = _parse(data)
+            if packet_type is None:
+                continue
+            self.stats['received'] += 1
+            self.last_received = time.perf_counter()
+            if packet_type == INPUT:
+                self._handle_input(body)
+            elif packet_type == HELLO and self._start_packet is not None:
+                self.sock.sendto(self._start_packet, self.peer)
+            elif packet_type == BYE:
+                self.is_peer_gone = True
+
+        if len(self.remote_inputs) > first_new:
+            self._check_predictions(first_new)
+        if time.perf_counter() - self.last_received > config.NETPLAY_TIMEOUT:
+            self.is_peer_gone = True
+
+    def send(self):
+        first = self.peer_ack
+        count = min(len(self.local_inputs) - first, MAX_PACKET_INPUTS)
+        packet = _packet(INPUT, INPUT_BODY.pack(len(self.remote_inputs), first, count) +
+                         bytes(self.local_inputs[first:first + count]))
+        self.stats['sent'] += 1
+        if self.loss and random.random() < self.loss:
+            return
+        self.sock.sendto(packet, self.peer)
+
+    # Runs one tick with the local action (scheduled input_delay ticks ahead). Returns False
+    # when the tick could not run: too far ahead of the peer or the match is over
+    def advance(self, local_action):
+        if self.match.is_finished:
+            return False
+        ticks = self.match.ticks
+        if ticks - len(self.remote_inputs) >= self.max_rollback or ticks - self.remote_tick > MAX_AHEAD:
+            self.stats['stalls'] += 1
+            TRACER.count('netplay_stalls')
+            return False
+        self.local_inputs.append(ACTION_CODES[local_action])
+        self._simulate()
+        return True
+
+    # Receive, run a tick, send. Once per physics tick
+    def update(self, local_action):
+        self.receive()
+        has_advanced = self.advance(local_action)
+        self.send()
+        return has_advanced
+
+    def close(self):
+        if not self.is_peer_gone:
+            for _ in range(BYE_PACKETS):
+                self.sock.sendto(_packet(BYE), self.peer)
+        self.sock.close()
+
+    # Checksum of the match state, equal on both peers once the state is confirmed
+    def digest(self):
+        return zlib.crc32(struct.pack('<I', self.match.ticks) + FINAL.pack(*match_state(self.match)))
+
+def _socket(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(address)
+    return sock
+
+# Both peers build the match from the START body, so they use the very same values
+def _start_session(sock, peer, side, start_body, **kwargs):
+    seed, timestep, ball_speed, maximum_score, swept, input_delay = START_BODY.unpack(start_body)
+    sock.setblocking(False)
+    return NetSession(sock, peer, side, seed, timestep, ball_speed, maximum_score, bool(swept),
+                      input_delay=input_delay, **kwargs)
+
+# Waits for a guest and starts the match. The host plays on the left
+def host(port=config.NETPLAY_PORT, bind_address='0.0.0.0', seed=None, timeout=None, **kwargs):
+    sock = _socket((bind_address, port))
+    sock.settimeout(timeout)
+    while True:
+        try:
+            data, peer = sock.recvfrom(MAX_PACKET_SIZE)
+        except socket.timeout:
+            sock.close()
+            raise NetplayError("No guest joined")
+        if _parse(data)[0] == HELLO:
+            break
+
+    seed = seed if seed is not None else new_seed()
+    timestep = config.TIMESTEP
+    input_delay = kwargs.pop('input_delay', config.NETPLAY_INPUT_DELAY)
+    start_packet = _packet(START, START_BODY.pack(seed, timestep, config.BALL_SPEED, MAXIMUM_SCORE,
+                                                  config.SWEPT_COLLISIONS, input_delay))
+    sock.sendto(start_packet, peer)
+    return _start_session(sock, peer, 'left', start_packet[PACKET.size:], start_packet=start_packet, **kwargs)
+
+# Joins a host, the match settings come from it. The guest plays on the right
+def join(host_address, port=config.NETPLAY_PORT, timeout=config.NETPLAY_TIMEOUT, **kwargs):
+    sock = _socket(('', 0))
+    peer = (socket.gethostbyname(host_address), port)
+    sock.settimeout(HELLO_INTERVAL)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        sock.sendto(_packet(HELLO), peer)
+        try:
+            data, address = sock.recvfrom(MAX_PACKET_SIZE)
+        except (socket.timeout, ConnectionResetError):
+            continue
+        packet_type, body = _parse(data)
+        if address == peer and packet_type == START and len(body) == START_BODY.size:
+            return _start_session(sock, peer, 'right', body, **kwargs)
+    sock.close()
+    raise NetplayError("No answer from {}:{}".format(host_address, port))
+
+class NetplayView():
+
+    def __init__(self, screen, session):
+        self.screen = screen
+        self.session = session
+        screen_rect = screen.get_rect()
+        self.background = pygame.Surface(screen_rect.size)
+        self.background.fill(pygame.Color('black'))
+        self.background.fill(pygame.Color('white'), (screen_rect.centerx, 0, 5, screen_rect.height))
+        self.player_score_textbox = SimpleTextBox(screen_rect.centerx - 40, 36, screen, text='0', glyphs=True)
+        self.enemy_score_textbox = SimpleTextBox(screen_rect.centerx + 40, 36, screen, text='0', glyphs=True)
+
+    def draw(self):
+        match = self.session.match
+        self.screen.blit(self.background, (0, 0))
+        for entity in match.entities:
+            self.screen.blit(entity.image, entity.rect)
+        self.player_score_textbox.modify(newtext=str(match.player_score))
+        self.enemy_score_textbox.modify(newtext=str(match.enemy_score))
+        for textbox in (self.player_score_textbox, self.enemy_score_textbox):
+            textbox.update()
+            textbox.draw()
+        pygame.display.update()
+
+# Plays the session until it is over. controller: the local paddle (InputController fed with
+# the window events, or an AI). render: draw in a window; fast: don't wait for real time
+# (the peers still wait for each other). max_ticks: stop there, once both peers have the inputs
+def play(session, controller, render=True, fast=False, max_ticks=None):
+    view = None
+    if render:
+        screen = pygame.display.get_surface() or pygame.display.set_mode((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+        pygame.display.set_caption("PyPong! netplay ({})".format(session.side))
+        view = NetplayView(screen, session)
+    clock = pygame.time.Clock()
+    timestep = session.match.timestep
+    accumulator = 0.0
+    try:
+        while not session.is_over:
+            if render:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        return session
+                    if isinstance(controller, InputController):
+                        controller.handle_event(event)
+
+            if fast:
+                ticks_due = 1
+            else:
+                accumulator += min(clock.tick(config.FPS if render else 1 / timestep) / 1000.0, config.MAX_FRAME_TIME)
+                ticks_due = int(accumulator / timestep)
+                accumulator -= ticks_due * timestep
+            for _ in range(ticks_due):
+                if max_ticks is not None and session.match.ticks >= max_ticks:
+                    session.receive()
+                    session.send()
+                    continue
+                controller.update()
+                session.update(controller.action)
+
+            if max_ticks is not None and session.is_settled(max_ticks):
+                break
+            if view is not None:
+                view.draw()
+            elif fast:
+                # Let the peer run when both share a core
+                time.sleep(0)
+    finally:
+        session.close()
+    return session
+
+def _argument(name, default, cast=str):
+    if name in sys.argv:
+        return cast(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+def _run_peer(session, render):
+    if '--ai' in sys.argv:
+        controller = AIController(session.match, side=session.side)
+    else:
+        controller = InputController()
+    max_ticks = _argument('--ticks', None, int)
+    play(session, controller, render=render, fast='--fast' in sys.argv, max_ticks=max_ticks)
+    match = session.match
+    print("{} tick {} score {}-{} digest {:08x} {}".format(session.side, match.ticks, match.player_score,
+                                                          match.enemy_score, session.digest(), session.stats))
+
+# Host and guest as two processes over loopback, AI driven, headless and as fast as they can.
+# Exits with status 1 if the peers don't end in the same state
+def _test(ticks, loss):
+    port = _argument('--port', config.NETPLAY_PORT + 1, int)
+    options = ['--ai', '--headless', '--fast', '--ticks', str(ticks), '--loss', str(loss)]
+    host_process = subprocess.Popen([sys.executable, __file__, 'host', str(port)] + options,
+                                    stdout=subprocess.PIPE, text=True)
+    time.sleep(0.5)
+    guest_process = subprocess.Popen([sys.executable, __file__, 'join', '127.0.0.1', str(port)] + options,
+                                     stdout=subprocess.PIPE, text=True)
+    outputs = [process.communicate()[0].strip().splitlines()[-1] for process in (host_process, guest_process)]
+    for output in outputs:
+        print(output)
+    digests = [output.split(' digest ')[1].split()[0] for output in outputs]
+    print("OK" if digests[0] == digests[1] else "MISMATCH")
+    return digests[0] == digests[1]
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'test'
+    render = '--headless' not in sys.argv
+    loss = _argument('--loss', 0.0, float)
+    if render:
+        pygame.init()
+    if command == 'host':
+        port = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else config.NETPLAY_PORT
+        print("Waiting for a guest on port {}".format(port))
+        _run_peer(host(port, loss=loss), render)
+    elif command == 'join':
+        port = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3].isdigit() else config.NETPLAY_PORT
+        _run_peer(join(sys.argv[2], port, loss=loss), render)
+    elif command == 'test':
+        ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+        loss = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+        sys.exit(0 if _test(ticks, loss) else 1)
@@ -0,0 +1,200 @@
+import config
+import pygame
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Particle effects (paddle hits, wall bounces, goals) kept as a structure of arrays: one
+# preallocated float32 row per field (position, velocity, lifetime, color) and the live
+# particles packed at the start of the rows. Emitting writes the new particles after the live
+# ones, update() moves them all with a few numpy passes and packs the survivors again, draw()
+# writes their pixels straight into the surface (pygame.surfarray, one pass per pixel of the
+# particle size). Every intermediate result goes into preallocated buffers (out=...), once
+# warmed up no particle data is allocated, whatever the number of particles. What remains per
+# frame is the churn of small numpy view objects (slices, the pixels2d reference), about 2 KB
+# at peak, freed right away.
+#
+# At most config.PARTICLE_CAP particles are alive, and drawn, at any time: particles emitted
+# beyond the cap are dropped (counted in `dropped`). Needs numpy, AVAILABLE is False without it
+# and the game runs without effects. Only 32 bits surfaces can be drawn on, see supports().
+
+AVAILABLE = np is not None
+
+# Whether particles can be drawn on the surface: draw() writes 8 bits per channel pixels through
+# pygame.surfarray.pixels2d, which 24 bits surfaces don't support and 16 bits ones would garble
+def supports(surface):
+    return AVAILABLE and surface.get_bitsize() == 32
+
+X, Y, VX, VY, LIFE, INVERSE_LIFETIME, RED, GREEN, BLUE = range(9)
+FIELDS = 9
+
+class ParticleSystem():
+
+    # effects: name -> (particles per emission, max speed in pixels/s, lifetime in s, color)
+    def __init__(self, bounds, capacity=config.PARTICLE_CAP, effects=config.PARTICLE_EFFECTS,
+                 size=config.PARTICLE_SIZE, gravity=config.PARTICLE_GRAVITY, seed=None):
+        self.bounds = pygame.Rect(bounds)
+        self.capacity = capacity
+        self.effects = effects
+        self.size = size
+        self.gravity = gravity
+        # Not the match RNG, effects must not change the serves (replays)
+        self.rng = np.random.default_rng(seed)
+        self.particles = np.zeros((FIELDS, capacity), dtype=np.float32)
+        self._packed = np.zeros((FIELDS, capacity), dtype=np.float32)
+        self._scratch = np.zeros(capacity, dtype=np.float32)
+        self._keep = np.zeros(capacity, dtype=bool)
+        self._inside = np.zeros(capacity, dtype=bool)
+        self._indices = np.arange(capacity, dtype=np.intp)
+        self._destinations = np.zeros(capacity, dtype=np.intp)
+        # One spare slot, where the expired particles are sent when packing
+        self._sources = np.zeros(capacity + 1, dtype=np.intp)
+        self._columns = np.zeros(capacity, dtype=np.intp)
+        self._pixel_indices = np.zeros(capacity, dtype=np.intp)
+        self._channel = np.zeros(capacity, dtype=np.uint32)
+        self._colors = np.zeros(capacity, dtype=np.uint32)
+        self._fade = np.zeros(capacity, dtype=np.float32)
+        self.count = 0
+        self.dropped = 0
+        self.drawn_rect = None
+
+    def clear(self):
+        self.count = 0
+
+    # Emits the particles of the effect at (x, y), as many as the cap leaves room for
+    def emit(self, name, x, y):
+        amount, speed, lifetime, color = self.effects[name]
+        start = self.count
+        amount_left = min(amount, self.capacity - start)
+        self.dropped += amount - amount_left
+        if amount_left <= 0:
+            return
+        end = start + amount_left
+        particles = self.particles
+        angles = self._scratch[start:end]
+        speeds = self._fade[start:end]
+        self.rng.random(out=angles, dtype=np.float32)
+        angles *= 2 * np.pi
+        self.rng.random(out=speeds, dtype=np.float32)
+        speeds *= speed
+        np.cos(angles, out=particles[VX, start:end])
+        particles[VX, start:end] *= speeds
+        np.sin(angles, out=particles[VY, start:end])
+        particles[VY, start:end] *= speeds
+        particles[X, start:end] = x
+        particles[Y, start:end] = y
+        # Lifetimes from half to all of the effect lifetime, so a burst fades out gradually
+        self.rng.random(out=particles[LIFE, start:end], dtype=np.float32)
+        particles[LIFE, start:end] *= 0.5 * lifetime
+        particles[LIFE, start:end] += 0.5 * lifetime
+        particles[INVERSE_LIFETIME, start:end] = 1 / lifetime
+        particles[RED, start:end] = color[0]
+        particles[GREEN, start:end] = color[1]
+        particles[BLUE, start:end] = color[2]
+        self.count = end
+
+    # Moves the live particles dt seconds forward, and drops the expired ones and those out of
+    # the bounds
+    def update(self, dt):
+        count = self.count
+        if not count:
+            return
+        particles = self.particles
+        scratch = self._scratch[:count]
+        np.multiply(particles[VX, :count], dt, out=scratch)
+        particles[X, :count] += scratch
+        particles[VY, :count] += self.gravity * dt
+        np.multiply(particles[VY, :count], dt, out=scratch)
+        particles[Y, :count] += scratch
+        particles[LIFE, :count] -= dt
+
+        keep = self._keep[:count]
+        inside = self._inside[:count]
+        np.greater(particles[LIFE, :count], 0.0, out=keep)
+        np.greater_equal(particles[X, :count], self.bounds.left, out=inside)
+        keep &= inside
+        np.less(particles[X, :count], self.bounds.right - self.size, out=inside)
+        keep &= inside
+        np.greater_equal(particles[Y, :count], self.bounds.top, out=inside)
+        keep &= inside
+        np.less(particles[Y, :count], self.bounds.bottom - self.size, out=inside)
+        keep &= inside
+
+        alive = int(np.count_nonzero(keep))
+        if alive < count:
+            self._pack(keep, alive)
+
+    # Moves the particles kept to the start of the other rows, which become the live ones.
+    # np.compress() and boolean indexing would allocate index arrays, hence the manual scatter
+    def _pack(self, keep, alive):
+        count = self.count
+        destinations = self._destinations[:count]
+        np.copyto(destinations, keep)
+        np.add.accumulate(destinations, out=destinations)
+        destinations -= 1
+        dropped = self._inside[:count]
+        np.logical_not(keep, out=dropped)
+        np.copyto(destinations, self.capacity, where=dropped)
+        self._sources[destinations] = self._indices[:count]
+        sources = self._sources[:alive]
+        for field in range(FIELDS):
+            np.take(self.particles[field, :count], sources, out=self._packed[field, :alive], mode='clip')
+        self.particles, self._packed = self._packed, self.particles
+        self.count = alive
+
+    # Area covered by the live particles, None without any
+    def _bounding_rect(self):
+        if not self.count:
+            return None
+        particles = self.particles
+        left = int(particles[X, :self.count].min())
+        top = int(particles[Y, :self.count].min())
+        right = int(particles[X, :self.count].max()) + self.size
+        bottom = int(particles[Y, :self.count].max()) + self.size
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    # Draws all the live particles, faded by their remaining lifetime, on a 32 bits surface (the
+    # display). Returns the area drawn (None without particles), the previous one is kept in
+    # drawn_rect until the next draw
+    def draw(self, surface):
+        self.drawn_rect = self._bounding_rect()
+        count = self.count
+        if not count:
+            return None
+        particles = self.particles
+        width = surface.get_width()
+        fade = self._fade[:count]
+        np.multiply(particles[LIFE, :count], particles[INVERSE_LIFETIME, :count], out=fade)
+        np.minimum(fade, 1.0, out=fade)
+        # Colors in the surface pixel format
+        colors = self._colors[:count]
+        channel = self._channel[:count]
+        scratch = self._scratch[:count]
+        colors.fill(surface.get_masks()[3])
+        for field, shift in zip((RED, GREEN, BLUE), surface.get_shifts()):
+            np.multiply(particles[field, :count], fade, out=scratch)
+            np.copyto(channel, scratch, casting='unsafe')
+            np.left_shift(channel, shift, out=channel)
+            np.bitwise_or(colors, channel, out=colors)
+        # Index of the top-left pixel of every particle in the (rows, columns) pixel array
+        indices = self._pixel_indices[:count]
+        columns = self._columns[:count]
+        np.copyto(indices, particles[Y, :count], casting='unsafe')
+        indices *= width
+        np.copyto(columns, particles[X, :count], casting='unsafe')
+        indices += columns
+
+        # Transposed, the pixels2d array is the surface buffer itself (no copy for np.put())
+        pixels = pygame.surfarray.pixels2d(surface)
+        rows = pixels.T
+        try:
+            for _ in range(self.size):
+                for _ in range(self.size):
+                    np.put(rows, indices, colors)
+                    indices += 1
+                indices += width - self.size
+        finally:
+            # Releases the surface lock
+            del rows, pixels
+        return self.drawn_rect
@@ -0,0 +1,182 @@
+import time
+import config
+import pygame
+from array import array
+from widgets import SimpleTextBox
+from instrument import TRACER
+
+# Frame profiling for GameStateManager: every frame is split into event processing, state
+# update(s), draw and display update, and kept in a fixed-size ring buffer (the last
+# config.PROFILER_HISTORY frames). The manager records all the time, it is a handful of
+# perf_counter() calls per frame; ProfilerOverlay shows the history on screen (F key) and
+# the manager can dump it as CSV. With the tracer enabled the frames and their phases are
+# traced as well (instrument.py).
+
+PHASES = ('events', 'update', 'draw', 'display')
+EVENTS, UPDATE, DRAW, DISPLAY = range(len(PHASES))
+PHASE_COLORS = (pygame.Color(80, 140, 255), pygame.Color(80, 220, 120),
+                pygame.Color(240, 200, 60), pygame.Color(220, 90, 220))
+
+class FrameProfiler():
+
+    def __init__(self, size=config.PROFILER_HISTORY):
+        self.size = size
+        # One array per phase, seconds. Slot of frame n: n % size
+        self._times = [array('d', bytes(8 * size)) for _ in PHASES]
+        self._updates = array('I', bytes(4 * size))
+        self._current = [0.0] * len(PHASES)
+        self._mark = 0.0
+        self._frame_start = 0.0
+        self.count = 0
+        self._worst_slot = -1
+
+    def begin_frame(self):
+        for index in range(len(self._current)):
+            self._current[index] = 0.0
+        self._mark = time.perf_counter()
+        self._frame_start = self._mark
+
+    # Adds the time since the previous mark (or begin_frame) to the phase
+    def mark(self, phase_index):
+        now = time.perf_counter()
+        self._current[phase_index] += now - self._mark
+        TRACER.complete(PHASES[phase_index], self._mark, now, 'frame')
+        self._mark = now
+
+    # updates: number of physics steps run in the frame
+    def end_frame(self, updates=1):
+        slot = self.count % self.size
+        for times, value in zip(self._times, self._current):
+            times[slot] = value
+        self._updates[slot] = updates
+        self.count += 1
+        if TRACER.enabled:
+            TRACER.complete('frame', self._frame_start, time.perf_counter(), 'frame', {'updates': updates})
+
+        if self._worst_slot == slot:
+            # The worst frame was just overwritten
+            self._worst_slot = max(self.slots(), key=self.frame_time)
+        elif self._worst_slot < 0 or sum(self._current) >= self.frame_time(self._worst_slot):
+            self._worst_slot = slot
+
+    @property
+    def length(self):
+        return min(self.count, self.size)
+
+    @property
+    def last_slot(self):
+        return (self.count - 1) % self.size
+
+    def frame_time(self, slot):
+        return sum(times[slot] for times in self._times)
+
+    def phase_times(self, slot):
+        return [times[slot] for times in self._times]
+
+    # Slots from the oldest to the newest frame
+    def slots(self):
+        first = self.count - self.length
+        return [frame % self.size for frame in range(first, self.count)]
+
+    # Returns (frames ago, seconds) of the worst frame in the window
+    def worst(self):
+        if self._worst_slot < 0:
+            return None, 0.0
+        return (self.last_slot - self._worst_slot) % self.size, self.frame_time(self._worst_slot)
+
+    def to_csv(self):
+        lines = ["frame,{},total_ms,updates".format(",".join(phase + "_ms" for phase in PHASES))]
+        first = self.count - self.length
+        for frame, slot in zip(range(first, self.count), self.slots()):
+            phase_times = self.phase_times(slot)
+            lines.append("{},{},{:.4f},{}".format(frame, ",".join("{:.4f}".format(1000 * value) for value in phase_times),
+                                                1000 * sum(phase_times), self._updates[slot]))
+        return "\n".join(lines) + "\n"
+
+# Frame time graph, one column per frame (stacked phases) with the frame budget line, half
+# of it dimmed, and a marker over the worst frame. The graph surface is scrolled by one pixel
+# and a single column drawn per frame; the texts are refreshed every TEXT_INTERVAL frames.
+class ProfilerOverlay():
+
+    GRAPH_HEIGHT = 50
+    TEXT_INTERVAL = 15
+    MARKER_HEIGHT = 3
+    BACKGROUND = pygame.Color(20, 20, 20)
+    BUDGET_COLOR = pygame.Color(255, 60, 60)
+    HALF_BUDGET_COLOR = pygame.Color(110, 40, 40)
+    MARKER_COLOR = pygame.Color(255, 60, 60)
+
+    def __init__(self, screen, profiler, right, top, clock):
+        self.screen = screen
+        self.profiler = profiler
+        self.clock = clock
+        self.budget = 1 / config.FPS
+        # Full height is twice the frame budget
+        self._scale = self.GRAPH_HEIGHT / (2 * self.budget)
+        self._graph = pygame.Surface((profiler.size, self.GRAPH_HEIGHT))
+        self._graph_frame = 0 # profiler.count the graph is up to date with
+        self.rect = pygame.Rect(0, 0, profiler.size, self.GRAPH_HEIGHT + 30)
+        self.rect.topright = (right, top)
+        self._graph_pos = (self.rect.left, self.rect.bottom - self.GRAPH_HEIGHT)
+        self._fps_text = SimpleTextBox(self.rect.left + 35, self.rect.top + 8, screen, text='0.00 fps', size=12, glyphs=True)
+        self._worst_text = SimpleTextBox(self.rect.right - 45, self.rect.top + 8, screen, text='max 0.00 ms', size=12, glyphs=True)
+        self.drawn_rect = None
+
+    # phase_times: seconds, empty for a column without frame
+    def _draw_column(self, x, phase_times):
+        graph = self._graph
+        graph.fill(self.BACKGROUND, (x, 0, 1, self.GRAPH_HEIGHT))
+        bottom = self.GRAPH_HEIGHT
+        for color, value in zip(PHASE_COLORS, phase_times):
+            height = value * self._scale
+            if height >= 0.5 and bottom > 0:
+                top = max(0, bottom - round(height))
+                graph.fill(color, (x, top, 1, bottom - top))
+                bottom = top
+        graph.set_at((x, self.GRAPH_HEIGHT - round(self.budget * self._scale)), self.BUDGET_COLOR)
+        graph.set_at((x, self.GRAPH_HEIGHT - round(self.budget * self._scale / 2)), self.HALF_BUDGET_COLOR)
+
+    # Redraws the whole graph, e.g. when the overlay is shown again
+    def rebuild(self):
+        self._graph.fill(self.BACKGROUND)
+        slots = self.profiler.slots()
+        offset = self.profiler.size - len(slots)
+        for x in range(offset):
+            self._draw_column(x, ())
+        for x, slot in enumerate(slots, offset):
+            self._draw_column(x, self.profiler.phase_times(slot))
+        self._graph_frame = self.profiler.count
+        self._update_texts()
+
+    def _update_texts(self):
+        self._fps_text.modify(newtext="{0:.2f} fps".format(self.clock.get_fps()))
+        self._worst_text.modify(newtext="max {:.2f} ms".format(1000 * self.profiler.worst()[1]))
+        self._fps_text.update()
+        self._worst_text.update()
+
+    def update(self):
+        new_frames = self.profiler.count - self._graph_frame
+        if new_frames <= 0:
+            return
+        if new_frames >= self.profiler.size:
+            self.rebuild()
+            return
+        self._graph.scroll(-new_frames, 0)
+        width = self.profiler.size
+        for frame in range(self._graph_frame, self.profiler.count):
+            self._draw_column(width - (self.profiler.count - frame), self.profiler.phase_times(frame % width))
+        self._graph_frame = self.profiler.count
+        if self.profiler.count % self.TEXT_INTERVAL < new_frames:
+            self._update_texts()
+
+    def draw(self):
+        self.screen.fill(self.BACKGROUND, self.rect)
+        self.screen.blit(self._graph, self._graph_pos)
+        age, _ = self.profiler.worst()
+        if age is not None:
+            x = self.rect.right - 1 - age
+            self.screen.fill(self.MARKER_COLOR, (x - 1, self._graph_pos[1] - self.MARKER_HEIGHT - 1, 3, self.MARKER_HEIGHT))
+        self._fps_text.draw()
+        self._worst_text.draw()
+        self.drawn_rect = self.rect.copy()
+        return self.drawn_rect
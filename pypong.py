@@ -1,30 +1,52 @@
 import os
 import sys
+import time
 import config
 import pygame
 from pygame.locals import *
 from loader import ResourceLoader
-from states import (GameStateManager, GameMainMenuState, GameOptionsMenuState,
+from storage import SAVE_WRITER
+from instrument import TRACER
+from states import (GameStateManager, StateRegistry, GameMainMenuState, GameOptionsMenuState,
                     GamePauseMenuState, GameRunningState, GameLoseScreenState,
                     GameWinScreenState, GameCountdownState, GameSaveMenuState,
                     GameLoadMenuState)
 
+# Most likely next states of every state, in order, built ahead of time while idling
+PREWARM_HINTS = {'MAIN_MENU_STATE': ['GAME_COUNTDOWN_STATE', 'GAME_RUNNING_STATE', 'PAUSE_MENU_STATE',
+                                     'LOAD_MENU_STATE', 'OPTIONS_MENU_STATE'],
+                 'OPTIONS_MENU_STATE': ['MAIN_MENU_STATE'],
+                 'PAUSE_MENU_STATE': ['GAME_COUNTDOWN_STATE', 'SAVE_MENU_STATE'],
+                 'GAME_LOSE_SCREEN_STATE': ['GAME_COUNTDOWN_STATE', 'MAIN_MENU_STATE'],
+                 'GAME_WIN_SCREEN_STATE': ['GAME_COUNTDOWN_STATE', 'MAIN_MENU_STATE'],
+                 'SAVE_MENU_STATE': ['PAUSE_MENU_STATE'],
+                 'LOAD_MENU_STATE': ['MAIN_MENU_STATE', 'GAME_COUNTDOWN_STATE']}
+
 if __name__ == '__main__':
-    pygame.mixer.pre_init(44100, -16, 1, 512)
+    START_TIME = time.perf_counter()
+    pygame.mixer.pre_init(config.MIXER_FREQUENCY, config.MIXER_SIZE, config.MIXER_CHANNELS, config.MIXER_BUFFER)
     pygame.init()
     os.environ['SDL_VIDEO_CENTERED'] = "TRUE"
     SCREEN = pygame.display.set_mode((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
-    RESOURCE_LOADER = ResourceLoader(config.RESOURCES_BASE_PATH)
-    STATES = {'MAIN_MENU_STATE': GameMainMenuState(SCREEN, RESOURCE_LOADER),
-              'OPTIONS_MENU_STATE': GameOptionsMenuState(SCREEN, RESOURCE_LOADER),
-              'PAUSE_MENU_STATE': GamePauseMenuState(SCREEN, RESOURCE_LOADER),
-              'GAME_COUNTDOWN_STATE': GameCountdownState(SCREEN, RESOURCE_LOADER),
-              'GAME_RUNNING_STATE': GameRunningState(SCREEN, RESOURCE_LOADER),
-              'GAME_LOSE_SCREEN_STATE': GameLoseScreenState(SCREEN, RESOURCE_LOADER),
-              'GAME_WIN_SCREEN_STATE': GameWinScreenState(SCREEN, RESOURCE_LOADER),
-              'SAVE_MENU_STATE': GameSaveMenuState(SCREEN, RESOURCE_LOADER),
-              'LOAD_MENU_STATE': GameLoadMenuState(SCREEN, RESOURCE_LOADER)}
-    GAME = GameStateManager(STATES, 'MAIN_MENU_STATE', SCREEN, caption='PyPong!')
+    RESOURCE_LOADER = ResourceLoader(config.RESOURCES_BASE_PATH, background=config.BACKGROUND_LOADING,
+                                     bundle_path=config.BUNDLE_PATH)
+    STATES = StateRegistry(SCREEN, RESOURCE_LOADER,
+                           {'MAIN_MENU_STATE': GameMainMenuState,
+                            'OPTIONS_MENU_STATE': GameOptionsMenuState,
+                            'PAUSE_MENU_STATE': GamePauseMenuState,
+                            'GAME_COUNTDOWN_STATE': GameCountdownState,
+                            'GAME_RUNNING_STATE': GameRunningState,
+                            'GAME_LOSE_SCREEN_STATE': GameLoseScreenState,
+                            'GAME_WIN_SCREEN_STATE': GameWinScreenState,
+                            'SAVE_MENU_STATE': GameSaveMenuState,
+                            'LOAD_MENU_STATE': GameLoadMenuState},
+                           prewarm_hints=PREWARM_HINTS)
+    GAME = GameStateManager(STATES, 'MAIN_MENU_STATE', SCREEN, caption='PyPong!', start_time=START_TIME)
     GAME.run()
+    # A recording still going on is exported on exit
+    if TRACER.enabled:
+        GAME.dump_trace()
+    SAVE_WRITER.close()
+    RESOURCE_LOADER.shutdown()
     pygame.quit()
     sys.exit()
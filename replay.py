@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import zlib
+import random
+import struct
+import config
+import pygame
+from simulation import HeadlessMatch, left_ai, right_ai
+
+# Match replays: the match seed (serve directions) plus the action of both paddles on every
+# tick are enough to play a match again exactly, the simulation is otherwise deterministic.
+# Replays are recorded by GameRunningState (config.RECORD_REPLAYS) or by record_match() and
+# played headless (as fast as possible) or rendered by play().
+#
+# File layout: HEADER | runs length | runs | FINAL
+#   runs: zlib compressed RUN records (count, code), the per-tick codes run-length encoded
+#   code: player action | enemy action << 2 (see ACTIONS)
+#   FINAL: scores and ball state at the end of the match, checked by play()
+# The paddle sizes and speeds are not stored, replays only play back with the same config.
+
+MAGIC = b'PPRP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQddHBI') # magic, version, reserved, seed, timestep, ball speed, maximum score, swept, ticks
+RUN = struct.Struct('<HB')
+FINAL = struct.Struct('<HHddddd') # player score, enemy score, ball fx, fy, xspeed, yspeed, speed_coeff
+MAX_RUN = 0xFFFF
+EXTENSION = '.ppr'
+
+ACTIONS = ('stop', 'up', 'down')
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+class ReplayError(Exception):
+    pass
+
+def new_seed():
+    return random.getrandbits(63)
+
+# State compared at the end of a playback: GameRunningState and HeadlessMatch both work here
+def match_state(game):
+    ball = game.ball
+    return (game.player_score, game.enemy_score, ball.fx, ball.fy, ball.xspeed, ball.yspeed, ball.speed_coeff)
+
+class Replay():
+
+    def __init__(self, seed, timestep, ball_speed, maximum_score, swept, codes=None, final_state=None):
+        self.seed = seed
+        self.timestep = timestep
+        self.ball_speed = ball_speed
+        self.maximum_score = maximum_score
+        self.swept = swept
+        self.codes = codes if codes is not None else bytearray()
+        self.final_state = final_state
+
+    @property
+    def ticks(self):
+        return len(self.codes)
+
+    def action(self, tick, side):
+        if tick >= len(self.codes):
+            return 'stop'
+        code = self.codes[tick]
+        return ACTIONS[code & 3 if side == 'left' else code >> 2]
+
+    def to_bytes(self):
+        runs = []
+        run_code, run_length = None, 0
+        for code in self.codes:
+            if code == run_code and run_length < MAX_RUN:
+                run_length += 1
+                continue
+            if run_length:
+                runs.append(RUN.pack(run_length, run_code))
+            run_code, run_length = code, 1
+        if run_length:
+            runs.append(RUN.pack(run_length, run_code))
+
+        if self.final_state is None:
+            raise ReplayError("The replay is not finished")
+        header = HEADER.pack(MAGIC, VERSION, 0, self.seed, self.timestep, self.ball_speed,
+                             self.maximum_score, self.swept, self.ticks)
+        runs_data = zlib.compress(b''.join(runs), 9)
+        return b''.join([header, struct.pack('<I', len(runs_data)), runs_data, FINAL.pack(*self.final_state)])
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < HEADER.size + 4:
+            raise ReplayError("Truncated replay")
+        magic, version, _, seed, timestep, ball_speed, maximum_score, swept, ticks = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ReplayError("Not a version {} replay".format(VERSION))
+        offset = HEADER.size
+        (runs_length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if len(data) != offset + runs_length + FINAL.size:
+            raise ReplayError("Truncated replay")
+
+        try:
+            runs_data = zlib.decompress(data[offset:offset + runs_length])
+        except zlib.error:
+            raise ReplayError("Corrupted replay")
+        codes = bytearray()
+        if len(runs_data) % RUN.size == 0:
+            for run_length, code in RUN.iter_unpack(runs_data):
+                codes.extend(bytes((code,)) * run_length)
+        if len(codes) != ticks:
+            raise ReplayError("Corrupted replay")
+        offset += runs_length
+        final_state = FINAL.unpack_from(data, offset)
+        return cls(seed, timestep, ball_speed, maximum_score, bool(swept), codes, final_state)
+
+    def save(self, path):
+        with open(path, 'wb') as replay_file:
+            replay_file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as replay_file:
+            return cls.from_bytes(replay_file.read())
+
+    def __repr__(self):
+        return "Replay(seed={}, ticks={}, final={})".format(self.seed, self.ticks, self.final_state)
+
+class ReplayRecorder():
+
+    def __init__(self, seed, timestep, ball_speed, maximum_score, swept):
+        self.replay = Replay(seed, timestep, ball_speed, maximum_score, swept)
+        self._codes = self.replay.codes
+
+    # Once per tick, after the controllers are updated and before the paddles move
+    def record(self, player_action, enemy_action):
+        self._codes.append(ACTION_CODES[player_action] | ACTION_CODES[enemy_action] << 2)
+
+    # game: the finished match, its final state is kept to check the playbacks
+    def finish(self, game):
+        self.replay.final_state = match_state(game)
+        return self.replay
+
+# Drives a paddle with the recorded actions, the tick is the one of the match being played
+class ReplayController():
+    def __init__(self, game, replay, side):
+        self.action = 'stop'
+        self.game = game
+        self.replay = replay
+        self.side = side
+
+    def update(self):
+        self.action = self.replay.action(self.game.ticks, self.side)
+
+def record_match(seed=None, player_controller=left_ai, enemy_controller=right_ai, **kwargs):
+    seed = seed if seed is not None else new_seed()
+    match = HeadlessMatch(player_controller, enemy_controller, seed=seed, **kwargs)
+    recorder = ReplayRecorder(seed, match.timestep, match.ball_speed, match.maximum_score, match.swept)
+    match.recorder = recorder
+    match.run()
+    return recorder.finish(match)
+
+def _draw_match(match, screen):
+    screen.fill(pygame.Color('black'))
+    for entity in match.entities:
+        screen.blit(entity.image, entity.rect)
+    pygame.display.update()
+
+# Plays the replay again. Returns the match and whether it ended exactly as recorded.
+# render: draw it on the display at the recorded speed instead of running headless
+def play(replay, render=False):
+    match = HeadlessMatch(lambda game: ReplayController(game, replay, 'left'),
+                          lambda game: ReplayController(game, replay, 'right'),
+                          ball_speed=replay.ball_speed, maximum_score=replay.maximum_score,
+                          timestep=replay.timestep, swept=replay.swept, seed=replay.seed)
+    if render:
+        screen = pygame.display.get_surface() or pygame.display.set_mode(match.board.get_size())
+        clock = pygame.time.Clock()
+        while match.step():
+            if pygame.event.peek(pygame.QUIT):
+                break
+            pygame.event.pump()
+            _draw_match(match, screen)
+            clock.tick(1 / replay.timestep)
+    else:
+        match.run()
+
+    is_exact = match.ticks == replay.ticks and match_state(match) == tuple(replay.final_state)
+    return match, is_exact
+
+def _replay_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(EXTENSION))
+    return [path]
+
+# python replay.py record COUNT OUTPUT_DIR | play PATH [--render] | bench PATH
+# (PATH: a replay file or a folder of them, e.g. config.REPLAYS_PATH)
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    if command == 'record':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        output_path = sys.argv[3] if len(sys.argv) > 3 else config.REPLAYS_PATH
+        os.makedirs(output_path, exist_ok=True)
+        for _ in range(count):
+            replay = record_match()
+            replay.save(os.path.join(output_path, "replay_{}{}".format(replay.seed, EXTENSION)))
+            print(replay)
+    elif command == 'play':
+        render = '--render' in sys.argv
+        if render:
+            pygame.init()
+        for path in _replay_files(sys.argv[2]):
+            match, is_exact = play(Replay.load(path), render=render)
+            print("{}: {} {}".format(path, match.result(), "OK" if is_exact else "MISMATCH"))
+    elif command == 'bench':
+        paths = _replay_files(sys.argv[2] if len(sys.argv) > 2 else config.REPLAYS_PATH)
+        replays = [Replay.load(path) for path in paths]
+        start = time.perf_counter()
+        mismatches = sum(1 for replay in replays if not play(replay)[1])
+        elapsed = time.perf_counter() - start
+        ticks = sum(replay.ticks for replay in replays)
+        print("{} replays, {} ticks in {:.2f} s ({:.0f} ticks/s), {} mismatches".format(
+            len(replays), ticks, elapsed, ticks / elapsed if elapsed else 0.0, mismatches))
+        sys.exit(1 if mismatches else 0)
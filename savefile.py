@@ -0,0 +1,110 @@
+import json
+import zlib
+import struct
+import pygame
+
+# Binary save file: a single file holding the game state, its metadata, a thumbnail already
+# sized for the storage slot and the paused game screenshot.
+#
+# Layout: HEADER | slot section | screenshot section
+#   slot section: RECORD | metadata (JSON) | thumbnail image
+#   screenshot section: screenshot image
+#   image: IMAGE header (width, height, compressed length) + zlib compressed RGB pixels
+# Both sections have their CRC32 in the header, checked before anything is decoded. Listing
+# the slots only reads the header and the slot section, the screenshot is the bulk of the file.
+#
+# Saves written before this format (slot_*_data_*.json + slot_*_screenshot_*.png) are still
+# read by read_legacy().
+
+MAGIC = b'PPSV'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIII') # magic, version, reserved, slot crc32, slot length, screenshot crc32, screenshot length
+METADATA_LENGTH = struct.Struct('<I')
+IMAGE = struct.Struct('<HHI') # width, height, compressed length
+EXTENSION = '.sav'
+
+# GameRunningState._update_game_data() fields, in record order
+GAME_FIELDS = ('player_x', 'player_y', 'player_score',
+               'enemy_x', 'enemy_y', 'enemy_score',
+               'ball_fx', 'ball_fy', 'ball_xspeed', 'ball_yspeed', 'ball_speed_coeff')
+RECORD = struct.Struct('<iiiiiiddddd')
+
+class SaveFileError(Exception):
+    pass
+
+def _encode_image(image_string, size):
+    data = zlib.compress(image_string, 9)
+    return IMAGE.pack(size[0], size[1], len(data)) + data
+
+def _decode_image(view, offset):
+    width, height, length = IMAGE.unpack_from(view, offset)
+    offset += IMAGE.size
+    pixels = zlib.decompress(view[offset:offset + length])
+    if len(pixels) != width * height * 3:
+        raise SaveFileError("Bad image size")
+    return pygame.image.frombuffer(pixels, (width, height), 'RGB'), offset + length
+
+# thumbnail, screenshot: (RGB string, (width, height)), as given by pygame.image.tostring()
+def encode(metadata, game_data, thumbnail, screenshot):
+    metadata_data = json.dumps(metadata).encode('utf-8')
+    slot_data = b''.join([RECORD.pack(*(game_data[field] for field in GAME_FIELDS)),
+                          METADATA_LENGTH.pack(len(metadata_data)), metadata_data,
+                          _encode_image(*thumbnail)])
+    screenshot_data = _encode_image(*screenshot)
+    return b''.join([HEADER.pack(MAGIC, VERSION, 0, zlib.crc32(slot_data), len(slot_data),
+                                 zlib.crc32(screenshot_data), len(screenshot_data)),
+                     slot_data, screenshot_data])
+
+def _unpack_header(file_data):
+    if len(file_data) < HEADER.size:
+        raise SaveFileError("Truncated save file")
+    magic, version, _, slot_crc, slot_length, screenshot_crc, screenshot_length = HEADER.unpack_from(file_data, 0)
+    if magic != MAGIC:
+        raise SaveFileError("Not a save file")
+    if version != VERSION:
+        raise SaveFileError("Unsupported save file version: {}".format(version))
+    return slot_crc, slot_length, screenshot_crc, screenshot_length
+
+def _section(file_data, offset, length, crc):
+    section = memoryview(file_data)[offset:offset + length]
+    if len(section) != length or zlib.crc32(section) != crc:
+        raise SaveFileError("Corrupted save file")
+    return section
+
+# Returns {'metadata': ..., 'data': {'GAME_DATA': ...}, 'thumbnail': Surface, 'screenshot': Surface}
+# (screenshot is None when not asked for, file_data may then end after the slot section)
+def decode(file_data, screenshot=True):
+    slot_crc, slot_length, screenshot_crc, screenshot_length = _unpack_header(file_data)
+    payload = _section(file_data, HEADER.size, slot_length, slot_crc)
+
+    game_data = dict(zip(GAME_FIELDS, RECORD.unpack_from(payload, 0)))
+    offset = RECORD.size
+    (metadata_length,) = METADATA_LENGTH.unpack_from(payload, offset)
+    offset += METADATA_LENGTH.size
+    metadata = json.loads(bytes(payload[offset:offset + metadata_length]).decode('utf-8'))
+    offset += metadata_length
+    thumbnail = _decode_image(payload, offset)[0]
+    screenshot_image = None
+    if screenshot:
+        screenshot_section = _section(file_data, HEADER.size + slot_length, screenshot_length, screenshot_crc)
+        screenshot_image = _decode_image(screenshot_section, 0)[0]
+
+    return {'metadata': metadata, 'data': {'GAME_DATA': game_data},
+            'thumbnail': thumbnail, 'screenshot': screenshot_image}
+
+def read(path, screenshot=True):
+    with open(path, 'rb') as save_file:
+        if screenshot:
+            return decode(save_file.read())
+        header = save_file.read(HEADER.size)
+        slot_length = _unpack_header(header)[1]
+        return decode(header + save_file.read(slot_length), screenshot=False)
+
+# Old JSON + PNG saves, same result as read() (the thumbnail is scaled here)
+def read_legacy(data_path, screenshot_path, thumbnail_size=None, screenshot=True):
+    with open(data_path, 'r') as data_file:
+        storage_data = json.load(data_file)
+    image = pygame.image.load(screenshot_path) if screenshot_path and (screenshot or thumbnail_size) else None
+    return {'metadata': storage_data['metadata'], 'data': storage_data['data'],
+            'thumbnail': pygame.transform.scale(image, thumbnail_size) if image and thumbnail_size else None,
+            'screenshot': image if screenshot else None}
@@ -0,0 +1,461 @@
+import sys
+import time
+import socket
+import struct
+import asyncio
+import config
+import pygame
+from array import array
+from ai import AIController
+from simulation import HeadlessMatch
+from replay import ACTIONS, ACTION_CODES, new_seed
+
+# Authoritative match server: hundreds of independent headless matches in one process, all
+# stepped by a single fixed-rate scheduler (one asyncio task, config.SERVER_TICK_RATE ticks
+# per second). Clients connect over TCP, join a match against the AI or another client, send
+# paddle actions ('stop', 'up', 'down', like InputController) and get the match state as
+# deltas after every tick.
+#
+# Framing: every message is FRAME (payload length, type) + payload
+#   client -> server   JOIN: opponent (0: AI, 1: another client)   ACTION: action code   LEAVE
+#   server -> client   WELCOME: match id, side (0 left, 1 right), seed, tick rate
+#                      STATE: tick, mask of the FIELDS sent, then an int16 per field in the mask
+#                      END: player score, enemy score
+#
+# Slow clients: deltas are computed against the last state actually sent to each client, so a
+# client whose socket buffer is over config.SERVER_HIGH_WATER gets the deltas merged, one every
+# config.SERVER_COALESCE_TICKS ticks instead of every tick. The buffer of a client that stopped
+# reading keeps growing and once over config.SERVER_MAX_BUFFER the client is disconnected (its
+# paddle goes to the AI); the scheduler never waits for a client.
+#
+# python server.py serve [PORT]
+# python server.py bench [CLIENTS] [SECONDS] [SLOW_CLIENTS]: server and bot clients in one process
+
+FRAME = struct.Struct('<HB')
+JOIN, ACTION, LEAVE, WELCOME, STATE, END = range(6)
+JOIN_BODY = struct.Struct('<B')
+ACTION_BODY = struct.Struct('<B')
+WELCOME_BODY = struct.Struct('<IBQH')
+STATE_HEADER = struct.Struct('<IB')
+END_BODY = struct.Struct('<BB')
+FIELD = struct.Struct('<h')
+FIELDS = ('ball_x', 'ball_y', 'left_y', 'right_y', 'player_score', 'enemy_score')
+OPPONENT_AI, OPPONENT_CLIENT = range(2)
+SIDES = ('left', 'right')
+# Ticks the scheduler may run late to catch up, past that the ticks are dropped
+MAX_CATCHUP_TICKS = 5
+# Bench only: a match sends under 1 KB/s, with the default socket buffers and thresholds a slow
+# client would take minutes to be coalesced, let alone disconnected. With these (the smallest
+# buffers the kernel accepts) it is coalesced after about 5 s and disconnected after about 8 s
+BENCH_SEND_BUFFER = 4096
+BENCH_RECEIVE_BUFFER = 1024
+BENCH_HIGH_WATER = 512
+BENCH_MAX_BUFFER = 1024
+
+# The entities are only bound to the board, every match shares it
+BOARD = pygame.Surface((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+
+def frame(message_type, payload=b''):
+    return FRAME.pack(len(payload), message_type) + payload
+
+def match_fields(match):
+    return (match.ball.rect.x, match.ball.rect.y, match.player.rect.y, match.enemy.rect.y,
+            match.player_score, match.enemy_score)
+
+# STATE payload with the fields that changed since `previous` (None: all of them)
+def encode_state(tick, fields, previous):
+    mask = 0
+    values = []
+    for index, value in enumerate(fields):
+        if previous is None or previous[index] != value:
+            mask |= 1 << index
+            values.append(FIELD.pack(value))
+    return STATE_HEADER.pack(tick, mask) + b''.join(values)
+
+# Applies a STATE payload to `fields` (a list), returns the tick
+def decode_state(payload, fields):
+    tick, mask = STATE_HEADER.unpack_from(payload, 0)
+    offset = STATE_HEADER.size
+    for index in range(len(FIELDS)):
+        if mask & (1 << index):
+            (fields[index],) = FIELD.unpack_from(payload, offset)
+            offset += FIELD.size
+    return tick
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME.size)
+    length, message_type = FRAME.unpack(header)
+    payload = await reader.readexactly(length) if length else b''
+    return message_type, payload
+
+# The paddle of a client: the action is set when an ACTION message arrives and used from the
+# next tick on. Without a client (never joined or gone) the AI drives the paddle
+class RemoteController():
+    def __init__(self, game, side):
+        self.action = 'stop'
+        self.ai = AIController(game, side=side)
+        self.client = None
+
+    def update(self):
+        if self.client is None:
+            self.ai.update()
+            self.action = self.ai.action
+
+class ServerMatch():
+
+    def __init__(self, match_id, timestep, seed=None):
+        self.id = match_id
+        self.seed = seed if seed is not None else new_seed()
+        self.game = HeadlessMatch(lambda game: RemoteController(game, 'left'),
+                                  lambda game: RemoteController(game, 'right'),
+                                  timestep=timestep, seed=self.seed, board=BOARD)
+        self.controllers = {'left': self.game.player.controller, 'right': self.game.enemy.controller}
+
+    @property
+    def clients(self):
+        return [controller.client for controller in self.controllers.values() if controller.client is not None]
+
+class ClientConnection():
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.match = None
+        self.side = None
+        self.last_sent = None # fields of the last STATE sent, deltas are relative to it
+        self.is_closed = False
+
+    @property
+    def buffered(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def send(self, message_type, payload=b''):
+        if not self.is_closed:
+            self.writer.write(frame(message_type, payload))
+
+    # Returns False when the state could not be sent (client too slow)
+    def send_state(self, tick, fields):
+        buffered = self.buffered
+        if buffered > self.server.max_buffer:
+            self.server.metrics.counters['slow_disconnects'] += 1
+            self.close()
+            return False
+        if buffered > self.server.high_water and tick % config.SERVER_COALESCE_TICKS:
+            self.server.metrics.counters['deltas_coalesced'] += 1
+            return False
+        if fields != self.last_sent:
+            self.send(STATE, encode_state(tick, fields, self.last_sent))
+            self.last_sent = fields
+        return True
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            self.server.detach(self)
+            self.writer.close()
+
+# Per-tick scheduling metrics over the last `size` ticks: time spent stepping the matches and
+# sending the states, and how late the tick started
+class SchedulerMetrics():
+
+    def __init__(self, period, size=config.SERVER_METRICS_TICKS):
+        self.period = period
+        self.size = size
+        self._work = array('d', bytes(8 * size))
+        self._lateness = array('d', bytes(8 * size))
+        self.count = 0
+        self.counters = {'ticks': 0, 'dropped_ticks': 0, 'overruns': 0, 'deltas_coalesced': 0,
+                         'slow_disconnects': 0, 'matches_played': 0}
+
+    def record(self, work, lateness):
+        slot = self.count % self.size
+        self._work[slot] = work
+        self._lateness[slot] = lateness
+        self.count += 1
+        self.counters['ticks'] += 1
+        if work > self.period:
+            self.counters['overruns'] += 1
+
+    def summary(self):
+        length = min(self.count, self.size)
+        work = sorted(self._work[:length])
+        lateness = sorted(self._lateness[:length])
+        def percentile(values, percent):
+            return 1000 * values[min(len(values) - 1, int(percent / 100 * len(values)))] if values else 0.0
+        return {'work_p50_ms': percentile(work, 50), 'work_p99_ms': percentile(work, 99),
+                'late_p50_ms': percentile(lateness, 50), 'late_p99_ms': percentile(lateness, 99),
+                'load': sum(work) / (length * self.period) if length else 0.0}
+
+class MatchServer():
+
+    # send_buffer: SO_SNDBUF of the client sockets, the system default when None (the bench
+    # shrinks it, with the thresholds, so its slow clients reach them within a few seconds)
+    def __init__(self, host='127.0.0.1', port=config.SERVER_PORT, tick_rate=config.SERVER_TICK_RATE,
+                 high_water=config.SERVER_HIGH_WATER, max_buffer=config.SERVER_MAX_BUFFER, send_buffer=None):
+        self.host = host
+        self.port = port
+        self.tick_rate = tick_rate
+        self.high_water = high_water
+        self.max_buffer = max_buffer
+        self.send_buffer = send_buffer
+        self.timestep = 1 / tick_rate
+        self.matches = {}
+        self.clients = set()
+        self._next_match_id = 1
+        self._waiting = None # client waiting for another client to play against
+        self.metrics = SchedulerMetrics(self.timestep)
+        self.tick = 0
+        self.is_running = False
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.is_running = True
+        return asyncio.create_task(self._run_scheduler())
+
+    async def stop(self):
+        self.is_running = False
+        for client in list(self.clients):
+            client.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def add_match(self):
+        match = ServerMatch(self._next_match_id, self.timestep)
+        self._next_match_id += 1
+        self.matches[match.id] = match
+        return match
+
+    def _attach(self, client, match, side):
+        client.match = match
+        client.side = side
+        match.controllers[side].client = client
+        client.send(WELCOME, WELCOME_BODY.pack(match.id, SIDES.index(side), match.seed, self.tick_rate))
+
+    def _join(self, client, opponent):
+        if client.match is not None or client is self._waiting:
+            return
+        if opponent == OPPONENT_CLIENT:
+            if self._waiting is None:
+                self._waiting = client
+                return
+            match = self.add_match()
+            self._attach(self._waiting, match, 'left')
+            self._waiting = None
+            self._attach(client, match, 'right')
+        else:
+            self._attach(client, self.add_match(), 'left')
+
+    # The client is gone: its paddle goes to the AI, a match without clients is stopped
+    def detach(self, client):
+        self.clients.discard(client)
+        if self._waiting is client:
+            self._waiting = None
+        match = client.match
+        if match is None:
+            return
+        match.controllers[client.side].client = None
+        client.match = None
+        if not match.clients:
+            self.matches.pop(match.id, None)
+
+    async def _handle_client(self, reader, writer):
+        if self.send_buffer is not None:
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        client = ClientConnection(self, reader, writer)
+        self.clients.add(client)
+        try:
+            while not client.is_closed:
+                message_type, payload = await read_frame(reader)
+                if message_type == JOIN and len(payload) == JOIN_BODY.size:
+                    self._join(client, JOIN_BODY.unpack(payload)[0])
+                elif message_type == ACTION and len(payload) == ACTION_BODY.size and client.match is not None:
+                    (code,) = ACTION_BODY.unpack(payload)
+                    if code < len(ACTIONS):
+                        client.match.controllers[client.side].action = ACTIONS[code]
+                elif message_type == LEAVE:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.close()
+
+    def _end_match(self, match):
+        self.matches.pop(match.id, None)
+        self.metrics.counters['matches_played'] += 1
+        for client in match.clients:
+            client.send_state(self.tick, match_fields(match.game))
+            client.send(END, END_BODY.pack(match.game.player_score, match.game.enemy_score))
+            client.match = None
+
+    def _step_matches(self):
+        self.tick += 1
+        for match in list(self.matches.values()):
+            game = match.game
+            game.step()
+            if game.is_finished:
+                self._end_match(match)
+                continue
+            fields = None
+            for client in match.clients:
+                if fields is None:
+                    fields = match_fields(game)
+                client.send_state(self.tick, fields)
+
+    async def _run_scheduler(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self.is_running:
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # Let the clients be served even when running late
+                await asyncio.sleep(0)
+            lateness = loop.time() - next_tick
+            if lateness > MAX_CATCHUP_TICKS * self.timestep:
+                dropped = int(lateness / self.timestep)
+                self.metrics.counters['dropped_ticks'] += dropped
+                next_tick += dropped * self.timestep
+                lateness -= dropped * self.timestep
+
+            start = time.perf_counter()
+            self._step_matches()
+            self.metrics.record(time.perf_counter() - start, lateness)
+            next_tick += self.timestep
+
+    def report(self):
+        summary = self.metrics.summary()
+        return ("tick {} | {} matches, {} clients | work p50 {:.2f} ms p99 {:.2f} ms, load {:.0%} | "
+                "late p99 {:.2f} ms | {}".format(self.tick, len(self.matches), len(self.clients),
+                                                 summary['work_p50_ms'], summary['work_p99_ms'],
+                                                 summary['load'], summary['late_p99_ms'], self.metrics.counters))
+
+# Client side of the protocol. `fields` holds the last known match state (see FIELDS)
+class MatchClient():
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.match_id = None
+        self.side = None
+        self.seed = None
+        self.tick = 0
+        self.fields = [0] * len(FIELDS)
+        self.result = None
+        self.states_received = 0
+
+    # receive_buffer: SO_RCVBUF of the socket, the system default when None
+    async def connect(self, host='127.0.0.1', port=config.SERVER_PORT, opponent=OPPONENT_AI, receive_buffer=None):
+        if receive_buffer is None:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        else:
+            # Set before connecting, the TCP window is negotiated then
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+            sock.setblocking(False)
+            try:
+                await asyncio.get_running_loop().sock_connect(sock, (host, port))
+            except OSError:
+                sock.close()
+                raise
+            self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.writer.write(frame(JOIN, JOIN_BODY.pack(opponent)))
+        message_type, payload = await read_frame(self.reader)
+        if message_type != WELCOME:
+            raise ConnectionError("Unexpected message {}".format(message_type))
+        self.match_id, side, self.seed, _ = WELCOME_BODY.unpack(payload)
+        self.side = SIDES[side]
+
+    def send_action(self, action):
+        self.writer.write(frame(ACTION, ACTION_BODY.pack(ACTION_CODES[action])))
+
+    # Reads the next message. Returns False once the match is over
+    async def receive(self):
+        message_type, payload = await read_frame(self.reader)
+        if message_type == STATE:
+            self.tick = decode_state(payload, self.fields)
+            self.states_received += 1
+        elif message_type == END:
+            self.result = END_BODY.unpack(payload)
+            return False
+        return True
+
+    async def close(self):
+        if self.writer is not None:
+            if not self.writer.is_closing():
+                self.writer.write(frame(LEAVE))
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+# Bot client: chases the ball with its paddle, changing its action at most every few ticks
+async def _bot(port, duration, is_slow=False):
+    client = MatchClient()
+    await client.connect(port=port, receive_buffer=BENCH_RECEIVE_BUFFER if is_slow else None)
+    paddle_index = FIELDS.index(client.side + '_y')
+    deadline = time.perf_counter() + duration
+    action = 'stop'
+    try:
+        if is_slow:
+            # Never reads, not even into the StreamReader buffer: the states pile up on the
+            # server, which has to merge them and then disconnect the client
+            client.writer.transport.pause_reading()
+            await asyncio.sleep(duration)
+            return client
+        while time.perf_counter() < deadline and await client.receive():
+            if client.tick % 4 == 0:
+                paddle_center = client.fields[paddle_index] + 1.5 * config.BRICK_SIZE
+                ball_center = client.fields[1] + config.BRICK_SIZE / 2
+                new_action = 'up' if ball_center < paddle_center - 5 else 'down' if ball_center > paddle_center + 5 else 'stop'
+                if new_action != action:
+                    action = new_action
+                    client.send_action(action)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        await client.close()
+    return client
+
+async def _bench(clients, duration, slow_clients):
+    server = MatchServer(port=0, high_water=BENCH_HIGH_WATER, max_buffer=BENCH_MAX_BUFFER,
+                         send_buffer=BENCH_SEND_BUFFER)
+    scheduler = await server.start()
+    start = time.perf_counter()
+    bots = [asyncio.create_task(_bot(server.port, duration, is_slow=index < slow_clients))
+            for index in range(clients)]
+    while time.perf_counter() - start < duration:
+        await asyncio.sleep(1.0)
+        print(server.report())
+    results = await asyncio.gather(*bots, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    states = sum(result.states_received for result in results if isinstance(result, MatchClient))
+    errors = [result for result in results if not isinstance(result, MatchClient)]
+    print("{} clients, {} states received ({:.0f}/s), {} errors".format(clients, states, states / elapsed, len(errors)))
+    await server.stop()
+    scheduler.cancel()
+
+async def _serve(port):
+    server = MatchServer(host='0.0.0.0', port=port)
+    await server.start()
+    print("Match server on port {}, {} ticks/s".format(server.port, server.tick_rate))
+    while True:
+        await asyncio.sleep(5.0)
+        print(server.report())
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    if command == 'serve':
+        try:
+            asyncio.run(_serve(int(sys.argv[2]) if len(sys.argv) > 2 else config.SERVER_PORT))
+        except KeyboardInterrupt:
+            pass
+    elif command == 'bench':
+        clients = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+        slow_clients = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+        asyncio.run(_bench(clients, duration, slow_clients))
@@ -0,0 +1,297 @@
+import config
+import random
+import pygame
+from entities import Ball, Paddle
+from ai import AIController
+from loader import EmptySound
+
+# Headless version of the match played in GameRunningState: same entities, controllers and
+# scoring rules but no drawing, no sounds and no clock throttling, so matches can be played
+# as fast as the CPU allows (AI evaluation, regression checks...). One match is tens of
+# thousands of Python ticks (about 2 matches/s per core at the default 1/60 s step): for
+# throughput play many matches at once with the numpy engine of batch.py.
+
+MAXIMUM_SCORE = 11
+
+def check_point(ball, player, enemy):
+    # Returns who scored a point in the current tick, if anyone
+    if ball.rect.left < player.rect.left:
+        return 'enemy'
+    elif ball.rect.right > enemy.rect.right:
+        return 'player'
+    return None
+
+def check_winner(player_score, enemy_score, maximum_score=MAXIMUM_SCORE):
+    if enemy_score >= maximum_score:
+        return 'enemy'
+    elif player_score >= maximum_score:
+        return 'player'
+    return None
+
+def left_ai(game):
+    return AIController(game, side='left')
+
+def right_ai(game):
+    return AIController(game, side='right')
+
+class MatchResult():
+
+    def __init__(self, player_score, enemy_score, rally_lengths, ticks, maximum_score=MAXIMUM_SCORE):
+        self.player_score = player_score
+        self.enemy_score = enemy_score
+        self.maximum_score = maximum_score
+        # Number of paddle hits of every rally, one entry per point played
+        self.rally_lengths = rally_lengths
+        self.ticks = ticks
+
+    @property
+    def winner(self):
+        return check_winner(self.player_score, self.enemy_score, self.maximum_score)
+
+    @property
+    def score(self):
+        return (self.player_score, self.enemy_score)
+
+    def __repr__(self):
+        return "MatchResult(score={}-{}, rallies={}, ticks={})".format(self.player_score,
+                                                                      self.enemy_score,
+                                                                      len(self.rally_lengths),
+                                                                      self.ticks)
+
+class HeadlessMatch():
+
+    # Controllers are built from factories because AI controllers need the match itself.
+    # The default timestep is one reference frame; with swept collisions much bigger steps
+    # (fewer ticks per match) stay correct. The numpy batch engine mirrors swept=False.
+    # seed: seeds the match RNG (serves), a match with the same seed and controller actions is
+    # played exactly the same (see replay.py)
+    # board: surface the entities are bound to, nothing is drawn on it so many matches can
+    # share one (a screen sized surface per match otherwise)
+    def __init__(self, player_controller=left_ai, enemy_controller=right_ai,
+                 ball_speed=config.BALL_SPEED, maximum_score=MAXIMUM_SCORE, timestep=None,
+                 swept=config.SWEPT_COLLISIONS, seed=None, board=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.ball_speed = ball_speed
+        self.maximum_score = maximum_score
+        self.timestep = timestep if timestep is not None else 1 / config.SPEED_REFERENCE_FPS
+        self.swept = swept
+        self.board = board if board is not None else pygame.Surface((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
+        self.screen_rect = self.board.get_rect()
+
+        self.player = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
+                             2*config.BRICK_SIZE, self.screen_rect.centery,
+                             config.PLAYER_SPEED, self.board, player_controller(self))
+        self.ball = Ball(config.BRICK_SIZE, self.screen_rect.centerx,
+                         self.screen_rect.centery, ball_speed, self.board,
+                         bounce_sound=EmptySound(), hit_sound=EmptySound(), rng=self.rng)
+        self.enemy = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
+                            config.SCREEN_WIDTH - 2*config.BRICK_SIZE,
+                            self.screen_rect.centery, config.ENEMY_SPEED,
+                            self.board, enemy_controller(self))
+        self.entities = [self.ball, self.player, self.enemy]
+        self.paddles = [self.player, self.enemy]
+        if swept:
+            self.ball.colliders = self.paddles
+
+        self.player_score = 0
+        self.enemy_score = 0
+        self.ticks = 0
+        self.rally_lengths = []
+        self._rally_start_hits = 0
+        self.winner = None
+        # Called with (player action, enemy action) every tick before the paddles move
+        self.recorder = None
+
+    @property
+    def is_finished(self):
+        return self.winner is not None
+
+    def _check_collisions(self):
+        if self.ball.colliders is None:
+            for entity in pygame.sprite.spritecollide(self.ball, self.paddles, dokill=False):
+                self.ball.process_collision(entity)
+
+    # Same order of operations as GameRunningState._execute_game_logic + update
+    def _execute_game_logic(self):
+        scorer = check_point(self.ball, self.player, self.enemy)
+        if scorer is not None:
+            if scorer == 'enemy':
+                self.enemy_score += 1
+            else:
+                self.player_score += 1
+            self.rally_lengths.append(self.ball.hit_count - self._rally_start_hits)
+            self._rally_start_hits = self.ball.hit_count
+            self.ball.reset()
+
+        self.winner = check_winner(self.player_score, self.enemy_score, self.maximum_score)
+        if self.winner is None:
+            self._check_collisions()
+
+    def step(self):
+        if self.is_finished:
+            return False
+
+        self._execute_game_logic()
+        if self.is_finished:
+            return False
+
+        for paddle in self.paddles:
+            paddle.controller.update()
+        if self.recorder is not None:
+            self.recorder.record(self.player.controller.action, self.enemy.controller.action)
+
+        for entity in self.entities:
+            entity.update(self.timestep)
+
+        self.ticks += 1
+        return True
+
+    # Everything a tick changes, so the match can be rewound (netplay rollback). The controllers
+    # are not part of it, they have to be stateless or rewound by whoever owns them
+    def save_state(self):
+        ball = self.ball
+        return (self.ticks, self.player_score, self.enemy_score, self.winner, self._rally_start_hits,
+                len(self.rally_lengths), ball.fx, ball.fy, ball.prev_fx, ball.prev_fy, ball.xspeed,
+                ball.yspeed, ball.speed_coeff, ball.hit_count, ball.rect.topleft, ball.run,
+                tuple((paddle.fy, paddle.prev_fy, paddle.rect.y, paddle.action) for paddle in self.paddles),
+                self.rng.getstate())
+
+    def load_state(self, state):
+        ball = self.ball
+        (self.ticks, self.player_score, self.enemy_score, self.winner, self._rally_start_hits,
+         rallies, ball.fx, ball.fy, ball.prev_fx, ball.prev_fy, ball.xspeed, ball.yspeed,
+         ball.speed_coeff, ball.hit_count, ball.rect.topleft, ball.run, paddles, rng_state) = state
+        del self.rally_lengths[rallies:]
+        for paddle, (fy, prev_fy, y, action) in zip(self.paddles, paddles):
+            paddle.fy = fy
+            paddle.prev_fy = prev_fy
+            paddle.rect.y = y
+            paddle.action = action
+        self.rng.setstate(rng_state)
+
+    def run(self, max_ticks=None):
+        while self.step():
+            if max_ticks is not None and self.ticks >= max_ticks:
+                break
+        return self.result()
+
+    def result(self):
+        return MatchResult(self.player_score, self.enemy_score, list(self.rally_lengths), self.ticks,
+                           self.maximum_score)
+
+def run_matches(count, **kwargs):
+    return [HeadlessMatch(**kwargs).run() for _ in range(count)]
+
+# Serve RNG of the original match in check_mirror_symmetry(): keeps every direction drawn
+class _ServeRecorder():
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.draws = []
+
+    def choice(self, options):
+        value = self.rng.choice(options)
+        self.draws.append(value)
+        return value
+
+# Serve RNG of the mirrored match: the same serves, horizontal directions (the first draw of
+# every Ball.reset()) reversed
+class _MirroredServes():
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.index = 0
+
+    def choice(self, options):
+        value = self.recorder.draws[self.index]
+        if self.index % 2 == 0:
+            value = -value
+        self.index += 1
+        return value
+
+def _mirrored_state(match, axis):
+    ball = match.ball
+    return (axis - ball.size - ball.fx, ball.fy, -ball.xspeed, ball.yspeed, ball.speed_coeff,
+            match.enemy.fy, match.player.fy, match.enemy_score, match.player_score)
+
+def _state(match):
+    ball = match.ball
+    return (ball.fx, ball.fy, ball.xspeed, ball.yspeed, ball.speed_coeff,
+            match.player.fy, match.enemy.fy, match.player_score, match.enemy_score)
+
+# Plays a match between two identical AIs next to its mirror image (same serves, reversed
+# horizontally) and checks they stay mirror images tick after tick: neither side of the board
+# may be favoured. Returns the result of the original match
+def check_mirror_symmetry(swept, seed=0, tolerance=1e-6, max_ticks=None):
+    match = HeadlessMatch(swept=swept, seed=seed)
+    mirror = HeadlessMatch(swept=swept, seed=seed)
+    recorder = _ServeRecorder(match.rng)
+    match.ball.rng = recorder
+    mirror.ball.rng = _MirroredServes(recorder)
+    match.ball.reset()
+    mirror.ball.reset()
+    # The paddles are 1 pixel right of the board center (odd widths): mirror through theirs
+    axis = match.player.rect.left + match.enemy.rect.right
+    while match.step():
+        mirror.step()
+        expected = _state(match)
+        mirrored = _mirrored_state(mirror, axis)
+        if any(abs(value - other) > tolerance for value, other in zip(expected, mirrored)):
+            raise AssertionError("swept={} seed={}: mirrored match diverged at tick {}: {} vs {}".format(
+                swept, seed, match.ticks, expected, mirrored))
+        if max_ticks is not None and match.ticks >= max_ticks:
+            break
+    return match.result()
+
+# AI vs AI matches with swept and discrete collisions (same seeds). With the same AI on both
+# sides, each must give the left side about half of the wins. Returns {swept: summary}
+def compare_collision_modes(count=30, seed=0):
+    from tournament import wilson_interval
+
+    summaries = {}
+    for swept in (False, True):
+        results = [HeadlessMatch(swept=swept, seed=seed + index).run() for index in range(count)]
+        left_wins = sum(1 for result in results if result.winner == 'player')
+        rallies = [length for result in results for length in result.rally_lengths]
+        low, high = wilson_interval(left_wins, count)
+        summaries[swept] = {'left_wins': left_wins, 'left_win_ci': (low, high),
+                            'rally_mean': sum(rallies) / len(rallies) if rallies else 0.0,
+                            'ticks_per_match': sum(result.ticks for result in results) / count}
+        if not low <= 0.5 <= high:
+            raise AssertionError("swept={}: mirrored AIs, left side won {}/{} matches".format(swept, left_wins, count))
+    return summaries
+
+# python simulation.py [COUNT]: plays COUNT AI vs AI matches as fast as possible
+# python simulation.py check [COUNT]: mirror symmetry of both collision modes, and their AI vs
+# AI win rates over COUNT matches (exits with status 1 on failure)
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+        try:
+            for swept in (False, True):
+                for seed in range(3):
+                    result = check_mirror_symmetry(swept, seed)
+                    print("swept={} seed={}: mirrored OK ({})".format(swept, seed, result))
+            for swept, summary in compare_collision_modes(count).items():
+                low, high = summary['left_win_ci']
+                print("swept={}: left wins {}/{} [{:.0%}, {:.0%}], rally mean {:.1f}, {:.0f} ticks/match".format(
+                    swept, summary['left_wins'], count, low, high, summary['rally_mean'], summary['ticks_per_match']))
+        except AssertionError as error:
+            print("FAILED: {}".format(error))
+            sys.exit(1)
+        sys.exit(0)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    start = time.perf_counter()
+    results = run_matches(count)
+    elapsed = time.perf_counter() - start
+    player_wins = sum(1 for result in results if result.winner == 'player')
+    total_ticks = sum(result.ticks for result in results)
+    print("{} matches in {:.2f} s ({:.1f} matches/s, {:.0f} ticks/s)".format(count, elapsed,
+                                                                           count / elapsed,
+                                                                           total_ticks / elapsed))
+    print("player wins: {} - enemy wins: {}".format(player_wins, count - player_wins))
@@ -0,0 +1,71 @@
+import pygame
+
+# Holds the last paused game frame, replaces the screen serialized to a string in config.
+#
+# Ownership: the snapshot owns its surfaces and never modifies them once published. capture()
+# and set() replace the surface instead of drawing on it, so whoever got a surface (a menu,
+# the save writer thread) can keep using it, as long as it does not draw on it either.
+# The derived variants (dimmed background, thumbnails) are built once per snapshot and shared.
+
+def dim(surface, alpha):
+    # Same as blitting the surface with `alpha` over black, but opaque (a plain copy to blit)
+    dimmed = surface.copy()
+    dimmed.fill((alpha, alpha, alpha), special_flags=pygame.BLEND_MULT)
+    return dimmed
+
+class Snapshot():
+
+    def __init__(self):
+        self._surface = None
+        self._variants = {}
+        self.generation = 0
+
+    @property
+    def is_empty(self):
+        return self._surface is None
+
+    def _publish(self, surface):
+        self._surface = surface
+        self._variants = {}
+        self.generation += 1
+
+    # Copies the surface (the screen), the only full frame copy taken
+    def capture(self, surface):
+        self._publish(surface.copy())
+
+    # Takes ownership of an already built surface (e.g. a loaded save screenshot)
+    def set(self, surface):
+        if pygame.display.get_surface():
+            surface = surface.convert()
+        self._publish(surface)
+
+    def clear(self):
+        self._publish(None)
+
+    # The retained surface, or None. Read only
+    def get(self):
+        return self._surface
+
+    def _variant(self, key, build):
+        if self._surface is None:
+            return None
+        variant = self._variants.get(key)
+        if variant is None:
+            variant = build(self._surface)
+            self._variants[key] = variant
+        return variant
+
+    def dimmed(self, alpha):
+        return self._variant(('dimmed', alpha), lambda surface: dim(surface, alpha))
+
+    def thumbnail(self, size):
+        return self._variant(('thumbnail', tuple(size)), lambda surface: pygame.transform.scale(surface, size))
+
+    # Adds a variant built elsewhere (e.g. the thumbnail stored in a save file)
+    def add_thumbnail(self, thumbnail):
+        if self._surface is not None:
+            if pygame.display.get_surface():
+                thumbnail = thumbnail.convert()
+            self._variants[('thumbnail', thumbnail.get_size())] = thumbnail
+
+PAUSED_GAME = Snapshot()
@@ -1,16 +1,27 @@
+import os
+import json
+import time
+import random
 import config
 import pygame
 from pygame.locals import *
-from input import InputController, AIController
+from input import InputController
+from ai import create_controller
 from entities import Paddle, Ball
 from widgets import SimpleTextBox, SimpleButton
-from storage import StorageSlot
+from storage import StorageSlot, SAVE_WRITER
+from snapshot import PAUSED_GAME, dim
 from loader import MuteableSound
+from voices import VOICES
+from simulation import check_point, check_winner
+from instrument import TRACER
+from particles import ParticleSystem, supports as supports_particles
+from profiler import FrameProfiler, ProfilerOverlay, EVENTS, UPDATE, DRAW, DISPLAY
+from replay import ReplayRecorder, new_seed, EXTENSION as REPLAY_EXTENSION
 
 # TODO:
 # 4) Decouple game variables (screen, clock...) from GameStateManager, maybe a Game class?
 # 5) Decouple the use of screen in each state (just pass it as parameter in draw()) (classes should be reworked as well)
-# 6) Add 'dt' in state machine and update methods of the states (classes should be reworked as well)
 # 8) Add new method to state; resume/startup. Clear buttons, reset game... (MAY BE NOT)
 # 11) Refactor class attributes that have to be private -> _whatever
 # 14) Add a logger to the whole game
@@ -21,90 +32,351 @@ from loader import MuteableSound
 #   - https://gist.github.com/iminurnamez/8d51f5b40032f106a847
 #   - https://python-3-patterns-idioms-test.readthedocs.io/en/latest/StateMachine.html
 
+# Builds the states on demand: holds a factory per state name (callable(screen, resource_loader))
+# and constructs each state the first time it is looked up. States listed in prewarm_hints for
+# the current state can be built ahead of time with prewarm(), which the manager calls while
+# the game sits idle on a static state.
+class StateRegistry():
+
+    def __init__(self, screen, resource_loader, factories, prewarm_hints=None):
+        self._screen = screen
+        self._resource_loader = resource_loader
+        self._factories = factories
+        self._prewarm_hints = prewarm_hints or {}
+        self._states = {}
+        self.build_times = {}
+
+    def __getitem__(self, name):
+        state = self._states.get(name)
+        if state is None:
+            state = self._build(name)
+        return state
+
+    def __contains__(self, name):
+        return name in self._factories
+
+    def is_built(self, name):
+        return name in self._states
+
+    def _build(self, name):
+        start = time.perf_counter()
+        state = self._factories[name](self._screen, self._resource_loader)
+        self.build_times[name] = time.perf_counter() - start
+        self._states[name] = state
+        return state
+
+    # Builds the first not yet built state likely to follow current_state_name.
+    # Returns True if a state was built (there may be more pending)
+    def prewarm(self, current_state_name):
+        for name in self._prewarm_hints.get(current_state_name, ()):
+            if not self.is_built(name):
+                self._build(name)
+                return True
+        return False
+
+    def report(self):
+        lines = []
+        for name, build_time in self.build_times.items():
+            lines.append("  {:<24} {:8.2f} ms".format(name, 1000 * build_time))
+        pending = [name for name in self._factories if not self.is_built(name)]
+        if pending:
+            lines.append("  not built yet: {}".format(", ".join(pending)))
+        return "\n".join(lines)
+
 class GameStateManager():
 
-    def __init__(self, states, start_state, screen, caption='Game'):
+    # start_time: time.perf_counter() value taken at launch, used by the startup report
+    def __init__(self, states, start_state, screen, caption='Game', start_time=None):
         self.clock = pygame.time.Clock()
+        self.start_time = start_time
+        self._is_first_frame = True
         self.screen = screen
         self.caption = caption
         self.states = states
         self.current_state_name = start_state
         self.current_state = self.states[start_state]
         self.is_running = True
-        self.is_fps_counter_enabled = False
-        self._fps_counter = SimpleTextBox(650, 10, screen, text='60 fps', size=12)
+        self.has_focus = True
+        self.is_overlay_enabled = False
+        # Always recording, the overlay (F key) only shows it
+        self.profiler = FrameProfiler()
+        self._overlay = ProfilerOverlay(screen, self.profiler, screen.get_width() - 5, 5, self.clock)
+        self._set_trace_names()
 
         pygame.display.set_caption(self.caption)
 
-    def _update_fps_counter(self):
-        if self.is_fps_counter_enabled:
-            average_fps = self.clock.get_fps()
-            fps_str = "{0:.2f} fps".format(average_fps)
-            self._fps_counter.modify(newtext=fps_str)
-            self._fps_counter.update()
-
-    def _draw_fps_counter(self):
-        if self.is_fps_counter_enabled:
-            self._fps_counter.draw()
+    def _update_overlay(self):
+        if self.is_overlay_enabled:
+            self._overlay.update()
+
+    def _erase_overlay(self):
+        if self.is_overlay_enabled and self._overlay.drawn_rect:
+            return [self.current_state.erase(self._overlay.drawn_rect)]
+        return []
+
+    def _draw_overlay(self):
+        if self.is_overlay_enabled:
+            return [self._overlay.draw()]
+        return []
+
+    # Writes the frames in the profiler window to a CSV file (on the save writer thread).
+    # Returns its path, None if the write could not be queued (a failed write is reported)
+    def dump_profile(self):
+        csv_data = self.profiler.to_csv()
+        path = os.path.join(config.PROFILES_PATH, "frames_{}.csv".format(time.strftime("%Y%m%d_%H%M%S")))
+        def write_profile():
+            os.makedirs(config.PROFILES_PATH, exist_ok=True)
+            with open(path, 'w') as profile_file:
+                profile_file.write(csv_data)
+        def failed(error):
+            print("Error: can't write the profile {}: {}".format(path, error))
+        return path if SAVE_WRITER.submit(write_profile, on_error=failed) else None
+
+    # Exports the recorded trace to a Chrome trace JSON file (on the save writer thread).
+    # Returns its path, None if the write could not be queued (a failed write is reported)
+    def dump_trace(self):
+        trace = TRACER.to_chrome_trace()
+        path = os.path.join(config.TRACES_PATH, "trace_{}.json".format(time.strftime("%Y%m%d_%H%M%S")))
+        def write_trace():
+            os.makedirs(config.TRACES_PATH, exist_ok=True)
+            with open(path, 'w') as trace_file:
+                json.dump(trace, trace_file)
+        def failed(error):
+            print("Error: can't write the trace {}: {}".format(path, error))
+        return path if SAVE_WRITER.submit(write_trace, on_error=failed) else None
+
+    # T key: starts a new recording, or stops it and exports it
+    def toggle_trace(self):
+        if TRACER.enabled:
+            TRACER.disable()
+            return self.dump_trace()
+        TRACER.clear()
+        TRACER.enable()
+        return None
+
+    # Span names of the current state, built once per switch instead of every frame
+    def _set_trace_names(self):
+        self._update_span = self.current_state_name + '.update'
+        self._draw_span = self.current_state_name + '.draw'
 
     def switch_state(self):
         next_state_name = self.current_state.next_state
+        if TRACER.enabled:
+            TRACER.count('state_switches')
+            TRACER.instant('switch_state', args={'from': self.current_state_name, 'to': next_state_name})
         self.current_state.clean()
         self.current_state_name = next_state_name
-        self.current_state = self.states[self.current_state_name]
+        # Switches are rare, the name can be built even when not tracing
+        with TRACER.scope('build_' + next_state_name):
+            self.current_state = self.states[self.current_state_name]
+        self.current_state.startup()
+        self.current_state.invalidate()
+        self._set_trace_names()
+
+    def _handle_event(self, event):
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_f:
+            self.is_overlay_enabled = not self.is_overlay_enabled
+            if self.is_overlay_enabled:
+                self._overlay.rebuild()
+            self.current_state.invalidate()
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_d and self.is_overlay_enabled:
+            self.dump_profile()
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_t:
+            self.toggle_trace()
+        elif event.type == pygame.WINDOWFOCUSLOST:
+            self.has_focus = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            self.has_focus = True
+        elif event.type in (pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED):
+            # The window contents may be gone, the next frame can't be a partial update
+            self.current_state.invalidate()
+        self.current_state.get_event(event)
 
     def process_events(self):
         for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_f:
-                self.is_fps_counter_enabled = not self.is_fps_counter_enabled
-            self.current_state.get_event(event)
+            self._handle_event(event)
+        # Callbacks of the finished background writes (saves, replays...), whatever the state
+        if SAVE_WRITER.pending:
+            SAVE_WRITER.poll()
 
-    def update(self):
+    def update(self, dt):
         if self.current_state.is_quit:
             self.is_running = False
         elif self.current_state.is_done:
             self.switch_state()
 
-        self.current_state.update()
-        self._update_fps_counter()
-
-    def draw(self):
-        self.current_state.draw()
-        self._draw_fps_counter()
-
+        VOICES.new_tick()
+        with TRACER.scope(self._update_span, 'state'):
+            self.current_state.update(dt)
+
+    # Returns the list of screen areas that changed, or None when the whole screen has to be
+    # pushed to the display
+    def draw(self, alpha=1.0):
+        erased_rects = self._erase_overlay()
+        with TRACER.scope(self._draw_span, 'state'):
+            dirty_rects = self.current_state.draw(alpha)
+        overlay_rects = self._draw_overlay()
+        if dirty_rects is None:
+            return None
+        return erased_rects + dirty_rects + overlay_rects
+
+    def _display_update(self, dirty_rects):
+        if dirty_rects is None:
+            pygame.display.update()
+        elif dirty_rects:
+            pygame.display.update(dirty_rects)
+
+        if self._is_first_frame:
+            self._is_first_frame = False
+            if config.STARTUP_REPORT:
+                self._print_startup_report()
+
+    def _print_startup_report(self):
+        if self.start_time is not None:
+            print("Time to first frame: {:.2f} ms".format(1000 * (time.perf_counter() - self.start_time)))
+        if isinstance(self.states, StateRegistry):
+            print("State construction times:")
+            print(self.states.report())
+        print(VOICES.report())
+
+    # Idle time is used to build the states likely to come next, one per idle frame
+    def _prewarm_states(self):
+        if config.PREWARM_STATES and isinstance(self.states, StateRegistry):
+            return self.states.prewarm(self.current_state_name)
+        return False
+
+    # Idle frame for static states: sleeps until an event arrives (or the timeout expires,
+    # longer without focus), then updates and draws once. Nothing is pushed to the display
+    # unless a widget changed, and nothing is drawn at all while the window is minimized.
+    def _run_idle_frame(self):
+        if not pygame.display.get_active():
+            timeout = config.IDLE_HIDDEN_TIMEOUT
+        elif not self.has_focus:
+            timeout = config.IDLE_UNFOCUSED_TIMEOUT
+        else:
+            timeout = config.IDLE_TIMEOUT
+
+        # Don't sleep when the state is done (the switch happens at the start of the update) or
+        # while there are states left to prewarm (once the first frame is out)
+        if self.current_state.is_done or self.current_state.is_quit:
+            event = pygame.event.poll()
+        elif not self._is_first_frame and self._prewarm_states():
+            event = pygame.event.poll()
+        else:
+            event = pygame.event.wait(timeout)
+        self.profiler.begin_frame()
+        if event.type != pygame.NOEVENT:
+            self._handle_event(event)
+        self.process_events()
+        self.profiler.mark(EVENTS)
+
+        self.update(config.TIMESTEP)
+        self.profiler.mark(UPDATE)
+        if pygame.display.get_active():
+            self._update_overlay()
+            dirty_rects = self.draw()
+            self.profiler.mark(DRAW)
+            self._display_update(dirty_rects)
+            self.profiler.mark(DISPLAY)
+        self.profiler.end_frame()
+
+        # Restart the frame timer so the idle time is not simulated by the next busy frame
+        self.clock.tick()
+
+    # Fixed timestep loop: the states are updated in config.TIMESTEP increments, as many times
+    # as the elapsed real time requires, and the frame is rendered once per iteration,
+    # interpolating between the last two physics states with the leftover time.
+    # States flagged as IS_STATIC run in idle mode instead (see _run_idle_frame).
     def run(self):
+        accumulator = 0.0
         while self.is_running:
-            dt = self.clock.tick(config.FPS)
+            if self.current_state.IS_STATIC:
+                self._run_idle_frame()
+                accumulator = 0.0
+                continue
+
+            frame_time = self.clock.tick(config.FPS) / 1000.0
+            accumulator += min(frame_time, config.MAX_FRAME_TIME)
+            self.profiler.begin_frame()
             self.process_events()
-            self.update()
-            self.draw()
-            pygame.display.update()
+            self.profiler.mark(EVENTS)
+            updates = 0
+            while accumulator >= config.TIMESTEP and self.is_running:
+                self.update(config.TIMESTEP)
+                accumulator -= config.TIMESTEP
+                updates += 1
+            self.profiler.mark(UPDATE)
+            self._update_overlay()
+            dirty_rects = self.draw(accumulator / config.TIMESTEP)
+            self.profiler.mark(DRAW)
+            self._display_update(dirty_rects)
+            self.profiler.mark(DISPLAY)
+            self.profiler.end_frame(updates)
 
 class State():
     SHARED_DATA = {'GAME_DATA': {}, 'GAME_CONTROL': {'data_loaded': False}}
+    # Static states only change on user input, the manager runs them in idle mode
+    IS_STATIC = False
+
     def __init__(self):
         self.next_state = None
         self.is_done = False
         self.is_quit = False
+        self.needs_redraw = True
 
     def clean(self):
         self.is_done = False
         self.is_quit = False
         self.next_state = None
 
+    # Called every time the manager switches to the state
+    def startup(self):
+        pass
+
     def get_event(self, event):
         raise NotImplementedError
 
-    # TODO: This should be update(self, dt)
-    def update(self):
+    # dt: seconds of simulated time since the last update
+    def update(self, dt):
         raise NotImplementedError
 
+    # Next draw() repaints (and reports) the whole screen
+    def invalidate(self):
+        self.needs_redraw = True
+
+    # Restores the background of the given screen area, returns the area
+    def erase(self, rect):
+        self.screen.fill(pygame.Color('black'), rect)
+        return rect
+
+    # Dirty rect drawing for the widget-only screens: everything is painted after an
+    # invalidate() and only the widgets that changed afterwards
+    def _draw_widgets(self, widgets):
+        if self.needs_redraw:
+            self.screen.fill(pygame.Color('black'))
+            for widget in widgets:
+                widget.draw()
+            self.needs_redraw = False
+            return None
+
+        dirty_rects = []
+        for widget in widgets:
+            if widget.is_dirty:
+                if widget.drawn_rect:
+                    dirty_rects.append(self.erase(widget.drawn_rect))
+                dirty_rects.append(widget.draw())
+        return dirty_rects
+
+    # alpha: interpolation factor between the previous and the current physics state.
+    # Returns the list of changed screen areas, or None if the whole screen changed
     # TODO: This should be draw(self, screen)
-    def draw(self):
+    def draw(self, alpha=1.0):
         raise NotImplementedError
 
 class GameMainMenuState(State):
 
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -126,7 +398,7 @@ class GameMainMenuState(State):
             for button in self.buttons:
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -141,13 +413,13 @@ class GameMainMenuState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GameOptionsMenuState(State):
 
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -177,7 +449,7 @@ class GameOptionsMenuState(State):
             for button in self.buttons:
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -192,13 +464,13 @@ class GameOptionsMenuState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GamePauseMenuState(State):
 
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -224,7 +496,7 @@ class GamePauseMenuState(State):
                 # get_event() instead of update(), the changes are not applied until the next frame...
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -236,21 +508,20 @@ class GamePauseMenuState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GameCountdownState(State):
 
     TIME_IN_SECONDS = 3
+    BACKGROUND_ALPHA = 100
 
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
         self.screen_rect = self.screen.get_rect()
-        self.new_game_img = resource_loader.get_image('new_game_screenshot')
-        self.background = self.new_game_img
+        self.resource_loader = resource_loader
+        self.background = None
         self.title = 'Game starts in...'
         self.title_textbox = SimpleTextBox(self.screen_rect.centerx, 100, screen, text=self.title, size=60)
         self.number_3 = SimpleTextBox(self.screen_rect.centerx, 250, screen, text='3', size=72)
@@ -258,45 +529,46 @@ class GameCountdownState(State):
         self.number_1 = SimpleTextBox(self.screen_rect.centerx, 250, screen, text='1', size=72)
         self.numbers = [self.number_3, self.number_2, self.number_1]
         self.current_number = self.numbers[0]
-        self.counter = 0
+        self.elapsed = 0.0
+        self._last_index = -1
         self.cowntdown_sound = resource_loader.get_sound('countdown_beep')
         self.match_start_sound = resource_loader.get_sound('match_beep')
         self.is_bg_set = False
 
     def _set_pause_background(self):
         if not self.is_bg_set:
-            if config.PAUSED_GAME_IMG_STRING:
-                self.background = pygame.image.fromstring(config.PAUSED_GAME_IMG_STRING,
-                                                          (config.SCREEN_WIDTH,
-                                                           config.SCREEN_HEIGHT),
-                                                          'RGB')
+            if not PAUSED_GAME.is_empty:
+                self.background = PAUSED_GAME.dimmed(self.BACKGROUND_ALPHA)
+                self.is_bg_set = True
             else:
-                self.background = self.new_game_img
-            self.background.set_alpha(100)
-            self.is_bg_set = True
+                # Looked up every frame until it is decoded, the image may still be loading in
+                # the background (get_image() returns a placeholder meanwhile)
+                self.background = dim(self.resource_loader.get_image('new_game_screenshot'), self.BACKGROUND_ALPHA)
+                self.is_bg_set = self.resource_loader.is_ready('images', 'new_game_screenshot')
 
     def get_event(self, event):
         if event.type == pygame.QUIT:
             self.is_quit = True
 
-    def update(self):
+    def update(self, dt):
         self._set_pause_background()
 
-        if self.counter >= (self.TIME_IN_SECONDS * config.FPS):
-            self.counter = 0
+        if self.elapsed >= self.TIME_IN_SECONDS:
+            self.elapsed = 0.0
+            self._last_index = -1
             self.next_state = 'GAME_RUNNING_STATE'
             self.is_done = True
             self.is_bg_set = False
             self.match_start_sound.play()
         else:
-            last_index = (self.counter - 1)//config.FPS
-            current_index = self.counter//config.FPS
+            current_index = int(self.elapsed)
             self.current_number = self.numbers[current_index]
-            if current_index != last_index:
+            if current_index != self._last_index:
                 self.cowntdown_sound.play()
-            self.counter += 1
+                self._last_index = current_index
+            self.elapsed += dt
 
-    def draw(self):
+    def draw(self, alpha=1.0):
         self.screen.fill(pygame.Color('black'))
         self.screen.blit(self.background, (0, 0))
         self.title_textbox.draw()
@@ -310,42 +582,82 @@ class GameRunningState(State):
         super().__init__()
         self.screen = screen
         self.screen_rect = self.screen.get_rect()
+        # Serves are drawn from a per match RNG, seeded in _start_match()
+        self.rng = random.Random()
+        self.match_seed = None
+        self.recorder = None
+        # Hit, bounce and goal effects (None when disabled, without numpy or on a display that is
+        # not 32 bits)
+        self.particles = None
+        if config.PARTICLES and supports_particles(self.screen):
+            self.particles = ParticleSystem(self.screen_rect)
 
         self.player = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
                              2*config.BRICK_SIZE, self.screen_rect.centery,
                              config.PLAYER_SPEED, self.screen, InputController())
         self.ball = Ball(config.BRICK_SIZE, self.screen_rect.centerx,
-                         self.screen_rect.centery, 2, self.screen,
+                         self.screen_rect.centery, config.BALL_SPEED, self.screen,
                          bounce_sound=resource_loader.get_sound('ball_bounce_2'),
-                         hit_sound=resource_loader.get_sound('ball_hit'))
+                         hit_sound=resource_loader.get_sound('ball_hit'), rng=self.rng,
+                         effects=self.particles)
         self.enemy = Paddle(config.BRICK_SIZE, 3*config.BRICK_SIZE,
                             config.SCREEN_WIDTH - 2*config.BRICK_SIZE,
                             self.screen_rect.centery, config.ENEMY_SPEED,
-                            self.screen, AIController(self))
+                            self.screen, create_controller(self))
         self.entities = [self.ball, self.player, self.enemy]
         self.paddles = [self.player, self.enemy]
+        if config.SWEPT_COLLISIONS:
+            self.ball.colliders = self.paddles
 
         self.player_score = 0
         self.enemy_score = 0
         self.player_score_textbox = SimpleTextBox(self.screen_rect.centerx - 40, 36,
-                                                  self.screen, text=str(self.player_score))
+                                                  self.screen, text=str(self.player_score), glyphs=True)
         self.enemy_score_textbox = SimpleTextBox(self.screen_rect.centerx + 40, 36,
-                                                 self.screen, text=str(self.enemy_score))
+                                                 self.screen, text=str(self.enemy_score), glyphs=True)
         self.widgets = [self.player_score_textbox, self.enemy_score_textbox]
         self.score_point_sound = resource_loader.get_sound('score_point')
 
         self._init_static_elements()
+        self._start_match()
 
-    def _game_reset(self):
+    # Seeds the match RNG and puts the entities in their initial position, so a match can be
+    # played again from its seed and the paddle actions (see replay.py)
+    def _start_match(self):
+        self.match_seed = config.MATCH_SEED if config.MATCH_SEED is not None else new_seed()
+        self.rng.seed(self.match_seed)
         for entity in self.entities:
             entity.reset()
+        if self.particles is not None:
+            self.particles.clear()
+
+        self.recorder = None
+        if config.RECORD_REPLAYS:
+            self.recorder = ReplayRecorder(self.match_seed, config.TIMESTEP, config.BALL_SPEED,
+                                           self.MAXIMUM_SCORE, self.ball.colliders is not None)
+
+    # Written by the save writer thread, the frame loop never waits for the disk
+    def _finish_replay(self):
+        if self.recorder is not None:
+            replay = self.recorder.finish(self)
+            path = os.path.join(config.REPLAYS_PATH, "replay_{}{}".format(replay.seed, REPLAY_EXTENSION))
+            def save_replay():
+                os.makedirs(config.REPLAYS_PATH, exist_ok=True)
+                replay.save(path)
+            def failed(error):
+                print("Error: can't save the replay {}: {}".format(path, error))
+            SAVE_WRITER.submit(save_replay, on_error=failed)
+            self.recorder = None
+
+    def _game_reset(self):
+        self._start_match()
 
         self.player_score = 0
         self.enemy_score = 0
         self.player_score_textbox.modify(newtext=str(self.player_score))
         self.enemy_score_textbox.modify(newtext=str(self.enemy_score))
 
-        config.PAUSED_GAME_IMG_STRING = None
+        PAUSED_GAME.clear()
 
     def _update_game_data(self):
         self.SHARED_DATA['GAME_DATA'].update(
@@ -382,40 +694,60 @@ class GameRunningState(State):
 
         self.SHARED_DATA['GAME_CONTROL']['data_loaded'] = False
 
+    # The static elements are painted once into a background surface, which is also used to
+    # erase the moving elements when drawing only the dirty areas
     def _init_static_elements(self):
         self.middle_line = pygame.Surface([5, config.SCREEN_HEIGHT])
         self.middle_line.fill(pygame.Color('white'))
+        self.background = pygame.Surface(self.screen_rect.size)
+        self.background.fill(pygame.Color('black'))
+        self.background.blit(self.middle_line, (self.screen_rect.centerx, 0))
 
     def _draw_static_elements(self):
-        self.screen.blit(self.middle_line, (self.screen_rect.centerx, 0))
+        self.screen.blit(self.background, (0, 0))
+
+    def erase(self, rect):
+        self.screen.blit(self.background, rect, rect)
+        return rect
 
     def _get_screenshot(self):
-        screenshot_img_string = pygame.image.tostring(self.screen, 'RGB')
-        config.PAUSED_GAME_IMG_STRING = screenshot_img_string
+        PAUSED_GAME.capture(self.screen)
 
+    # With swept collisions the ball resolves its paddle hits while moving (Ball.update)
     def _check_collisions(self):
-        for entity in pygame.sprite.spritecollide(self.ball, self.paddles, dokill=False):
-            self.ball.process_collision(entity)
+        if self.ball.colliders is None:
+            TRACER.count('collision_checks')
+            for entity in pygame.sprite.spritecollide(self.ball, self.paddles, dokill=False):
+                self.ball.process_collision(entity)
 
     def _execute_game_logic(self):
-        if self.ball.rect.left < self.player.rect.left:
+        scorer = check_point(self.ball, self.player, self.enemy)
+        if scorer is not None:
+            TRACER.count('points')
+            TRACER.instant('point', args={'scorer': scorer} if TRACER.enabled else None)
+            if self.particles is not None:
+                self.particles.emit('goal', *self.screen_rect.clamp(self.ball.rect).center)
+        if scorer == 'enemy':
             self.enemy_score += 1
             self.enemy_score_textbox.modify(newtext=str(self.enemy_score))
             self.score_point_sound.play()
             self.ball.reset()
-        elif self.ball.rect.right > self.enemy.rect.right:
+        elif scorer == 'player':
             self.player_score += 1
             self.player_score_textbox.modify(newtext=str(self.player_score))
             self.score_point_sound.play()
             self.ball.reset()
 
-        if self.enemy_score >= self.MAXIMUM_SCORE:
+        winner = check_winner(self.player_score, self.enemy_score, self.MAXIMUM_SCORE)
+        if winner == 'enemy':
             self.next_state = 'GAME_LOSE_SCREEN_STATE'
             self.is_done = True
+            self._finish_replay()
             self._game_reset()
-        elif self.player_score >= self.MAXIMUM_SCORE:
+        elif winner == 'player':
             self.next_state = 'GAME_WIN_SCREEN_STATE'
             self.is_done = True
+            self._finish_replay()
             self._game_reset()
 
         self._check_collisions()
@@ -430,34 +762,77 @@ class GameRunningState(State):
         else:
             self.player.controller.handle_event(event)
 
-    def update(self):
+    def update(self, dt):
         if self.SHARED_DATA['GAME_CONTROL']['data_loaded']:
             self._load_game_data()
+            # A loaded match can't be played again from its seed
+            self.recorder = None
 
-        self._execute_game_logic()
+        with TRACER.scope('game_logic'):
+            self._execute_game_logic()
 
         self.enemy.controller.update()
+        if self.recorder is not None:
+            if dt == self.recorder.replay.timestep:
+                self.recorder.record(self.player.controller.action, self.enemy.controller.action)
+            else:
+                self.recorder = None
 
-        for entity in self.entities:
-            entity.update()
+        with TRACER.scope('entities_update'):
+            for entity in self.entities:
+                entity.update(dt)
+        if self.particles is not None:
+            with TRACER.scope('particles_update'):
+                self.particles.update(dt)
 
         for widget in self.widgets:
             widget.update()
 
         self._update_game_data()
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        self._draw_static_elements()
-
+    def draw(self, alpha=1.0):
+        if self.needs_redraw:
+            self._draw_static_elements()
+            if self.particles is not None:
+                self.particles.draw(self.screen)
+            for entity in self.entities:
+                entity.draw(alpha)
+            for widget in self.widgets:
+                widget.draw()
+            self.needs_redraw = False
+            return None
+
+        # Erase everything that moves or changed before drawing anything, so an erased area
+        # never wipes an element already drawn in this frame
+        erased_rects = []
         for entity in self.entities:
-            entity.draw()
-
+            if entity.drawn_rect:
+                erased_rects.append(self.erase(entity.drawn_rect))
+        for widget in self.widgets:
+            if widget.is_dirty and widget.drawn_rect:
+                erased_rects.append(self.erase(widget.drawn_rect))
+        if self.particles is not None and self.particles.drawn_rect:
+            erased_rects.append(self.erase(self.particles.drawn_rect))
+
+        # Particles under the entities, the ball stays readable
+        dirty_rects = erased_rects
+        if self.particles is not None:
+            particles_rect = self.particles.draw(self.screen)
+            if particles_rect:
+                dirty_rects.append(particles_rect)
+        dirty_rects += [entity.draw(alpha) for entity in self.entities]
+
+        # Widgets go on top of the entities, as in a full redraw
         for widget in self.widgets:
-            widget.draw()
+            if widget.is_dirty or widget.drawn_rect.collidelist(dirty_rects) != -1:
+                dirty_rects.append(widget.draw())
+
+        return dirty_rects
 
 class GameLoseScreenState(State):
 
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -480,7 +855,7 @@ class GameLoseScreenState(State):
             for button in self.buttons:
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -492,13 +867,13 @@ class GameLoseScreenState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GameWinScreenState(State):
 
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -521,7 +896,7 @@ class GameWinScreenState(State):
             for button in self.buttons:
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -533,12 +908,13 @@ class GameWinScreenState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GameSaveMenuState(State):
+
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -551,6 +927,10 @@ class GameSaveMenuState(State):
         self.buttons = [self.confirm_button, self.storage_slot_0]
         self.buttons_map = {0: "PAUSE_MENU_STATE", 1: "STAY"}
 
+    # The slot may have been saved from elsewhere since the menu was last shown
+    def startup(self):
+        self.storage_slot_0.refresh()
+
     def get_event(self, event):
         if event.type == pygame.QUIT:
             self.is_quit = True
@@ -561,7 +941,8 @@ class GameSaveMenuState(State):
     def _save_game(self):
         self.storage_slot_0.save_game(self.SHARED_DATA)
 
-    def update(self):
+    # Finished saves are polled by the manager (the writer posts an event to wake up the idle loop)
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -574,12 +955,13 @@ class GameSaveMenuState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
 
 class GameLoadMenuState(State):
+
+    IS_STATIC = True
+
     def __init__(self, screen, resource_loader):
         super().__init__()
         self.screen = screen
@@ -592,8 +974,13 @@ class GameLoadMenuState(State):
         self.buttons = [self.confirm_button, self.storage_slot_0]
         self.buttons_map = {0: "MAIN_MENU_STATE", 1: "STAY"}
 
+    def startup(self):
+        self.storage_slot_0.refresh()
+
     def _load_game(self):
         loaded_data = self.storage_slot_0.load_game()
+        if loaded_data is None:
+            return
         self.SHARED_DATA.update(loaded_data)
         self.SHARED_DATA['GAME_CONTROL']['data_loaded'] = True
 
@@ -604,7 +991,7 @@ class GameLoadMenuState(State):
             for button in self.buttons:
                 button.update(event)
 
-    def update(self):
+    def update(self, dt):
         self.title_textbox.update()
 
         for idx, button in enumerate(self.buttons):
@@ -617,7 +1004,5 @@ class GameLoadMenuState(State):
             else:
                 self.next_state = None
 
-    def draw(self):
-        self.screen.fill(pygame.Color('black'))
-        for widget in self.widgets:
-            widget.draw()
+    def draw(self, alpha=1.0):
+        return self._draw_widgets(self.widgets)
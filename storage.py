@@ -1,8 +1,14 @@
 import os
+import copy
 import json
+import queue
 import datetime
+import threading
 import pygame
 import config
+import savefile
+from snapshot import PAUSED_GAME
+from instrument import TRACER
 from widgets import SimpleButton
 
 # TODO:
@@ -11,84 +17,362 @@ from widgets import SimpleButton
 #       - May be this can be just a couple of functions create_folder/check_files/save/load
 #       - file and screenshot filenames can be removed, duplicated info ----> Check this out
 
+# In-memory view of the storage folder shared by every StorageSlot (save and load menus).
+# The folder is only listed again when its mtime changed since the last scan, and a slot's
+# metadata and thumbnails are only read again when its files changed. Every change bumps
+# `generation`, so the slots can tell they are out of date with a single comparison.
+class StorageIndex():
+
+    def __init__(self, root_path):
+        self._root_path = root_path
+        self._mtime = None
+        self._slots = {}
+        self.generation = 0
+
+    def _create_storage_folder(self):
+        if not os.path.isdir(self._root_path):
+            os.mkdir(self._root_path)
+
+    @staticmethod
+    def _slot_prefixes(slot_id):
+        return "_".join(["slot", slot_id, "data"]), "_".join(["slot", slot_id, "screenshot"])
+
+    def _read_entry(self, data_filename, screenshot_filename):
+        data_file = os.path.join(self._root_path, data_filename)
+        if data_filename.endswith(savefile.EXTENSION):
+            try:
+                save = savefile.read(data_file, screenshot=False)
+            except (savefile.SaveFileError, OSError, ValueError):
+                return None
+            thumbnail = save['thumbnail']
+            if pygame.display.get_surface():
+                thumbnail = thumbnail.convert()
+            metadata, screenshot_file, thumbnails = save['metadata'], None, {thumbnail.get_size(): thumbnail}
+        else:
+            with open(data_file, 'r') as loadfile:
+                metadata = json.load(loadfile)['metadata']
+            screenshot_file = os.path.join(self._root_path, screenshot_filename) if screenshot_filename else None
+            thumbnails = {}
+        return {
+            'metadata': metadata,
+            'data_filename': data_filename,
+            'data_file': data_file,
+            'screenshot_filename': screenshot_filename,
+            'screenshot_file': screenshot_file,
+            'thumbnails': thumbnails
+        }
+
+    def _scan(self):
+        TRACER.count('storage_scans')
+        filenames = [filename for filename in os.listdir(self._root_path) if not filename.endswith('.tmp')]
+        slot_ids = {filename.split('_')[1] for filename in filenames
+                    if filename.startswith('slot_') and filename.count('_') >= 2}
+        for slot_id in slot_ids | set(self._slots):
+            data_prefix, screenshot_prefix = self._slot_prefixes(slot_id)
+            # A binary save wins over a legacy JSON/PNG pair left behind
+            data_filenames = sorted((f for f in filenames if f.startswith(data_prefix)),
+                                    key=lambda f: (f.endswith(savefile.EXTENSION), f))
+            data_filename = data_filenames[-1] if data_filenames else None
+            screenshot_filename = None
+            if data_filename is not None and not data_filename.endswith(savefile.EXTENSION):
+                screenshot_filename = next((f for f in filenames if f.startswith(screenshot_prefix)), None)
+
+            entry = self._slots.get(slot_id)
+            if entry is not None and (entry['data_filename'], entry['screenshot_filename']) == (data_filename, screenshot_filename):
+                continue
+            entry = self._read_entry(data_filename, screenshot_filename) if data_filename is not None else None
+            if entry is None:
+                self._slots.pop(slot_id, None)
+            else:
+                self._slots[slot_id] = entry
+            self.generation += 1
+
+    # Stats the folder and rescans it if it changed, force: rescan anyway
+    def refresh(self, force=False):
+        self._create_storage_folder()
+        mtime = os.stat(self._root_path).st_mtime_ns
+        if force or mtime != self._mtime:
+            self._mtime = mtime
+            self._scan()
+        return self.generation
+
+    # Drops everything, the next refresh() reads the folder again
+    def invalidate(self):
+        self._mtime = None
+        self._slots.clear()
+        self.generation += 1
+
+    def get_entry(self, slot_id):
+        return self._slots.get(str(slot_id))
+
+    def get_metadata(self, slot_id):
+        entry = self.get_entry(slot_id)
+        return entry['metadata'] if entry is not None else None
+
+    # Scaled once per size, from the legacy screenshot or the thumbnail of the save file
+    def get_thumbnail(self, slot_id, size):
+        entry = self.get_entry(slot_id)
+        if entry is None:
+            return None
+        thumbnails = entry['thumbnails']
+        thumbnail = thumbnails.get(size)
+        if thumbnail is None:
+            if entry['screenshot_file'] is not None:
+                source = pygame.image.load(entry['screenshot_file']).convert()
+            elif thumbnails:
+                source = max(thumbnails.values(), key=lambda image: image.get_width())
+            else:
+                return None
+            thumbnail = pygame.transform.scale(source, size)
+            thumbnails[size] = thumbnail
+        return thumbnail
+
+    # Registers the files just written for a slot, no need to read them back
+    def record_save(self, slot_id, metadata, data_file, screenshot_file=None, thumbnails=None):
+        self._slots[str(slot_id)] = {
+            'metadata': dict(metadata),
+            'data_filename': os.path.basename(data_file),
+            'data_file': data_file,
+            'screenshot_filename': os.path.basename(screenshot_file) if screenshot_file else None,
+            'screenshot_file': screenshot_file,
+            'thumbnails': dict(thumbnails or {})
+        }
+        self._mtime = os.stat(self._root_path).st_mtime_ns
+        self.generation += 1
+
+    # Safe to call from the writer thread, it does not touch the index
+    def remove_slot_files(self, slot_id, keep=()):
+        data_prefix, screenshot_prefix = self._slot_prefixes(str(slot_id))
+        for filename in os.listdir(self._root_path):
+            if filename in keep or filename.endswith('.tmp'):
+                continue
+            if filename.startswith(data_prefix) or filename.startswith(screenshot_prefix):
+                os.remove(os.path.join(self._root_path, filename))
+
+STORAGE_INDEX = StorageIndex(config.STORAGE_BASE_PATH)
+
+# Posted when the writer finishes a save, wakes up the idle menu loop to run the callbacks
+SAVE_COMPLETED = pygame.event.custom_type()
+
+class SaveError(Exception):
+    pass
+
+# What reading a slot raises when its files are damaged: a bad save file, a missing or unreadable
+# file, and for the old JSON + PNG saves, bad JSON (ValueError), missing fields or a bad PNG
+LOAD_ERRORS = (savefile.SaveFileError, OSError, ValueError, KeyError, pygame.error)
+
+# The file only appears under its final name once it is complete
+def write_atomic(path, write):
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            write(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Runs the save jobs on a background thread so disk writes never block the frame loop.
+# At most max_pending saves can wait, submit() fails right away beyond that. The callbacks
+# are never called from the writer thread: poll() runs them on the calling (main) thread.
+class SaveWriter():
+
+    def __init__(self, max_pending=config.SAVE_QUEUE_SIZE):
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._results = queue.Queue()
+        self._thread = None
+        self.pending = 0
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='SaveWriter', daemon=True)
+            self._thread.start()
+
+    # job: callable run on the writer thread, its result is passed to on_done(result) and
+    # the exception it raised, if any, to on_error(error). Returns False if the queue is full
+    def submit(self, job, on_done=None, on_error=None):
+        self._start()
+        try:
+            self._jobs.put_nowait((job, on_done, on_error))
+        except queue.Full:
+            if on_error:
+                on_error(SaveError("Too many saves pending"))
+            return False
+        self.pending += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                break
+            job, on_done, on_error = item
+            try:
+                result, error = job(), None
+            except Exception as e:
+                result, error = None, e
+            self._results.put((on_done, on_error, result, error))
+            try:
+                pygame.event.post(pygame.event.Event(SAVE_COMPLETED))
+            except pygame.error:
+                pass
+
+    # Runs the callbacks of the finished saves
+    def poll(self):
+        while True:
+            try:
+                on_done, on_error, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if error is None:
+                if on_done:
+                    on_done(result)
+            elif on_error:
+                on_error(error)
+
+    # Waits for the pending saves and stops the thread
+    def close(self, timeout=None):
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+        self.poll()
+
+SAVE_WRITER = SaveWriter()
+
+# Writer thread side of StorageSlot.save_game(): plain data and snapshot surfaces, which are
+# never modified once published (see snapshot.Snapshot), so they are only read here
+def _write_slot(index, root_path, slot_id, storage_data, screenshot, thumbnail, strdate, strtime):
+    data_filename = "_".join(["slot", slot_id, "data", strdate, strtime]) + savefile.EXTENSION
+    data_file = os.path.join(root_path, data_filename)
+
+    with TRACER.scope('encode_save', 'storage'):
+        file_data = savefile.encode(storage_data['metadata'], storage_data['data']['GAME_DATA'],
+                                    (pygame.image.tostring(thumbnail, 'RGB'), thumbnail.get_size()),
+                                    (pygame.image.tostring(screenshot, 'RGB'), screenshot.get_size()))
+    with TRACER.scope('write_save', 'storage', {'bytes': len(file_data)}):
+        write_atomic(data_file, lambda f: f.write(file_data))
+    index.remove_slot_files(slot_id, keep=(data_filename,))
+
+    return data_file
+
 class StorageSlot(SimpleButton):
 
-    def __init__(self, slot_id, x, y, width, height, screen, **kwargs):
+    def __init__(self, slot_id, x, y, width, height, screen, index=None, writer=None, **kwargs):
         super().__init__(x, y, width, height, screen, **kwargs)
         self._id = str(slot_id)
+        self._index = index if index is not None else STORAGE_INDEX
+        self._writer = writer if writer is not None else SAVE_WRITER
+        self._generation = None
         self._metadata = {}
         self._file = None
-        self._filename = None
         self._screenshot_file = None
-        self._screenshot_filename = None
-        self._create_storage_folder()
-        self._check_saved_files()
+        self._empty_image = self._still_image
+        self.is_saving = False
+        self.refresh()
 
-    def _create_storage_folder(self):
-        if not os.path.isdir(config.STORAGE_BASE_PATH):
-            os.mkdir(config.STORAGE_BASE_PATH)
-
-    def _check_saved_files(self):
-        slot_file_data = "_".join(["slot", self._id, "data"])
-        slot_file_screenshot = "_".join(["slot", self._id, "screenshot"])
-        for filename in os.listdir(config.STORAGE_BASE_PATH):
-            if filename.startswith(slot_file_data) and filename != self._filename:
-                self._filename = filename
-                self._file = "\\".join([config.STORAGE_BASE_PATH, filename])
-                with open(self._file, 'r') as loadfile:
-                    storage_data = json.load(loadfile)
-                    self._metadata = storage_data['metadata']
-                self.textbox.modify(newtext=self._metadata['timestamp'])
-            elif filename.startswith(slot_file_screenshot) and filename != self._screenshot_filename:
-                self._screenshot_filename = filename
-                self._screenshot_file = "\\".join([config.STORAGE_BASE_PATH, filename])
-                screenshot = pygame.image.load(self._screenshot_file).convert()
-                self._still_image = pygame.transform.scale(screenshot, (self._width, self._height))
-
-    def _remove_last_saved_file(self):
-        slot_file_data = "_".join(["slot", self._id, "data"])
-        slot_file_screenshot = "_".join(["slot", self._id, "screenshot"])
-        for filename in os.listdir(config.STORAGE_BASE_PATH):
-            if filename.startswith(slot_file_data) or filename.startswith(slot_file_screenshot):
-                filepath = "\\".join([config.STORAGE_BASE_PATH, filename])
-                os.remove(filepath)
-
-    def save_game(self, data):
+    # Checks the storage folder for changes (a stat), meant for when the slot is shown again
+    def refresh(self):
+        self._writer.poll()
+        self._index.refresh()
+        self._sync()
+
+    # Picks up the index changes, nothing is read from disk unless the slot changed
+    def _sync(self):
+        if self._generation == self._index.generation:
+            return
+        self._generation = self._index.generation
+        entry = self._index.get_entry(self._id)
+        if entry is None:
+            self._metadata = {}
+            self._file = None
+            self._screenshot_file = None
+            self._still_image = self._empty_image
+            if self._text:
+                self.textbox.modify(newtext=self._text)
+        else:
+            self._metadata = dict(entry['metadata'])
+            self._file = entry['data_file']
+            self._screenshot_file = entry['screenshot_file']
+            thumbnail = self._index.get_thumbnail(self._id, (self._width, self._height))
+            self._still_image = thumbnail if thumbnail is not None else self._empty_image
+            self.textbox.modify(newtext=self._metadata['timestamp'])
+        if not self.is_hovered:
+            self.image = self._still_image
+
+    # Queues the save and returns right away (False if it could not be queued). The files are
+    # written by the SaveWriter thread; on_done() or on_error(error) are called from poll()
+    def save_game(self, data, on_done=None, on_error=None):
         # TODO: Ask if the user is sure of the operation??
-        self._remove_last_saved_file()
+        if self.is_saving:
+            return False
 
         date = datetime.datetime.now()
         strdate = date.strftime("%d-%m-%Y")
         strtime = date.strftime("%H-%M-%S")
-        self._metadata['timestamp'] = " ".join([strdate, strtime])
-
-        self._filename = "_".join(["slot", self._id, "data", strdate, strtime])
-        self._file = "".join([config.STORAGE_BASE_PATH, "\\", self._filename, ".json"])
+        metadata = dict(self._metadata, timestamp=" ".join([strdate, strtime]))
+        storage_data = {'metadata': metadata, 'data': copy.deepcopy(data)}
 
-        # FIXME: Use the resource loader instead? Or better, just pass the image as a parameter to this method
-        self._screenshot_filename = "_".join(["slot", self._id, "screenshot", strdate, strtime])
-        self._screenshot_file = "".join([config.STORAGE_BASE_PATH, "\\", self._screenshot_filename, ".png"])
-        screenshot = pygame.image.frombuffer(config.PAUSED_GAME_IMG_STRING, (config.SCREEN_WIDTH, config.SCREEN_HEIGHT), 'RGB').convert()
-        pygame.image.save(screenshot, self._screenshot_file)
+        if PAUSED_GAME.is_empty:
+            if on_error:
+                on_error(SaveError("There is no paused game to save"))
+            return False
+        screenshot = PAUSED_GAME.get()
+        thumbnail = PAUSED_GAME.thumbnail((self._width, self._height))
+        job = lambda: _write_slot(self._index, config.STORAGE_BASE_PATH, self._id, storage_data,
+                                  screenshot, thumbnail, strdate, strtime)
 
-        self._still_image = pygame.transform.scale(screenshot, (self._width, self._height))
-        self.textbox.modify(newtext=self._metadata['timestamp'])
+        def saved(data_file):
+            TRACER.instant('save_completed', 'storage')
+            self.is_saving = False
+            self._index.record_save(self._id, metadata, data_file,
+                                    thumbnails={(self._width, self._height): thumbnail})
+            self._sync()
+            if on_done:
+                on_done()
 
-        storage_data = {'metadata': self._metadata, 'data': data}
+        def failed(error):
+            TRACER.count('save_errors')
+            self.is_saving = False
+            self.textbox.modify(newtext="Save failed")
+            if on_error:
+                on_error(error)
 
-        with open(self._file, 'w') as savefile:
-            json.dump(storage_data, savefile, indent=4)
+        self.is_saving = True
+        self.textbox.modify(newtext="Saving...")
+        TRACER.count('saves')
+        TRACER.instant('save_submitted', 'storage')
+        return self._writer.submit(job, saved, failed)
 
+    # Returns the saved game data, None for a free slot or if the files could not be read
+    # (missing, corrupted, old save damaged): the slot then shows "Load failed" and the paused
+    # game is left as it was
     def load_game(self):
-        with open(self._file, 'r') as loadfile:
-            storage_data = json.load(loadfile)
+        if self._file is None:
+            return None
+        TRACER.count('loads')
+        with TRACER.scope('load_save', 'storage'):
+            try:
+                if self._screenshot_file is None:
+                    save = savefile.read(self._file)
+                else:
+                    save = savefile.read_legacy(self._file, self._screenshot_file)
+            except LOAD_ERRORS as error:
+                print("Error: can't load the save {}: {}".format(self._file, error))
+                TRACER.count('load_errors')
+                self.textbox.modify(newtext="Load failed")
+                return None
         self.textbox.modify(newtext="Loaded")
-        screenshot = pygame.image.load(self._screenshot_file).convert()
-        screenshot_img_string = pygame.image.tostring(screenshot, 'RGB')
-        config.PAUSED_GAME_IMG_STRING = screenshot_img_string
+        PAUSED_GAME.set(save['screenshot'])
+        if save['thumbnail'] is not None:
+            PAUSED_GAME.add_thumbnail(save['thumbnail'])
 
-        return storage_data['data']
+        return save['data']
 
     def update(self, event):
-        self._check_saved_files()
+        self._sync()
         super().update(event)
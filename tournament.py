@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import config
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from ai import create_controller
+from simulation import HeadlessMatch
+from storage import write_atomic
+
+# AI vs AI tournaments to tune the controllers and the game parameters. A tournament is a set
+# of matchups played `matches` times each:
+#
+#   {"seed": 1, "matches": 2000, "matchups": {
+#       "simple_vs_predictive": {"left": "simple", "right": "predictive",
+#                                "right_options": {"reaction_delay": 6, "error": 10}},
+#       "fast_enemy": {"config": {"ENEMY_SPEED": 4}},
+#       "steep_bounces": {"config": {"MAX_BOUNCING_ANGLE": 1.4}, "ball_speed": 3}}}
+#
+#   left/right: ai.CONTROLLERS name ('simple' by default), *_options: its keyword arguments
+#   config: config values set while the matchup is played (the ones HeadlessMatch and the
+#   controllers take as keyword defaults, e.g. SWEPT_COLLISIONS or AI_ERROR, are passed to
+#   them explicitly), ball_speed: HeadlessMatch ball speed
+#
+# Every match has its own seed (from the tournament seed, the matchup and the match index), so
+# a tournament always gives the same results, however it is split. The matches are played in
+# chunks of config.TOURNAMENT_CHUNK on a process pool; a chunk comes back as one partial
+# aggregate (wins, score differences, rally length histogram) and partial aggregates simply add
+# up. The checkpoint file holds the aggregates and the chunks done, a run started again with
+# the same checkpoint only plays the chunks left.
+#
+# python tournament.py SPEC.json [--checkpoint PATH] [--workers N] [--json]
+# (no SPEC: a small built-in tournament)
+
+DEFAULT_SPEC = {'seed': 1, 'matches': 40,
+                'matchups': {'simple_vs_simple': {},
+                             'simple_vs_predictive': {'right': 'predictive'},
+                             'fast_enemy': {'config': {'ENEMY_SPEED': 4}},
+                             'fast_ball': {'ball_speed': 3}}}
+Z_95 = 1.959964
+
+def default_workers():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def match_seed(tournament_seed, matchup_name, index):
+    return (tournament_seed * 1000003 + zlib.crc32(matchup_name.encode()) * 1000000007 + index) % 2**63
+
+def new_aggregate():
+    return {'matches': 0, 'left_wins': 0, 'ticks': 0, 'diff_sum': 0, 'diff_squares': 0, 'rallies': {}}
+
+def merge(aggregate, partial):
+    for key in ('matches', 'left_wins', 'ticks', 'diff_sum', 'diff_squares'):
+        aggregate[key] += partial[key]
+    rallies = aggregate['rallies']
+    for length, count in partial['rallies'].items():
+        rallies[length] = rallies.get(length, 0) + count
+    return aggregate
+
+def _controller_factory(matchup, side, seed):
+    name = matchup.get(side, 'simple')
+    options = dict(matchup.get(side + '_options', {}))
+    if name == 'predictive':
+        # Seeded too, the aiming error is random
+        options.setdefault('rng', random.Random(2 * seed + (side == 'right')))
+        # Keyword defaults are read from config at import time, the overrides wouldn't reach them
+        options.setdefault('reaction_delay', config.AI_REACTION_DELAY)
+        options.setdefault('error', config.AI_ERROR)
+    return lambda game: create_controller(game, name, side=side, **options)
+
+# Runs in the worker processes: plays matches [first, first + count) of the matchup
+def play_chunk(tournament_seed, matchup_name, matchup, chunk, first, count):
+    overrides = matchup.get('config', {})
+    previous = {}
+    for name, value in overrides.items():
+        if not hasattr(config, name):
+            raise KeyError("Unknown config value {}".format(name))
+        previous[name] = getattr(config, name)
+        setattr(config, name, value)
+
+    partial = new_aggregate()
+    rallies = partial['rallies']
+    try:
+        for index in range(first, first + count):
+            seed = match_seed(tournament_seed, matchup_name, index)
+            # Same for the HeadlessMatch defaults, everything config gives is passed explicitly
+            match = HeadlessMatch(_controller_factory(matchup, 'left', seed), _controller_factory(matchup, 'right', seed),
+                                  ball_speed=matchup.get('ball_speed', config.BALL_SPEED),
+                                  swept=config.SWEPT_COLLISIONS, seed=seed)
+            result = match.run()
+            diff = result.player_score - result.enemy_score
+            partial['matches'] += 1
+            partial['left_wins'] += result.winner == 'player'
+            partial['ticks'] += result.ticks
+            partial['diff_sum'] += diff
+            partial['diff_squares'] += diff * diff
+            for length in result.rally_lengths:
+                # str keys, the aggregates go through JSON
+                rallies[str(length)] = rallies.get(str(length), 0) + 1
+    finally:
+        for name, value in previous.items():
+            setattr(config, name, value)
+    return matchup_name, chunk, partial
+
+def _spec_digest(spec):
+    return "{:08x}".format(zlib.crc32(json.dumps(spec, sort_keys=True).encode()))
+
+class Tournament():
+
+    def __init__(self, spec, checkpoint_path=None, chunk_size=config.TOURNAMENT_CHUNK):
+        self.spec = spec
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = chunk_size
+        self.aggregates = {name: new_aggregate() for name in spec['matchups']}
+        self.done = {name: set() for name in spec['matchups']}
+        if checkpoint_path and os.path.isfile(checkpoint_path):
+            self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint['spec'] != _spec_digest(self.spec) or checkpoint['chunk_size'] != self.chunk_size:
+            raise ValueError("{} belongs to another tournament".format(self.checkpoint_path))
+        self.aggregates = checkpoint['aggregates']
+        self.done = {name: set(chunks) for name, chunks in checkpoint['done'].items()}
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        checkpoint = {'spec': _spec_digest(self.spec), 'chunk_size': self.chunk_size,
+                      'aggregates': self.aggregates,
+                      'done': {name: sorted(chunks) for name, chunks in self.done.items()}}
+        data = json.dumps(checkpoint).encode()
+        write_atomic(self.checkpoint_path, lambda checkpoint_file: checkpoint_file.write(data))
+
+    # (matchup name, chunk index, first match, count) of the chunks not played yet
+    def pending_chunks(self):
+        matches = self.spec['matches']
+        for name in self.spec['matchups']:
+            for chunk, first in enumerate(range(0, matches, self.chunk_size)):
+                if chunk not in self.done[name]:
+                    yield name, chunk, first, min(self.chunk_size, matches - first)
+
+    def _record(self, matchup_name, chunk, partial):
+        merge(self.aggregates[matchup_name], partial)
+        self.done[matchup_name].add(chunk)
+
+    # Keeps at most 2 chunks per worker in flight, checkpoints every
+    # config.TOURNAMENT_CHECKPOINT_INTERVAL seconds, on interruption and at the end
+    def run(self, workers=None, progress=None):
+        workers = workers or default_workers()
+        chunks = list(self.pending_chunks())
+        total = len(chunks)
+        chunks = iter(chunks)
+        finished = 0
+        last_checkpoint = time.perf_counter()
+        seed = self.spec['seed']
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            try:
+                while True:
+                    for name, chunk, first, count in chunks:
+                        pending.add(executor.submit(play_chunk, seed, name, self.spec['matchups'][name],
+                                                    chunk, first, count))
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        self._record(*future.result())
+                        finished += 1
+                    if progress:
+                        progress(finished, total)
+                    if time.perf_counter() - last_checkpoint > config.TOURNAMENT_CHECKPOINT_INTERVAL:
+                        self.save_checkpoint()
+                        last_checkpoint = time.perf_counter()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+            finally:
+                self.save_checkpoint()
+        return self.summary()
+
+    def summary(self):
+        return {name: summarize(aggregate) for name, aggregate in self.aggregates.items()}
+
+# Wilson score interval of a proportion
+def wilson_interval(successes, trials, z=Z_95):
+    if not trials:
+        return 0.0, 1.0
+    rate = successes / trials
+    denominator = 1 + z * z / trials
+    center = (rate + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials)) / denominator
+    return center - margin, center + margin
+
+def histogram_percentile(histogram, percent):
+    total = sum(histogram.values())
+    if not total:
+        return 0
+    target = percent / 100 * total
+    seen = 0
+    for length in sorted(histogram, key=int):
+        seen += histogram[length]
+        if seen >= target:
+            return int(length)
+    return int(max(histogram, key=int))
+
+def summarize(aggregate):
+    matches = aggregate['matches']
+    rallies = aggregate['rallies']
+    rally_count = sum(rallies.values())
+    summary = {'matches': matches,
+               'left_win_rate': aggregate['left_wins'] / matches if matches else 0.0,
+               'left_win_rate_ci': wilson_interval(aggregate['left_wins'], matches),
+               'ticks_per_match': aggregate['ticks'] / matches if matches else 0.0,
+               'rally_mean': sum(int(length) * count for length, count in rallies.items()) / rally_count if rally_count else 0.0,
+               'rally_p50': histogram_percentile(rallies, 50),
+               'rally_p90': histogram_percentile(rallies, 90),
+               'rally_max': max((int(length) for length in rallies), default=0)}
+    mean = aggregate['diff_sum'] / matches if matches else 0.0
+    variance = aggregate['diff_squares'] / matches - mean * mean if matches else 0.0
+    margin = Z_95 * math.sqrt(max(variance, 0.0) / matches) if matches else 0.0
+    summary['score_diff'] = mean
+    summary['score_diff_ci'] = (mean - margin, mean + margin)
+    return summary
+
+def print_summary(summary):
+    print("{:<24} {:>8} {:>22} {:>24} {:>18} {:>10}".format('matchup', 'matches', 'left wins (95% CI)',
+                                                          'score diff (95% CI)', 'rally mean/p50/p90', 'ticks'))
+    for name, result in summary.items():
+        low, high = result['left_win_rate_ci']
+        diff_low, diff_high = result['score_diff_ci']
+        print("{:<24} {:>8} {:>6.1%} [{:>5.1%}, {:>5.1%}] {:>+7.2f} [{:>+6.2f}, {:>+6.2f}] {:>10.2f}/{:>3}/{:>3} {:>10.0f}".format(
+            name, result['matches'], result['left_win_rate'], low, high, result['score_diff'], diff_low, diff_high,
+            result['rally_mean'], result['rally_p50'], result['rally_p90'], result['ticks_per_match']))
+
+def _argument(name, default, cast=str):
+    if name in sys.argv:
+        return cast(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+if __name__ == '__main__':
+    spec_path = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('--') else None
+    if spec_path:
+        with open(spec_path, 'r') as spec_file:
+            spec = json.load(spec_file)
+    else:
+        spec = DEFAULT_SPEC
+    checkpoint_path = _argument('--checkpoint', spec_path + '.checkpoint' if spec_path else None)
+    workers = _argument('--workers', None, int)
+
+    tournament = Tournament(spec, checkpoint_path)
+    def progress(finished, total):
+        print("\r{}/{} chunks".format(finished, total), end='', flush=True)
+    start = time.perf_counter()
+    try:
+        summary = tournament.run(workers, progress)
+    except KeyboardInterrupt:
+        print("\nInterrupted, progress saved to {}".format(checkpoint_path))
+        sys.exit(1)
+    print("\nDone in {:.1f} s".format(time.perf_counter() - start))
+    if '--json' in sys.argv:
+        print(json.dumps(summary, indent=4))
+    else:
+        print_summary(summary)
@@ -0,0 +1,115 @@
+import time
+import config
+import pygame
+from instrument import TRACER
+
+# Voice manager: every MuteableSound play goes through VOICES, which decides whether the sound
+# is heard and on which mixer channel, instead of letting Sound.play() grab (or fail to grab)
+# any free channel.
+#   - dedupe: a sound triggered several times within one physics tick plays once
+#   - cooldown: a sound is not played again before config.SOUND_COOLDOWNS[name] seconds
+#     (e.g. the bounce sound while the ball sits past the edge for a few frames)
+#   - priority classes (config.SOUND_CLASSES, 'game' by default): 'ui' and 'score' sounds
+#     get config.RESERVED_CHANNELS channels of their own, nothing else plays on them. They
+#     fall back to the shared channels and then take over the oldest voice of their own
+#     channels. 'game' sounds only use the shared channels and are dropped when all are busy.
+# The mixer buffer (config.MIXER_BUFFER) sets the output latency, see output_latency().
+
+DEFAULT_CLASS = 'game'
+
+class VoiceManager():
+
+    def __init__(self, classes=config.SOUND_CLASSES, cooldowns=config.SOUND_COOLDOWNS,
+                 reserved=config.RESERVED_CHANNELS, voices=config.MIXER_VOICES, clock=time.perf_counter):
+        self.classes = classes
+        self.cooldowns = cooldowns
+        self.reserved = reserved
+        self.voices = voices
+        self.clock = clock
+        self._groups = None # class name -> reserved Channels, built once the mixer is initialized
+        self._shared = None
+        self._started = {} # channel -> time its current sound started
+        self._last_played = {}
+        self._tick_played = set()
+        # Plays skipped, by reason
+        self.skipped = {'dedupe': 0, 'cooldown': 0, 'no_channel': 0}
+
+    def _setup(self):
+        pygame.mixer.set_num_channels(self.voices)
+        reserved_count = sum(self.reserved.values())
+        if reserved_count >= self.voices:
+            raise ValueError("Not enough mixer voices for {} reserved channels".format(reserved_count))
+        # Reserved channels are never picked by a plain Sound.play()
+        pygame.mixer.set_reserved(reserved_count)
+        self._groups = {}
+        index = 0
+        for class_name, count in self.reserved.items():
+            # No channel of its own: the class plays on the shared channels, like 'game' sounds
+            if count <= 0:
+                continue
+            self._groups[class_name] = [pygame.mixer.Channel(index + offset) for offset in range(count)]
+            index += count
+        self._shared = [pygame.mixer.Channel(index) for index in range(reserved_count, self.voices)]
+
+    # Called by the GameStateManager before every update
+    def new_tick(self):
+        if self._tick_played:
+            self._tick_played.clear()
+
+    def _free_channel(self, channels):
+        for channel in channels:
+            if not channel.get_busy():
+                return channel
+        return None
+
+    def _find_channel(self, class_name):
+        group = self._groups.get(class_name)
+        if group is None:
+            return self._free_channel(self._shared)
+        channel = self._free_channel(group) or self._free_channel(self._shared)
+        if channel is None:
+            channel = min(group, key=lambda channel: self._started.get(channel, 0.0))
+        return channel
+
+    # sound: pygame.mixer.Sound, name: the resource name. Returns the Channel, or None when
+    # the sound is not played
+    def play(self, sound, name):
+        if name in self._tick_played:
+            self.skipped['dedupe'] += 1
+            return None
+        now = self.clock()
+        last_played = self._last_played.get(name)
+        if last_played is not None and now - last_played < self.cooldowns.get(name, 0.0):
+            self.skipped['cooldown'] += 1
+            return None
+
+        if self._groups is None:
+            self._setup()
+        channel = self._find_channel(self.classes.get(name, DEFAULT_CLASS))
+        if channel is None:
+            self.skipped['no_channel'] += 1
+            TRACER.count('sound_drops')
+            return None
+
+        channel.play(sound)
+        self._started[channel] = now
+        self._last_played[name] = now
+        self._tick_played.add(name)
+        TRACER.count('sound_plays')
+        return channel
+
+    # Seconds of audio buffered by the mixer, from the settings it actually opened with
+    # (the frequency may differ from the one requested)
+    def output_latency(self, buffer_size=config.MIXER_BUFFER):
+        mixer_settings = pygame.mixer.get_init()
+        if not mixer_settings:
+            return None
+        return buffer_size / mixer_settings[0]
+
+    def report(self):
+        latency = self.output_latency()
+        latency_text = "{:.1f} ms".format(1000 * latency) if latency is not None else "no mixer"
+        return "Audio: {} voices ({} reserved), buffer {} samples, output latency {}, skipped {}".format(
+            self.voices, sum(self.reserved.values()), config.MIXER_BUFFER, latency_text, self.skipped)
+
+VOICES = VoiceManager()
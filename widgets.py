@@ -1,35 +1,68 @@
 import pygame
+from fonts import TEXT_CACHE, get_glyph_atlas
 
 class SimpleTextBox():
 
-    def __init__(self, x, y, surface, text='placeholder', color='white', size=36):
+    # glyphs: compose the text from cached glyphs when possible (numbers that change often)
+    def __init__(self, x, y, surface, text='placeholder', color='white', size=36, glyphs=False):
         self._text = text
         self._color = pygame.Color(color)
         self._size = size
-        self._font = pygame.font.SysFont('consolas', size, bold=True)
+        self._atlas = get_glyph_atlas(size, self._color) if glyphs else None
+        self._glyphs = None
         self._pos = (x, y)
-        self.rendered_text = self._font.render(text, True, self._color)
-        self.rect = self.rendered_text.get_rect(center=(x, y))
+        self.rendered_text = None
+        self.rect = None
         self.surface = surface
         self.is_modified = False
+        self.drawn_rect = None
+        self._is_drawn = False
+        self._render()
+
+    def _render(self):
+        if self._atlas is not None and self._atlas.can_render(self._text):
+            self._glyphs, width = self._atlas.layout(self._text)
+            self.rendered_text = None
+            self.rect = pygame.Rect(0, 0, width, self._atlas.height)
+            self.rect.center = self._pos
+        else:
+            self._glyphs = None
+            self.rendered_text = TEXT_CACHE.render(self._text, self._color, self._size)
+            self.rect = self.rendered_text.get_rect(center=self._pos)
 
     def modify(self, newtext='modified', newcolor=None):
         self._text = newtext
         if newcolor:
             self._color = pygame.Color(newcolor)
+            if self._atlas is not None:
+                self._atlas = get_glyph_atlas(self._size, self._color)
         self.is_modified = True
 
     def update(self):
         if self.is_modified:
-            self.rendered_text = self._font.render(self._text, True, self._color)
-            self.rect = self.rendered_text.get_rect(center=self._pos)
+            self._render()
             self.is_modified = False
+            self._is_drawn = False
+
+    # True when the screen does not show the current rendered text yet
+    @property
+    def is_dirty(self):
+        return not self._is_drawn
 
     def draw(self):
-        self.surface.blit(self.rendered_text, self.rect)
+        if self._glyphs is not None:
+            x, y = self.rect.topleft
+            self.surface.blits([(glyph, (x + offset, y)) for glyph, offset in self._glyphs], doreturn=False)
+            self.drawn_rect = self.rect.clip(self.surface.get_rect())
+        else:
+            self.drawn_rect = self.surface.blit(self.rendered_text, self.rect)
+        self._is_drawn = True
+        return self.drawn_rect
 
 class SimpleButton(pygame.sprite.Sprite):
 
+    MOUSE_EVENTS = (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)
+
     def __init__(self, x, y, width, height, screen, color='black', hovered_color='grey',
                  border=False, border_width=2, border_color='white', text=None, text_color='white',
                  text_size=24, hovered_sound=None, clicked_sound=None, callback=None):
@@ -61,6 +94,9 @@ class SimpleButton(pygame.sprite.Sprite):
         self.is_hovered = False
         self.is_clicked = False
         self.is_played = False
+        self.drawn_rect = None
+        self._drawn_image = None
+        self._drawn_enabled = None
 
     def enable(self):
         self.is_enabled = True
@@ -75,8 +111,8 @@ class SimpleButton(pygame.sprite.Sprite):
         self.is_clicked = False
         self.image = self._still_image
 
-    def on_hover_check(self):
-        mouse_x, mouse_y = pygame.mouse.get_pos()
+    def on_hover_check(self, pos=None):
+        mouse_x, mouse_y = pos if pos is not None else pygame.mouse.get_pos()
 
         if self.rect.collidepoint(mouse_x, mouse_y):
             self.is_hovered = True
@@ -100,24 +136,37 @@ class SimpleButton(pygame.sprite.Sprite):
         elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
             self.is_clicked = False
 
+    # Only mouse events can change the hover/click state, they carry the mouse position
     def update(self, event):
         if self.is_enabled:
-            if self.on_hover_check():
+            if event.type in self.MOUSE_EVENTS and self.on_hover_check(event.pos):
                 self.on_click_check(event)
             if self._text:
                 self.textbox.update()
 
+    # True when the button looks different from what was drawn the last time
+    @property
+    def is_dirty(self):
+        return (self._drawn_image is not self.image or
+                self._drawn_enabled != self.is_enabled or
+                (self._text is not None and self.textbox.is_dirty))
+
+    # Returns the area covered by the button (border included), also kept in drawn_rect
     def draw(self):
+        self._drawn_image = self.image
+        self._drawn_enabled = self.is_enabled
+        area = self.rect.copy()
+        if self._border:
+            area = self.rect.inflate(2*self._border_width, 2*self._border_width)
+
         if self.is_enabled:
             if self._border:
-                pygame.draw.rect(self.screen,
-                                 pygame.Color(self._border_color),
-                                 (self.rect.x - self._border_width,
-                                  self.rect.y - self._border_width,
-                                  self._width + 2*self._border_width,
-                                  self._height + 2*self._border_width))
+                pygame.draw.rect(self.screen, pygame.Color(self._border_color), area)
 
             self.screen.blit(self.image, self.rect)
 
             if self._text:
-                self.textbox.draw()
+                area.union_ip(self.textbox.draw())
+
+        self.drawn_rect = area
+        return area